@@ -37,6 +37,8 @@ import torch
 import torch.ao.quantization
 
 from .... import xnn
+# the batched search is shared with the v3 observers
+from ..v3.observer_utils import _batched_mse_param_search
 
 
 ####################################################################
@@ -66,14 +68,19 @@ def ceil2_num(x):
 
 def _adjust_qparams_power2_scale(min_val, max_val, quant_min, quant_max, scale, zero_point, eps):
     r"""Calculates the quantization parameters."""
-    # make scale a power of 2 value
-    scale = _ceil2_tensor(scale)
+    # make scale a power of 2 value - same as _ceil2_tensor, zero values remain zero (so the all zero check is not needed)
+    scale = torch.sign(scale) * xnn.layers.functional.ceil2_func(torch.abs(scale))
     scale = torch.max(scale, eps)
-    if len(torch.unique(zero_point))>1 or torch.unique(zero_point) not in (0,127):
-        # adjust the zero_point based on new scale
-        min_val_neg = torch.min(min_val, torch.zeros_like(min_val))
-        zero_point = quant_min - torch.round(min_val_neg / scale).to(torch.int)
-        zero_point = torch.clamp(zero_point, quant_min, quant_max)
+    # the zero_point is kept only if all the channels have the same zero_point and it is 0 or 127,
+    # this is found with tensor ops instead of torch.unique so that there is no sort or device sync per channel
+    zero_point_flat = zero_point.reshape(-1)
+    keep_zero_point = torch.all(zero_point_flat == zero_point_flat[:1]) & ((zero_point_flat[:1] == 0) | (zero_point_flat[:1] == 127)).all()
+    # adjust the zero_point based on new scale
+    min_val_neg = torch.min(min_val, torch.zeros_like(min_val))
+    adjusted_zero_point = quant_min - torch.round(min_val_neg / scale).to(torch.int)
+    adjusted_zero_point = torch.clamp(adjusted_zero_point, quant_min, quant_max)
+    # the zero_point keeps its dtype (eg. int64 from calculate_qparams)
+    zero_point = torch.where(keep_zero_point, zero_point, adjusted_zero_point.to(zero_point.dtype))
     return scale, zero_point
 
 
@@ -81,9 +88,17 @@ def _adjust_qparams_power2_scale(min_val, max_val, quant_min, quant_max, scale,
 # histogram observer from torch.ao.quantization
 # (MSE based and includes merging of histograms across iterations)
 class CumulativeMSEHistogramObserver(torch.ao.quantization.HistogramObserver):
-    def __init__(self, *args, range_shrink_percentile=None, fast_mode=False, **kwargs):
+    def __init__(self, *args, range_shrink_percentile=None, fast_mode=False, batched_search=False, sample_budget=None, **kwargs):
         super().__init__(*args, bins=256, upsample_rate=16, **kwargs)
         self.fast_mode = fast_mode
+        self.batched_search = batched_search
+        # maximum number of elements added to the histogram in each call (None: all the elements)
+        self.sample_budget = sample_budget
+
+    def _non_linear_param_search(self):
+        if self.batched_search:
+            return _batched_mse_param_search(self.histogram, self.min_val, self.max_val, self.dst_nbins)
+        return super()._non_linear_param_search()
 
     def forward(self, x_orig: torch.Tensor) -> torch.Tensor:
         fast_stride = 2
@@ -91,7 +106,18 @@ class CumulativeMSEHistogramObserver(torch.ao.quantization.HistogramObserver):
         is_large_tensor4 = len(x_orig.size()) == 4 and (x_orig.size(-2) > fast_stride2) and (x_orig.size(-1) > fast_stride2)
         is_large_tensor3 = len(x_orig.size()) == 3 and (x_orig.size(-1) > fast_stride2)
         src = x_orig
-        if self.fast_mode and (is_large_tensor3 or is_large_tensor4):
+        if self.sample_budget is not None:
+            src, sample_weight = self._sample(x_orig)
+            if sample_weight != 1.0:
+                # the histogram stays in units of elements (as without sampling, so that it can be merged / saved / synced)
+                # only the sampled counts are scaled: the histogram update (re-binning and add) is linear in the counts,
+                # so (histogram / weight + new_counts) * weight == histogram + new_counts * weight
+                self.histogram.div_(sample_weight)
+                super().forward(src)
+                self.histogram.mul_(sample_weight)
+                return x_orig
+            #
+        elif self.fast_mode and (is_large_tensor3 or is_large_tensor4):
             r_start = random.randint(0, fast_stride - 1)
             c_start = random.randint(0, fast_stride - 1)
             if is_large_tensor4:
@@ -102,6 +128,15 @@ class CumulativeMSEHistogramObserver(torch.ao.quantization.HistogramObserver):
         super().forward(src)
         return x_orig
 
+    def _sample(self, x_orig):
+        # strided sampling with a random offset over the flattened tensor (any rank) - every element has the same 
+        # probability of being sampled, so the cost of the histogram is bounded by sample_budget for any input size.
+        # returns the samples and the number of elements represented by each sample
+        x_flat = x_orig.detach().reshape(-1)
+        stride = max(math.ceil(x_flat.numel() / self.sample_budget), 1)
+        src = x_flat[random.randint(0, stride - 1)::stride] if stride > 1 else x_flat
+        return src, x_flat.numel() / max(src.numel(), 1)
+
 
 class MSEHistogramObserver(CumulativeMSEHistogramObserver):
     def __init__(self, *args, range_shrink_percentile=None, **kwargs):
@@ -141,7 +141,9 @@ def get_act_quantization_config(activation_qconfig, is_qat=True, fast_mode=False
                                              range_max=activation_qconfig.get('range_max', None),
                                              fixed_range=activation_qconfig.get('fixed_range', False),
                                              class_name=activation_qconfig.get('observer_name', observer_name),
-                                             range_shrink_percentile=activation_qconfig.get('range_shrink_percentile', 0.01))
+                                             range_shrink_percentile=activation_qconfig.get('range_shrink_percentile', 0.01),
+                                             batched_search=activation_qconfig.get('batched_search', False),
+                                             sample_budget=activation_qconfig.get('sample_budget', None))
                
     fake_quantized_activation_observer = fake_quantize_types.AdaptiveActivationFakeQuantize.with_args(observer=activation_observer) if is_qat else activation_observer
     
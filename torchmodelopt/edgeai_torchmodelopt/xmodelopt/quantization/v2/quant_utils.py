@@ -114,6 +114,8 @@ class QuantAttention(nn.Module):
         self.proj_drop = nn.Dropout(proj_drop)
         self.softmax = nn.Softmax(dim=-1)
         self.relative_position_bias_table = None
+        # scale for q as a vector (so that it is quantized as a tensor input of mul), created once and moved along with the module
+        self.register_buffer('scale_tensor', torch.full((self.head_dim,), self.scale), persistent=False)
 
     def forward(self, x: torch.Tensor, **kwargs) -> torch.Tensor:
         B, N, C = x.shape
@@ -122,7 +124,7 @@ class QuantAttention(nn.Module):
         q, k = self.q_norm(q), self.k_norm(k)
 
         #q = torch.mul(q, torch.tensor(self.scale))
-        q = torch.mul(q, torch.tensor([self.scale]*self.head_dim))
+        q = torch.mul(q, self.scale_tensor)
         attn = torch.matmul(q, k.transpose(-2, -1))
         if self.relative_position_bias_table is not None:
             attn = attn + _get_rel_pos_bias(self.relative_position_bias_table, self.relative_position_index, self.window_area)
@@ -35,5 +35,8 @@ from .qconfig_types import *
 
 
 from . import quant_func_wrapper
+from . import mixed_precision
+from .error_profiler import QuantErrorProfiler
+from .int_executor import IntegerReferenceExecutor
 
 from .quant_module import QATPT2EModule, PTQPT2EModule
@@ -0,0 +1,245 @@
+#################################################################################
+# Copyright (c) 2018-2023, Texas Instruments Incorporated - http://www.ti.com
+# All Rights Reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#################################################################################
+
+import os
+import csv
+import json
+import math
+import torch
+from torch.fx import Interpreter, Node
+from torch.ao.quantization.fx import _decomposed  # registers the quantized_decomposed ops
+
+from ... import utils
+from . import quant_utils
+
+
+_QUANTIZE_TARGETS = (torch.ops.quantized_decomposed.quantize_per_tensor.default,
+                     torch.ops.quantized_decomposed.quantize_per_tensor.tensor)
+_QUANTIZE_PER_CHANNEL_TARGETS = (torch.ops.quantized_decomposed.quantize_per_channel.default,)
+_DEQUANTIZE_TARGETS = (torch.ops.quantized_decomposed.dequantize_per_tensor.default,
+                       torch.ops.quantized_decomposed.dequantize_per_tensor.tensor,
+                       torch.ops.quantized_decomposed.dequantize_per_channel.default)
+
+
+def _get_module_output_nodes(graph_module):
+    # the last node of each (innermost) module in the graph is the output of that module
+    module_output_nodes = {}
+    for node in graph_module.graph.nodes:
+        nn_module_stack = node.meta.get('nn_module_stack', None)
+        if not nn_module_stack or node.op != 'call_function':
+            continue
+        #
+        key, value = list(nn_module_stack.items())[-1]
+        path = value[0] if isinstance(value, tuple) else key
+        module_output_nodes[quant_utils._normalize_module_path(path)] = node
+    #
+    return module_output_nodes
+
+
+class _RunningErrorStats():
+    def __init__(self):
+        self.error = 0.0
+        self.signal = 0.0
+        self.max_abs_error = 0.0
+        self.num_clipped = 0
+        self.numel = 0
+        self.num_batches = 0
+
+    def update(self, float_output, quant_output, clip_range=None):
+        float_output = float_output.detach().float()
+        error = quant_output.detach().float() - float_output
+        # a single device to host transfer per layer per batch
+        values = torch.stack([torch.sum(error * error), torch.sum(float_output * float_output), torch.amax(torch.abs(error)),
+                              torch.sum((float_output < clip_range[0]) | (float_output > clip_range[1])).float() if clip_range is not None 
+                              else torch.zeros((), device=error.device)]).tolist()
+        self.error += values[0]
+        self.signal += values[1]
+        self.max_abs_error = max(self.max_abs_error, values[2])
+        self.num_clipped += int(values[3])
+        self.numel += float_output.numel()
+        self.num_batches += 1
+
+    def get_dict(self):
+        sqnr = 10 * math.log10(self.signal / self.error) if self.error > 0 and self.signal > 0 else float('inf')
+        return dict(sqnr_db=sqnr, mse=self.error / max(self.numel, 1), max_abs_error=self.max_abs_error,
+                    clip_rate=self.num_clipped / max(self.numel, 1), numel=self.numel, num_batches=self.num_batches)
+
+
+class _ProfilerInterpreter(Interpreter):
+    def __init__(self, module, profiler):
+        super().__init__(module)
+        self.profiler = profiler
+
+    def run_node(self, node):
+        result = super().run_node(node)
+        module_path = self.profiler.capture_nodes.get(node.name, None)
+        if module_path is not None and module_path in self.profiler.float_outputs and isinstance(result, torch.Tensor):
+            float_output = self.profiler.float_outputs.pop(module_path)
+            if float_output.shape == result.shape:
+                clip_range = self.profiler._get_clip_range(node, self.env, result.dim())
+                self.profiler.stats.setdefault(module_path, _RunningErrorStats()).update(float_output, result, clip_range)
+            #
+        #
+        return result
+
+
+class QuantErrorProfiler():
+    '''
+    Streaming per layer quantization error profiler. The float model (by default __quant_params__.original_model)
+    and the prepared or converted model are run on the same batches and the output of every leaf module of the float
+    model is compared with the (fake) quantized value of the corresponding node in the quantized graph.
+    Only running sums are kept, so the memory does not grow with the number of batches.
+    '''
+    def __init__(self, quant_model, float_model=None):
+        self.quant_model = quant_model
+        if float_model is None:
+            float_model = utils.get_retained_model(getattr(quant_model, '__quant_params__', {}).get('original_model', None))
+            assert float_model is not None, "float_model must be provided if the original model is not retained"
+        #
+        self.float_model = float_model
+        self.modules = dict(quant_model.named_modules())
+        self.stats = {}
+        self.float_outputs = {}
+        float_modules = {quant_utils._normalize_module_path(name): module for name, module in float_model.named_modules() 
+                         if name and len(list(module.children())) == 0}
+        self.capture_nodes = {}
+        for module_path, node in _get_module_output_nodes(quant_model).items():
+            if module_path in float_modules:
+                self.capture_nodes[self._get_quantized_node(node).name] = module_path
+            #
+        #
+        self.hooks = [float_modules[module_path].register_forward_hook(self._get_float_hook(module_path))
+                      for module_path in set(self.capture_nodes.values())]
+
+    def _get_float_hook(self, module_path):
+        def _float_hook(module, inputs, output):
+            if isinstance(output, torch.Tensor):
+                self.float_outputs[module_path] = output.detach()
+            #
+        #
+        return _float_hook
+
+    def _is_quant_module(self, node):
+        return node.op == 'call_module' and isinstance(self.modules.get(node.target, None), 
+            (torch.ao.quantization.FakeQuantizeBase, torch.ao.quantization.ObserverBase))
+
+    def _get_quantized_node(self, node):
+        # the value after the output fake quantize (prepared model) or after the quantize-dequantize (converted model)
+        for user in node.users:
+            if self._is_quant_module(user):
+                return user
+            elif user.target in _QUANTIZE_TARGETS + _QUANTIZE_PER_CHANNEL_TARGETS:
+                dequantize_users = [u for u in user.users if u.target in _DEQUANTIZE_TARGETS]
+                if dequantize_users:
+                    return dequantize_users[0]
+                #
+            #
+        #
+        return node
+
+    def _get_clip_range(self, node, env, ndim):
+        # per channel ranges are shaped to broadcast with the output (channels in ch_axis)
+        if self._is_quant_module(node):
+            module = self.modules[node.target]
+            if isinstance(module, torch.ao.quantization.FakeQuantizeBase):
+                scale, zero_point = module.scale.detach(), module.zero_point
+            else:
+                scale, zero_point = module.calculate_qparams()
+            #
+            quant_min, quant_max = module.quant_min, module.quant_max
+            ch_axis = getattr(module, 'ch_axis', None)
+        elif node.target in _DEQUANTIZE_TARGETS and node.args[0].target in _QUANTIZE_TARGETS:
+            q_args = [env[a] if isinstance(a, Node) else a for a in node.args[0].args]
+            scale, zero_point, quant_min, quant_max = q_args[1:5]
+            ch_axis = None
+        elif node.target in _DEQUANTIZE_TARGETS and node.args[0].target in _QUANTIZE_PER_CHANNEL_TARGETS:
+            q_args = [env[a] if isinstance(a, Node) else a for a in node.args[0].args]
+            scale, zero_point, ch_axis, quant_min, quant_max = q_args[1:6]
+        else:
+            return None
+        #
+        clip_min, clip_max = (quant_min - zero_point) * scale, (quant_max - zero_point) * scale
+        if isinstance(scale, torch.Tensor) and scale.numel() != 1:
+            if ch_axis is None or ndim == 0:
+                return None
+            #
+            shape = [1] * ndim
+            shape[ch_axis] = -1
+            clip_min, clip_max = clip_min.reshape(shape), clip_max.reshape(shape)
+        #
+        return (clip_min, clip_max)
+
+    def update(self, *args, **kwargs):
+        with torch.no_grad():
+            self.float_outputs = {}
+            self.float_model(*args, **kwargs)
+            # the keyword inputs are given to the graph by name (Interpreter.run takes only positional inputs)
+            _ProfilerInterpreter(self.quant_model, self).run(*quant_utils.get_graph_args(self.quant_model, args, kwargs))
+            self.float_outputs = {}
+        #
+
+    def profile(self, loader, max_batches=None, input_fn=None):
+        device = next(iter(self.quant_model.parameters())).device
+        input_fn = input_fn or (lambda batch: quant_utils.get_calibration_inputs(batch, device=device))
+        for batch_index, batch in enumerate(loader):
+            if max_batches is not None and batch_index >= max_batches:
+                break
+            #
+            args, kwargs = input_fn(batch)
+            self.update(*args, **kwargs)
+        #
+        return self.get_report()
+
+    def get_report(self):
+        # worst layers first
+        report = [dict(layer=module_path, **stats.get_dict()) for module_path, stats in self.stats.items()]
+        return sorted(report, key=lambda r: r['sqnr_db'])
+
+    def save_report(self, filename):
+        report = self.get_report()
+        if os.path.splitext(filename)[1].lower() == '.csv':
+            with open(filename, 'w', newline='') as fp:
+                writer = csv.DictWriter(fp, fieldnames=list(report[0].keys()) if report else ['layer'])
+                writer.writeheader()
+                writer.writerows(report)
+            #
+        else:
+            with open(filename, 'w') as fp:
+                json.dump(report, fp, indent=2)
+            #
+        #
+        return report
+
+    def remove_hooks(self):
+        for hook in self.hooks:
+            hook.remove()
+        #
+        self.hooks = []
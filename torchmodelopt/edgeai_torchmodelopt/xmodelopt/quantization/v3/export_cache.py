@@ -0,0 +1,390 @@
+#################################################################################
+# Copyright (c) 2018-2023, Texas Instruments Incorporated - http://www.ti.com
+# All Rights Reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#################################################################################
+
+import os
+import sys
+import copy
+import functools
+import pickle
+import hashlib
+import inspect
+import warnings
+import torch
+import torch._dynamo as torchdynamo
+from torch.fx import GraphModule, Graph, Node
+from torch.utils import _pytree as pytree
+
+from ....version import __version__
+
+
+# node.meta entries that are needed by the quantizer (get_source_partitions etc.) and can be stored on disk
+# fake tensor values ('val') are not picklable, they are re-generated after loading
+_EXPORT_CACHE_META_KEYS = ('source_fn_stack', 'source_fn', 'nn_module_stack', 'stack_trace', 'torch_fn')
+
+# version of the on-disk format, bump this if the serialization below changes
+_EXPORT_CACHE_FORMAT_VERSION = 2
+
+
+class ExportGraphCache():
+    '''
+    On-disk cache of the aten graph produced by torchdynamo.export in quant_func.init
+    The key is computed from the code of the model (including the functions that it calls), the names and shapes of 
+    its parameters / buffers, the example input shapes/dtypes, the decomposition table and the torch version - 
+    so any change to these will cause a re-export. The values of the parameters / buffers are not stored in the cache,
+    they are taken from the given model when the graph is loaded.
+    '''
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.stats = dict(hits=0, misses=0, writes=0, errors=0)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_stats(self):
+        return dict(self.stats)
+
+    def reset_stats(self):
+        for k in self.stats:
+            self.stats[k] = 0
+
+    def export(self, model, example_inputs, example_kwargs, decomposition_table, **export_kwargs):
+        cache_key = get_export_cache_key(model, example_inputs, example_kwargs, decomposition_table, **export_kwargs)
+        cache_file = os.path.join(self.cache_dir, f'{cache_key}.pt')
+        if os.path.exists(cache_file):
+            try:
+                m = load_graph_module(cache_file, model)
+                _propagate_fake_values(m, example_inputs, example_kwargs)
+                self.stats['hits'] += 1
+                print(f"Dynamo Export loaded from cache: {cache_file} \n\n")
+                return m
+            except Exception as e:
+                self.stats['errors'] += 1
+                warnings.warn(f"could not load the exported graph from cache {cache_file}, exporting again - {e}")
+            #
+        #
+        self.stats['misses'] += 1
+        m, guards = torchdynamo.export(model, aten_graph=True, pre_dispatch=True, decomposition_table=decomposition_table, 
+                                       **export_kwargs)(*example_inputs, **example_kwargs)
+        try:
+            save_graph_module(m, cache_file, model)
+            self.stats['writes'] += 1
+        except Exception as e:
+            self.stats['errors'] += 1
+            warnings.warn(f"could not write the exported graph to cache {cache_file} - {e}")
+        #
+        return m
+
+
+# the code in these packages is covered by their versions in the key
+_EXPORT_CACHE_VERSIONED_PACKAGES = ('builtins', 'torch', 'numpy', 'typing', 'functools', 'collections', 'math', 'operator')
+
+
+def _is_versioned(obj):
+    module_name = getattr(obj, '__module__', None) or ''
+    return module_name.split('.')[0] in _EXPORT_CACHE_VERSIONED_PACKAGES
+
+
+def _update_hash_with_code_object(hasher, code):
+    hasher.update(f'{code.co_qualname if hasattr(code, "co_qualname") else code.co_name}:{code.co_names}'.encode())
+    hasher.update(code.co_code)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            _update_hash_with_code_object(hasher, const)
+        elif isinstance(const, frozenset):
+            # the order of a set depends on the hash seed of the process
+            hasher.update(repr(sorted(repr(value) for value in const)).encode())
+        else:
+            hasher.update(repr(const).encode())
+        #
+    #
+
+
+def _get_code_names(code):
+    # global / attribute names used by the code, including the nested functions, lambdas and comprehensions
+    names = list(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names += _get_code_names(const)
+        #
+    #
+    return names
+
+
+def _get_referenced_objects(fn, code):
+    fn_globals = getattr(fn, '__globals__', {})
+    names = _get_code_names(code)
+    for name in names:
+        value = fn_globals.get(name, None)
+        if inspect.ismodule(value):
+            # eg. helpers.fn(x): the attributes of the module that are used by the code
+            yield from (getattr(value, attr_name) for attr_name in names if hasattr(value, attr_name))
+        elif value is not None:
+            yield value
+        #
+    #
+    for cell in (getattr(fn, '__closure__', None) or ()):
+        try:
+            yield cell.cell_contents
+        except ValueError:
+            pass
+        #
+    #
+
+
+def _update_hash_with_callable(hasher, obj, visited):
+    # hashes the code of the function / class and, recursively, of the functions and classes that it refers to,
+    # so that a change in a free function or a helper in another module that is called by forward also changes the key
+    if _is_versioned(obj):
+        return
+    #
+    if inspect.isclass(obj):
+        if id(obj) in visited:
+            return
+        #
+        visited.add(id(obj))
+        hasher.update(f'class:{obj.__module__}.{obj.__qualname__}'.encode())
+        for base in obj.__mro__:
+            if not _is_versioned(base):
+                for attr_name, value in sorted(vars(base).items(), key=lambda kv: kv[0]):
+                    value = value.__func__ if isinstance(value, (staticmethod, classmethod)) else value
+                    value = value.fget if isinstance(value, property) else value
+                    if inspect.isfunction(value):
+                        _update_hash_with_callable(hasher, value, visited)
+                    #
+                #
+            #
+        #
+        return
+    #
+    fn = inspect.unwrap(getattr(obj, '__func__', obj)) if callable(obj) else None
+    fn = fn.func if isinstance(fn, functools.partial) else fn
+    code = getattr(fn, '__code__', None)
+    # the code objects are visited only once (bound methods / partials are new objects for each access)
+    if code is None or id(code) in visited:
+        return
+    #
+    visited.add(id(code))
+    _update_hash_with_code_object(hasher, code)
+    for value in _get_referenced_objects(fn, code):
+        if inspect.isfunction(value) or inspect.isclass(value) or inspect.ismethod(value) or isinstance(value, functools.partial):
+            _update_hash_with_callable(hasher, value, visited)
+        #
+    #
+
+
+def get_export_cache_key(model, example_inputs, example_kwargs, decomposition_table, **export_kwargs):
+    hasher = hashlib.sha256()
+    hasher.update(f'format:{_EXPORT_CACHE_FORMAT_VERSION}'.encode())
+    hasher.update(f'python:{sys.version}'.encode())
+    hasher.update(f'torch:{torch.__version__}'.encode())
+    hasher.update(f'edgeai_torchmodelopt:{__version__}'.encode())
+    # model code - every module class that is used in the model and the functions that these call
+    visited = set()
+    module_types = sorted(set(type(m) for m in model.modules()), key=lambda t: f'{t.__module__}.{t.__qualname__}')
+    for module_type in module_types:
+        _update_hash_with_callable(hasher, module_type, visited)
+    #
+    # model structure - the names, shapes and dtypes of the parameters / buffers (their values are not in the cache)
+    for name, module in model.named_modules():
+        hasher.update(f'module:{name}:{module.training}'.encode())
+    #
+    for name, tensor in _named_tensors(model):
+        hasher.update(f'{name}:{tuple(tensor.shape)}:{tensor.dtype}:{tensor.device.type}:{isinstance(tensor, torch.nn.Parameter)}'.encode())
+    #
+    # example inputs - only the shapes, dynamic dims (torch._dynamo.mark_dynamic) and dtypes affect the exported graph
+    flat_inputs, input_spec = pytree.tree_flatten((example_inputs, example_kwargs))
+    hasher.update(str(input_spec).encode())
+    for inp in flat_inputs:
+        if isinstance(inp, torch.Tensor):
+            dynamic_dims = sorted(getattr(inp, '_dynamo_dynamic_indices', ()))
+            hasher.update(f'{tuple(inp.shape)}:{dynamic_dims}:{inp.dtype}:{inp.device.type}'.encode())
+        else:
+            hasher.update(repr(inp).encode())
+        #
+    #
+    # decomposition table - the decompositions and the helpers that they call (eg. LayerNormWithoutGB in quant_utils)
+    for op, fn in sorted(decomposition_table.items(), key=lambda kv: str(kv[0])):
+        hasher.update(f'{op}:{fn.__module__}.{fn.__qualname__}'.encode())
+        _update_hash_with_callable(hasher, fn, visited)
+    #
+    hasher.update(repr(sorted(export_kwargs.items())).encode())
+    return hasher.hexdigest()
+
+
+def _named_tensors(model):
+    yield from model.named_parameters()
+    yield from model.named_buffers()
+
+
+def _encode_target(target):
+    if isinstance(target, torch._ops.OpOverload):
+        return ('op_overload', target._schema.name, target._overloadname)
+    #
+    return ('object', target)
+
+
+def _decode_target(encoded_target):
+    kind, *values = encoded_target
+    if kind == 'op_overload':
+        schema_name, overload_name = values
+        namespace, op_name = schema_name.split('::')
+        op_packet = getattr(getattr(torch.ops, namespace), op_name)
+        return getattr(op_packet, overload_name or 'default')
+    #
+    return values[0]
+
+
+class _NodeRef():
+    def __init__(self, name):
+        self.name = name
+
+
+def _encode_arg(arg):
+    return pytree.tree_map_only(Node, lambda n: _NodeRef(n.name), arg)
+
+
+def _decode_arg(arg, env):
+    return pytree.tree_map_only(_NodeRef, lambda r: env[r.name], arg)
+
+
+def save_graph_module(gm, filename, model=None):
+    node_records = []
+    for node in gm.graph.nodes:
+        meta = {}
+        for key in _EXPORT_CACHE_META_KEYS:
+            if key in node.meta:
+                try:
+                    pickle.dumps(node.meta[key])
+                    meta[key] = node.meta[key]
+                except Exception:
+                    pass
+                #
+            #
+        #
+        node_records.append(dict(name=node.name, op=node.op, target=_encode_target(node.target),
+                                 args=_encode_arg(node.args), kwargs=_encode_arg(node.kwargs), type=node.type, meta=meta))
+    #
+    # parameters, buffers and any other tensor attributes that are accessed by get_attr nodes
+    gm_tensors = dict(_named_tensors(gm))
+    for node in gm.graph.nodes:
+        if node.op == 'get_attr' and node.target not in gm_tensors:
+            attr_value = _get_nested_attr(gm, node.target)
+            if isinstance(attr_value, torch.Tensor):
+                gm_tensors[node.target] = attr_value
+            #
+        #
+    #
+    # the tensors of the model are stored by their name in the model (they are taken from the model when loading), 
+    # only the other tensors (eg. constants created in forward) are stored in the cache
+    model_tensor_names = {id(tensor): name for name, tensor in _named_tensors(model)} if model is not None else {}
+    attr_sources = {name: model_tensor_names[id(tensor)] for name, tensor in gm_tensors.items() if id(tensor) in model_tensor_names}
+    attrs = {name: tensor.detach() for name, tensor in gm_tensors.items() if name not in attr_sources}
+    param_names = [name for name, _ in gm.named_parameters()]
+    data = dict(format_version=_EXPORT_CACHE_FORMAT_VERSION, nodes=node_records, attrs=attrs, attr_sources=attr_sources, 
+                param_names=param_names, codegen=gm.graph._codegen, meta=copy.copy(getattr(gm, 'meta', {})), class_name=gm.__class__.__name__)
+    # write to a temporary file first, so that an interrupted write does not leave a corrupt cache entry
+    tmp_filename = filename + f'.{os.getpid()}.tmp'
+    torch.save(data, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def load_graph_module(filename, model=None):
+    data = torch.load(filename, map_location='cpu', weights_only=False)
+    if data.get('format_version', None) != _EXPORT_CACHE_FORMAT_VERSION:
+        raise RuntimeError(f"unsupported export cache format in {filename}")
+    #
+    attr_sources = data['attr_sources']
+    if attr_sources and model is None:
+        raise RuntimeError(f"the model is needed to load the parameters / buffers of the cached graph {filename}")
+    #
+    root = torch.nn.Module()
+    param_names = set(data['param_names'])
+    model_tensors = dict(_named_tensors(model)) if model is not None else {}
+    for name, source_name in attr_sources.items():
+        # the same tensor objects as in a fresh export (that shares the parameters / buffers with the model)
+        _set_nested_attr(root, name, model_tensors[source_name], is_buffer=(name not in param_names))
+    #
+    for name, tensor in data['attrs'].items():
+        value = torch.nn.Parameter(tensor, requires_grad=tensor.is_floating_point()) if name in param_names else tensor
+        _set_nested_attr(root, name, value, is_buffer=(name not in param_names))
+    #
+    graph = Graph()
+    env = {}
+    for record in data['nodes']:
+        args = _decode_arg(record['args'], env)
+        kwargs = _decode_arg(record['kwargs'], env)
+        node = graph.create_node(record['op'], _decode_target(record['target']), args, kwargs, name=record['name'], type_expr=record['type'])
+        node.meta.update(record['meta'])
+        env[record['name']] = node
+    #
+    graph._codegen = data['codegen']
+    gm = GraphModule(root, graph, data['class_name'])
+    gm.meta.update(data['meta'])
+    return gm
+
+
+def _get_nested_attr(module, target):
+    value = module
+    for atom in target.split('.'):
+        value = getattr(value, atom)
+    #
+    return value
+
+
+def _set_nested_attr(module, target, value, is_buffer=True):
+    *prefix, attr_name = target.split('.')
+    for atom in prefix:
+        if not hasattr(module, atom):
+            module.add_module(atom, torch.nn.Module())
+        #
+        module = getattr(module, atom)
+    #
+    if isinstance(value, torch.nn.Parameter):
+        module.register_parameter(attr_name, value)
+    elif is_buffer:
+        module.register_buffer(attr_name, value)
+    else:
+        setattr(module, attr_name, value)
+
+
+def _propagate_fake_values(gm, example_inputs, example_kwargs):
+    # the fake tensor values in node.meta['val'] are used by prepare_pt2e, re-create them since they are not stored in the cache
+    # (these have static shapes, so init does not use the cache for the graphs exported with dynamic_axes)
+    from torch.fx.passes.fake_tensor_prop import FakeTensorProp
+    from torch._subclasses.fake_tensor import FakeTensorMode
+    flat_inputs = [inp for inp in pytree.tree_leaves((example_inputs, example_kwargs)) if isinstance(inp, torch.Tensor)]
+    placeholders = [node for node in gm.graph.nodes if node.op == 'placeholder']
+    if len(flat_inputs) != len(placeholders):
+        warnings.warn("could not match the example inputs to the placeholders of the cached graph, node.meta['val'] is not populated")
+        return gm
+    #
+    fake_mode = FakeTensorMode(allow_non_fake_inputs=True)
+    fake_inputs = [fake_mode.from_tensor(inp) for inp in flat_inputs]
+    FakeTensorProp(gm, mode=fake_mode).propagate_dont_convert_inputs(*fake_inputs)
+    return gm
@@ -31,7 +31,7 @@
 
 import math
 import torch
-from torch.ao.quantization import MovingAverageMinMaxObserver, MovingAveragePerChannelMinMaxObserver, FakeQuantize
+from torch.ao.quantization import MovingAverageMinMaxObserver, MovingAveragePerChannelMinMaxObserver, FakeQuantize, FusedMovingAvgObsFakeQuantize
 from .... import xnn
 
 
@@ -129,9 +129,186 @@ class AdaptiveActivationFakeQuantize(AdaptiveFakeQuantize):
         return x_q
 
 
+####################################################################
+class LearnableFakeQuantize(FakeQuantize):
+    '''
+    LSQ / LSQ+ style fake quantize with a learnable scale (and a learnable zero_point for affine quantization).
+    The observer is used only in the first init_steps training batches to initialize the scale and zero_point,
+    after that the quantization parameters are learned from the gradients of the loss, 
+    so that there are no range reductions in the training step.
+    For per channel quantization, channel_len (the number of channels) must be given at construction, 
+    as in _LearnableFakeQuantize in torch - the quantizer fills it from the shape of the weight. The parameters 
+    then have their final shape before the optimizer is created and are only updated in place afterwards.
+    '''
+    def __init__(self, *args, init_steps=1, use_grad_scaling=True, channel_len=-1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.init_steps = init_steps
+        self.use_grad_scaling = use_grad_scaling
+        self.num_init_steps = 0
+        self.power2_scale = getattr(self.activation_post_process, 'power2_scale', False)
+        learn_zero_point = self.qscheme in (torch.per_tensor_affine, torch.per_channel_affine)
+        # the scale and zero_point buffers of FakeQuantize are replaced by parameters (same as _LearnableFakeQuantize in torch)
+        # a resize after the optimizer was created would detach the parameters from the optimizer (and its state)
+        if self.is_per_channel and channel_len <= 0:
+            raise ValueError("LearnableFakeQuantize: channel_len (the number of channels) is required for per channel quantization")
+        #
+        num_qparams = channel_len if self.is_per_channel else 1
+        del self.scale
+        del self.zero_point
+        self.scale = torch.nn.Parameter(torch.ones(num_qparams))
+        self.zero_point = torch.nn.Parameter(torch.zeros(num_qparams), requires_grad=learn_zero_point)
+        self.learn_zero_point = learn_zero_point
+        # python side copies of the observer_enabled / fake_quant_enabled flags - avoid a host sync in every forward
+        self._observer_on = bool(self.observer_enabled[0] == 1)
+        self._fake_quant_on = bool(self.fake_quant_enabled[0] == 1)
+
+    @torch.jit.export
+    def enable_observer(self, enabled: bool = True) -> None:
+        # the learning of scale/zero_point is also frozen along with the observer
+        super().enable_observer(enabled)
+        self._observer_on = enabled
+        self.scale.requires_grad_(enabled)
+        self.zero_point.requires_grad_(enabled and self.learn_zero_point)
+
+    @torch.jit.export
+    def enable_fake_quant(self, enabled: bool = True) -> None:
+        super().enable_fake_quant(enabled)
+        self._fake_quant_on = enabled
+
+    def _copy_qparam(self, param, value):
+        # in place, so that the optimizer keeps training the same parameters
+        value = value.to(device=param.device, dtype=torch.float32).reshape(-1)
+        if param.shape != value.shape:
+            raise RuntimeError(f"LearnableFakeQuantize: qparams of shape {tuple(value.shape)} for the parameter of shape {tuple(param.shape)} "
+                               f"- check channel_len and ch_axis")
+        #
+        param.data.copy_(value)
+
+    def _initialize_qparams(self, X):
+        with torch.no_grad():
+            self.activation_post_process(X.detach())
+            _scale, _zero_point = self.activation_post_process.calculate_qparams()
+            self._copy_qparam(self.scale, _scale)
+            self._copy_qparam(self.zero_point, _zero_point)
+        #
+        self.num_init_steps += 1
+
+    def _get_scale(self):
+        scale = torch.clamp(self.scale, min=torch.finfo(torch.float32).eps)
+        if self.power2_scale:
+            # straight through estimator for the rounding of the scale to power of 2
+            scale_power2 = torch.pow(2, torch.ceil(torch.log2(scale)))
+            scale = scale + (scale_power2 - scale).detach()
+        #
+        return scale
+
+    def forward(self, X):
+        # initialization also happens in the first forward in eval mode, so that the scale is never left at the default
+        if (self.training or self.num_init_steps == 0) and self.num_init_steps < self.init_steps and self._observer_on:
+            self._initialize_qparams(X)
+        #
+        if self._fake_quant_on:
+            grad_factor = (1.0 / math.sqrt(X.numel() * self.quant_max)) if self.use_grad_scaling else 1.0
+            zero_point = self.zero_point if self.learn_zero_point else self.zero_point.detach()
+            if self.is_per_channel:
+                X = torch._fake_quantize_learnable_per_channel_affine(X, self._get_scale(), zero_point, self.ch_axis,
+                                                                     self.quant_min, self.quant_max, grad_factor)
+            else:
+                X = torch._fake_quantize_learnable_per_tensor_affine(X, self._get_scale(), zero_point,
+                                                                    self.quant_min, self.quant_max, grad_factor)
+            #
+        #
+        return X
+
+    @torch.jit.export
+    def calculate_qparams(self):
+        if self.num_init_steps == 0:
+            # not trained - fall back to the observer (for example in case of calibration without training)
+            return self.activation_post_process.calculate_qparams()
+        #
+        scale = self._get_scale().detach()
+        zero_point = self.zero_point.detach().round().clamp(self.quant_min, self.quant_max).long()
+        return scale, zero_point
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        # the parameters are saved as in FakeQuantize (same as _LearnableFakeQuantize in torch)
+        super(FakeQuantize, self)._save_to_state_dict(destination, prefix, keep_vars)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        # the loaded qparams count as initialized - the parameters are not resized, 
+        # a size mismatch is reported in error_msgs by the load of the module below
+        for name in ('scale', 'zero_point'):
+            key = prefix + name
+            if key in state_dict:
+                param = getattr(self, name)
+                if param.numel() != state_dict[key].numel():
+                    continue
+                #
+                with torch.no_grad():
+                    self._copy_qparam(param, state_dict[key])
+                #
+                self.num_init_steps = max(self.num_init_steps, self.init_steps)
+            #
+        #
+        super(FakeQuantize, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+        self._observer_on = bool(self.observer_enabled[0] == 1)
+        self._fake_quant_on = bool(self.fake_quant_enabled[0] == 1)
+
+
+class LearnableWeightFakeQuantize(LearnableFakeQuantize):
+    '''
+    Create a subclass, just to distinguish between the ones used for activation and weight
+    '''
+    def forward(self, X):
+        # to preserve sparsity in the weights
+        sparsity_mask = (X != 0).detach()
+        X = X * sparsity_mask
+        x_q = super().forward(X)
+        return x_q
+
+
+class LearnableActivationFakeQuantize(LearnableFakeQuantize):
+    '''
+    Create a subclass, just to distinguish between the ones used for activation and weight
+    '''
+    def forward(self, X):
+        x_q = super().forward(X)
+        return x_q
+
+
+####################################################################
+# fake quantize for compile_mode: the observer update, qparams calculation and fake quantization happen in a single op
+# (torch.fused_moving_avg_obs_fake_quant) and the observer / fake quantize are enabled through tensor flags, 
+# so there is no python control flow or .item() in the forward - torch.compile can capture it without graph breaks
+# and disabling the observer (freeze) does not cause a recompile.
+class CompilableWeightFakeQuantize(FusedMovingAvgObsFakeQuantize):
+    '''
+    Create a subclass, just to distinguish between the ones used for activation and weight
+    '''
+    def forward(self, X):
+        # to preserve sparsity in the weights
+        sparsity_mask = (X != 0).detach()
+        X = X * sparsity_mask
+        x_q = super().forward(X)
+        return x_q
+
+
+class CompilableActivationFakeQuantize(FusedMovingAvgObsFakeQuantize):
+    '''
+    Create a subclass, just to distinguish between the ones used for activation and weight
+    '''
+    def forward(self, X):
+        x_q = super().forward(X)
+        return x_q
+
+
 ####################################################################
 ADAPTIVE_WEIGHT_FAKE_QUANT_TYPES = (AdaptiveWeightFakeQuantize,)
 
 ADAPTIVE_ACTIVATION_FAKE_QUANT_TYPES = (AdaptiveActivationFakeQuantize,)
 
 ADAPTIVE_FAKE_QUANT_TYPES = tuple(list(ADAPTIVE_WEIGHT_FAKE_QUANT_TYPES) + list(ADAPTIVE_ACTIVATION_FAKE_QUANT_TYPES))
+
+LEARNABLE_FAKE_QUANT_TYPES = (LearnableWeightFakeQuantize, LearnableActivationFakeQuantize)
+
+COMPILABLE_FAKE_QUANT_TYPES = (CompilableWeightFakeQuantize, CompilableActivationFakeQuantize)
@@ -0,0 +1,351 @@
+#################################################################################
+# Copyright (c) 2018-2023, Texas Instruments Incorporated - http://www.ti.com
+# All Rights Reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#################################################################################
+
+import functools
+import torch
+from torch.fx import Interpreter, GraphModule
+from torch.fx.node import map_aggregate
+from torch.ao.quantization.fx import _decomposed  # registers the quantized_decomposed ops
+
+from . import quant_utils
+
+
+_QUANTIZE_PER_TENSOR_TARGETS = (torch.ops.quantized_decomposed.quantize_per_tensor.default,
+                                torch.ops.quantized_decomposed.quantize_per_tensor.tensor)
+_DEQUANTIZE_PER_TENSOR_TARGETS = (torch.ops.quantized_decomposed.dequantize_per_tensor.default,
+                                  torch.ops.quantized_decomposed.dequantize_per_tensor.tensor)
+_QUANTIZE_PER_CHANNEL_TARGETS = (torch.ops.quantized_decomposed.quantize_per_channel.default,)
+_DEQUANTIZE_PER_CHANNEL_TARGETS = (torch.ops.quantized_decomposed.dequantize_per_channel.default,)
+
+# ops that only move / select the data - these are run on the integer values
+_DATA_MOVEMENT_TARGETS = (torch.ops.aten.view.default, torch.ops.aten.reshape.default, torch.ops.aten.flatten.using_ints,
+                          torch.ops.aten.permute.default, torch.ops.aten.transpose.int, torch.ops.aten.slice.Tensor,
+                          torch.ops.aten.max_pool2d.default, torch.ops.aten.pad.default, torch.ops.aten.dropout.default,
+                          torch.ops.aten.contiguous.default, torch.ops.aten.squeeze.dim, torch.ops.aten.unsqueeze.default)
+
+INT32_MIN = -(2 ** 31)
+INT32_MAX = (2 ** 31) - 1
+MULTIPLIER_BITS = 31
+
+
+class _QuantizedValue():
+    # integer tensor with its quantization parameters: real_value = (q - zero_point) * scale
+    def __init__(self, q, scale, zero_point, quant_min, quant_max, dtype, axis=None):
+        self.q = q
+        self.scale = torch.as_tensor(scale, dtype=torch.float64)
+        self.zero_point = torch.as_tensor(zero_point, dtype=torch.float64)
+        self.quant_min = quant_min
+        self.quant_max = quant_max
+        self.dtype = dtype
+        self.axis = axis
+
+    def _broadcast(self, param):
+        if self.axis is None or param.ndim == 0:
+            return param
+        shape = [1] * self.q.ndim
+        shape[self.axis] = -1
+        return param.reshape(shape)
+
+    def centered(self):
+        # (q - zero_point) as exact integer values in float64
+        return self.q.to(torch.float64) - self._broadcast(self.zero_point)
+
+    def dequantize(self):
+        return (self.centered() * self._broadcast(self.scale)).to(torch.float32)
+
+
+class _Accumulator():
+    # integer accumulator (int32 range) with its scale: real_value = value * scale
+    # the values are held in float64, in which the int32 arithmetic of the ops used here is exact
+    def __init__(self, value, scale):
+        self.value = torch.clamp(value, INT32_MIN, INT32_MAX)
+        self.scale = scale
+
+    def dequantize(self):
+        return (self.value * self.scale).to(torch.float32)
+
+
+def _materialize(value):
+    return map_aggregate(value, lambda v: v.dequantize() if isinstance(v, (_QuantizedValue, _Accumulator)) else v)
+
+
+def _get_fixed_point_multiplier(multiplier):
+    # multiplier = multiplier_int * 2^-shift with multiplier_int in [2^30, 2^31) - power of 2 multipliers are exact shifts
+    mantissa, exponent = torch.frexp(multiplier.to(torch.float64))
+    multiplier_int = torch.round(mantissa * (2 ** MULTIPLIER_BITS)).to(torch.int64)
+    overflow = (multiplier_int == (2 ** MULTIPLIER_BITS))
+    multiplier_int = torch.where(overflow, multiplier_int // 2, multiplier_int)
+    shift = MULTIPLIER_BITS - (exponent.to(torch.int64) + overflow.to(torch.int64))
+    return multiplier_int, shift
+
+
+def _fixed_point_multiply(value, multiplier):
+    # (value * multiplier_int + round) >> shift, rounding half up as in the device
+    # a multiplier >= 2^30 gives shift <= 0, which is a left shift without rounding
+    multiplier_int, shift = _get_fixed_point_multiplier(multiplier)
+    product = torch.round(value).to(torch.int64) * multiplier_int
+    right_shift = torch.clamp(shift, min=1)
+    rounding = torch.bitwise_left_shift(torch.ones_like(right_shift), right_shift - 1)
+    shifted = torch.bitwise_right_shift(product + rounding, right_shift)
+    return torch.where(shift > 0, shifted, torch.bitwise_left_shift(product, torch.clamp(-shift, min=0)))
+
+
+def _requantize(acc, acc_scale, scale, zero_point, quant_min, quant_max, dtype):
+    # fixed point requantization of the accumulator to the output scale
+    q = _fixed_point_multiply(acc, acc_scale / scale) + torch.round(zero_point).to(torch.int64)
+    return torch.clamp(q, quant_min, quant_max).to(dtype)
+
+
+class _IntegerInterpreter(Interpreter):
+    def __init__(self, module, executor):
+        super().__init__(module)
+        self.executor = executor
+        self.int_handlers = {
+            torch.ops.aten.conv2d.default: self._conv2d,
+            torch.ops.aten.linear.default: self._linear,
+            torch.ops.aten.matmul.default: self._matmul,
+            torch.ops.aten.bmm.default: self._matmul,
+            torch.ops.aten.relu.default: self._relu,
+            torch.ops.aten.relu_.default: self._relu,
+            torch.ops.aten.add.Tensor: self._add,
+            torch.ops.aten.mul.Tensor: self._mul,
+            torch.ops.aten.cat.default: self._cat,
+        }
+        for target in _DATA_MOVEMENT_TARGETS:
+            self.int_handlers[target] = functools.partial(self._data_movement, target)
+
+    def call_function(self, target, args, kwargs):
+        if target in _DEQUANTIZE_PER_TENSOR_TARGETS or target in _DEQUANTIZE_PER_CHANNEL_TARGETS:
+            return self._dequantize(target, args)
+        elif target in _QUANTIZE_PER_TENSOR_TARGETS or target in _QUANTIZE_PER_CHANNEL_TARGETS:
+            return self._quantize(target, args, kwargs)
+        #
+        handler = self.int_handlers.get(target, None)
+        if handler is not None:
+            result = handler(*args, **kwargs)
+            if result is not NotImplemented:
+                return result
+            #
+        #
+        # no integer implementation for this op (or for these inputs) - it is run in float on the dequantized inputs
+        self.executor.float_ops[str(target)] = self.executor.float_ops.get(str(target), 0) + 1
+        return super().call_function(target, _materialize(args), _materialize(kwargs))
+
+    def call_module(self, target, args, kwargs):
+        return super().call_module(target, _materialize(args), _materialize(kwargs))
+
+    def call_method(self, target, args, kwargs):
+        return super().call_method(target, _materialize(args), _materialize(kwargs))
+
+    def output(self, target, args, kwargs):
+        return _materialize(super().output(target, args, kwargs))
+
+    def _dequantize(self, target, args):
+        if target in _DEQUANTIZE_PER_CHANNEL_TARGETS:
+            q, scale, zero_point, axis, quant_min, quant_max, dtype = args[:7]
+        else:
+            (q, scale, zero_point, quant_min, quant_max, dtype), axis = args[:6], None
+        #
+        q = q.q if isinstance(q, _QuantizedValue) else q
+        return _QuantizedValue(q, scale, zero_point, quant_min, quant_max, dtype, axis=axis)
+
+    def _quantize(self, target, args, kwargs):
+        if target in _QUANTIZE_PER_CHANNEL_TARGETS:
+            x, scale, zero_point, axis, quant_min, quant_max, dtype = args[:7]
+        else:
+            (x, scale, zero_point, quant_min, quant_max, dtype), axis = args[:6], None
+        #
+        if isinstance(x, torch.Tensor):
+            # float input (for example the model input or a float weight) - reference quantize op
+            return super().call_function(target, args, kwargs)
+        elif isinstance(x, _QuantizedValue):
+            x = _Accumulator(x.centered(), x._broadcast(x.scale))
+        elif not isinstance(x, _Accumulator):
+            return super().call_function(target, _materialize(args), _materialize(kwargs))
+        #
+        scale = torch.as_tensor(scale, dtype=torch.float64)
+        zero_point = torch.as_tensor(zero_point, dtype=torch.float64)
+        if axis is not None:
+            shape = [1] * x.value.ndim
+            shape[axis] = -1
+            scale, zero_point = scale.reshape(shape), zero_point.reshape(shape)
+        #
+        return _requantize(x.value, x.scale, scale, zero_point, quant_min, quant_max, dtype)
+
+    @staticmethod
+    def _is_per_tensor(*values):
+        return all(isinstance(v, _QuantizedValue) and v.axis is None for v in values)
+
+    @staticmethod
+    def _add_bias(value, acc_scale, bias, channel_shape):
+        if bias is None:
+            return value
+        elif isinstance(bias, _QuantizedValue):
+            # int32 bias with scale = input_scale * weight_scale, rescaled only if the scales differ
+            bias_value = torch.round(bias.centered() * bias._broadcast(bias.scale) / acc_scale.reshape(-1))
+        else:
+            bias_value = torch.round(bias.to(torch.float64) / acc_scale.reshape(-1))
+        #
+        return value + bias_value.reshape(channel_shape)
+
+    def _conv2d(self, input, weight, bias=None, stride=1, padding=0, dilation=1, groups=1):
+        if not self._is_per_tensor(input) or not isinstance(weight, _QuantizedValue) or weight.axis not in (None, 0):
+            return NotImplemented
+        #
+        # padding with 0 in the centered domain is padding with the zero_point of the input
+        value = torch.nn.functional.conv2d(input.centered(), weight.centered(), None, stride, padding, dilation, groups)
+        acc_scale = (input.scale * weight.scale).reshape(-1)
+        acc_scale = acc_scale.reshape(1, -1, 1, 1) if acc_scale.numel() > 1 else acc_scale.reshape(())
+        value = self._add_bias(value, acc_scale, bias, (1, -1, 1, 1))
+        return _Accumulator(value, acc_scale)
+
+    def _linear(self, input, weight, bias=None):
+        if not self._is_per_tensor(input) or not isinstance(weight, _QuantizedValue) or weight.axis not in (None, 0):
+            return NotImplemented
+        #
+        value = torch.nn.functional.linear(input.centered(), weight.centered())
+        acc_scale = (input.scale * weight.scale).reshape(-1)
+        acc_scale = acc_scale if acc_scale.numel() > 1 else acc_scale.reshape(())
+        value = self._add_bias(value, acc_scale, bias, (-1,))
+        return _Accumulator(value, acc_scale)
+
+    def _matmul(self, input, other):
+        if not self._is_per_tensor(input, other):
+            return NotImplemented
+        #
+        return _Accumulator(torch.matmul(input.centered(), other.centered()), input.scale * other.scale)
+
+    def _relu(self, input):
+        if isinstance(input, _Accumulator):
+            return _Accumulator(torch.clamp(input.value, min=0), input.scale)
+        elif self._is_per_tensor(input):
+            return _QuantizedValue(torch.maximum(input.q, torch.round(input.zero_point).to(input.q.dtype)), input.scale, input.zero_point,
+                                   input.quant_min, input.quant_max, input.dtype)
+        #
+        return NotImplemented
+
+    def _add(self, input, other, alpha=1):
+        if not self._is_per_tensor(input, other) or alpha != 1:
+            return NotImplemented
+        #
+        # both inputs are aligned to the finer scale with the fixed point multiplier of the device 
+        # (exact shifts when the scales are power of 2, else rounded half up)
+        acc_scale = torch.minimum(input.scale, other.scale)
+        value = _fixed_point_multiply(input.centered(), input.scale / acc_scale) + \
+            _fixed_point_multiply(other.centered(), other.scale / acc_scale)
+        return _Accumulator(value.to(torch.float64), acc_scale)
+
+    def _mul(self, input, other):
+        if not self._is_per_tensor(input, other):
+            return NotImplemented
+        #
+        return _Accumulator(input.centered() * other.centered(), input.scale * other.scale)
+
+    def _cat(self, tensors, dim=0):
+        first = tensors[0] if len(tensors) > 0 else None
+        if not self._is_per_tensor(*tensors) or any(not (torch.equal(t.scale, first.scale) and torch.equal(t.zero_point, first.zero_point))
+                                                    for t in tensors):
+            return NotImplemented
+        #
+        return _QuantizedValue(torch.cat([t.q for t in tensors], dim), first.scale, first.zero_point, first.quant_min, first.quant_max, first.dtype)
+
+    def _data_movement(self, target, input, *args, **kwargs):
+        if not self._is_per_tensor(input):
+            return NotImplemented
+        #
+        if target == torch.ops.aten.pad.default:
+            args, kwargs = self._quantize_pad_value(input, args, kwargs)
+        #
+        value = target(input.centered(), *args, **kwargs)
+        q = torch.round(value + input.zero_point).to(input.q.dtype)
+        return _QuantizedValue(q, input.scale, input.zero_point, input.quant_min, input.quant_max, input.dtype)
+
+    @staticmethod
+    def _quantize_pad_value(input, args, kwargs):
+        # aten.pad(input, pad, mode='constant', value=None) - the constant pad value is a real value, 
+        # it is quantized to the input qparams as the following quantize op does in the fake quantized model
+        args, kwargs = list(args), dict(kwargs)
+        value = args[2] if len(args) >= 3 else kwargs.get('value', None)
+        if value:
+            zero_point = torch.round(input.zero_point)
+            q_value = torch.clamp(torch.round(torch.as_tensor(value, dtype=torch.float64) / input.scale) + zero_point,
+                                  input.quant_min, input.quant_max)
+            if len(args) >= 3:
+                args[2] = float(q_value - zero_point)
+            else:
+                kwargs['value'] = float(q_value - zero_point)
+            #
+        #
+        return tuple(args), kwargs
+
+
+class IntegerReferenceExecutor():
+    '''
+    Integer reference executor for the converted (QDQ) PT2E model. The dequantize - op - quantize patterns are run with
+    integer arithmetic as in the device: conv/linear/matmul accumulate (q - zero_point) products in int32 with the int32 bias, 
+    and the accumulator is requantized with a fixed point multiplier and a rounding shift (just a shift for power of 2 scales).
+    The ops without an integer implementation are run in float on the dequantized values - see float_ops.
+    It runs on batches, so it can be used to evaluate the accuracy on a validation set without exporting to onnx.
+    '''
+    def __init__(self, model):
+        if not isinstance(model, GraphModule) and isinstance(getattr(model, 'module', None), GraphModule):
+            model = model.module
+        #
+        assert isinstance(model, GraphModule), "IntegerReferenceExecutor expects the converted model (GraphModule)"
+        self.model = model
+        self.float_ops = {}
+        self.interpreter = _IntegerInterpreter(model, self)
+
+    def __call__(self, *args, **kwargs):
+        # the exported graph has the inputs as placeholders in order - the kwargs follow the args
+        with torch.no_grad():
+            return self.interpreter.run(*args, *kwargs.values())
+
+    def run_loader(self, loader, input_fn=None, output_fn=None, max_batches=None):
+        '''
+        Runs the batches from loader and returns the list of output_fn(outputs, batch) (the outputs if output_fn is None).
+        input_fn: optional function to map a batch to (args, kwargs) for the model
+        '''
+        input_fn = input_fn or quant_utils.get_calibration_inputs
+        results = []
+        for batch_index, batch in enumerate(loader):
+            if max_batches is not None and batch_index >= max_batches:
+                break
+            #
+            args, kwargs = input_fn(batch)
+            outputs = self(*args, **kwargs)
+            results.append(output_fn(outputs, batch) if output_fn is not None else outputs)
+        #
+        return results
+
+    def get_float_ops(self):
+        # ops that were run in float (count of calls by op), these are not bit exact with the device
+        return dict(self.float_ops)
@@ -0,0 +1,225 @@
+#################################################################################
+# Copyright (c) 2018-2023, Texas Instruments Incorporated - http://www.ti.com
+# All Rights Reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#################################################################################
+
+import copy
+import itertools
+import torch
+from torch.fx import Interpreter, Node
+
+from . import quant_func
+from . import quant_utils
+
+
+# nodes that can be promoted to 16 bits
+MIXED_PRECISION_NODE_TARGETS = (torch.ops.aten.conv2d.default, torch.ops.aten.linear.default,
+                                torch.ops.aten.matmul.default, torch.ops.aten.bmm.default)
+
+
+def _is_quant_module(module):
+    return isinstance(module, (torch.ao.quantization.FakeQuantizeBase, torch.ao.quantization.ObserverBase))
+
+
+def _is_16bit_candidate(node):
+    # only the nodes that the quantizer annotates with the node config (see TIDLRTQuantizer._get_node_config) can be 
+    # promoted to 16 bits - eg. the linear nodes from torch.nn.functional.linear are not annotated by the quantizer
+    if node.op != 'call_function' or node.target not in MIXED_PRECISION_NODE_TARGETS:
+        return False
+    #
+    annotation = node.meta.get('quantization_annotation', None)
+    return annotation is not None and (annotation.output_qspec is not None or len(annotation.input_qspec_map) > 0)
+
+
+def _get_num_macs(node, args, output):
+    if node.target == torch.ops.aten.conv2d.default:
+        weight = args[1]
+        return output.numel() * (weight.numel() // weight.shape[0])
+    elif node.target == torch.ops.aten.linear.default:
+        return output.numel() * args[1].shape[-1]
+    else:
+        return output.numel() * args[0].shape[-1]
+
+
+class _SensitivityInterpreter(Interpreter):
+    '''
+    Runs the PTQ prepared graph and for every candidate node compares the (fake) quantized output with the output
+    computed from the un-quantized inputs and weights of the same node - i.e. the error introduced at this node.
+    The errors are accumulated on the device (see _get_float_stats) and the intermediate values are released as in 
+    Interpreter, except that the float inputs of the candidate nodes are kept until the candidate node is run.
+    '''
+    def __init__(self, module, stats):
+        super().__init__(module)
+        self.modules = dict(module.named_modules())
+        self.stats = stats
+        # candidate node -> the node whose output is the quantized output of the candidate
+        self.quant_output_nodes = {}
+        float_inputs = {}
+        for node in module.graph.nodes:
+            if not _is_16bit_candidate(node):
+                continue
+            #
+            quant_users = [user for user in node.users if user.op == 'call_module' and _is_quant_module(self.modules.get(user.target, None))]
+            self.quant_output_nodes[node] = quant_users[0] if len(quant_users) == 1 else node
+            float_inputs[node] = [self._get_float_node(arg) for arg in node.all_input_nodes]
+        #
+        self.user_to_last_uses = self._get_last_uses(float_inputs)
+        # quantized output node -> (candidate node, float output, macs), while the quantized output is not yet computed
+        self.pending = {}
+
+    def _get_last_uses(self, extra_uses):
+        # same as the last uses in Interpreter, with the float inputs of the candidate nodes as extra inputs
+        node_to_last_use = {}
+        for node in reversed(self.module.graph.nodes):
+            for input_node in itertools.chain(node.all_input_nodes, extra_uses.get(node, [])):
+                node_to_last_use.setdefault(input_node, node)
+            #
+        #
+        user_to_last_uses = {}
+        for input_node, user in node_to_last_use.items():
+            user_to_last_uses.setdefault(user, []).append(input_node)
+        #
+        return user_to_last_uses
+
+    def _get_float_node(self, arg):
+        # bypass the fake quantize/observer modules to get the node of the float value
+        while isinstance(arg, Node) and arg.op == 'call_module' and _is_quant_module(self.modules.get(arg.target, None)):
+            arg = arg.args[0]
+        #
+        return arg
+
+    def _float_value(self, arg):
+        arg = self._get_float_node(arg)
+        return self.env[arg] if isinstance(arg, Node) else arg
+
+    def _accumulate(self, node, quant_output, float_output, macs):
+        node_stats = self.stats.setdefault(node.name, dict(error=0.0, signal=0.0, macs=0))
+        node_stats['error'] = node_stats['error'] + torch.sum((quant_output.float() - float_output.float()) ** 2)
+        node_stats['signal'] = node_stats['signal'] + torch.sum(float_output.float() ** 2)
+        node_stats['macs'] = macs
+
+    def run_node(self, node):
+        output = super().run_node(node)
+        quant_output_node = self.quant_output_nodes.get(node, None)
+        if quant_output_node is not None:
+            float_args = torch.fx.node.map_aggregate(node.args, self._float_value)
+            float_kwargs = torch.fx.node.map_aggregate(node.kwargs, self._float_value)
+            float_output = node.target(*float_args, **float_kwargs)
+            macs = _get_num_macs(node, float_args, float_output)
+            if quant_output_node is node:
+                self._accumulate(node, output, float_output, macs)
+            else:
+                self.pending[quant_output_node] = (node, float_output, macs)
+            #
+        #
+        if node in self.pending:
+            candidate_node, float_output, macs = self.pending.pop(node)
+            self._accumulate(candidate_node, output, float_output, macs)
+        #
+        return output
+
+
+def _get_float_stats(stats):
+    # the errors are accumulated as tensors on the device, they are transferred to the host once at the end
+    if len(stats) == 0:
+        return stats
+    #
+    values = torch.stack([torch.stack((torch.as_tensor(node_stats['error'], dtype=torch.float32), 
+                                       torch.as_tensor(node_stats['signal'], dtype=torch.float32)))
+                          for node_stats in stats.values()]).tolist()
+    for node_stats, (error, signal) in zip(stats.values(), values):
+        node_stats['error'] = error
+        node_stats['signal'] = signal
+    #
+    return stats
+
+
+def get_node_sensitivity(model, calibration_batches, qconfig_type=None, input_fn=None, **kwargs):
+    '''
+    measures the per node quantization error (relative error energy) of the conv/linear/matmul nodes
+    of an 8 bit PTQ prepared copy of model, on a (small) list or loader of calibration_batches.
+    returns a dict: node_name -> dict(error, signal, macs, sensitivity)
+    '''
+    calibration_batches = list(calibration_batches)
+    device = next(iter(model.parameters())).device
+    input_fn = input_fn or (lambda batch: quant_utils.get_calibration_inputs(batch, device=device))
+    example_args, example_kwargs = input_fn(calibration_batches[0])
+    prepared_model = quant_func.init(copy.deepcopy(model), is_qat=False, is_fake_quantize=True, total_epochs=2, qconfig_type=qconfig_type,
+                                     example_inputs=list(example_args), example_kwargs=dict(example_kwargs), **kwargs)
+    # 8 bit calibration, then measure the errors with the observers frozen
+    quant_func.calibrate_from_loader(prepared_model, calibration_batches, input_fn=input_fn, tolerance=0.0)
+    quant_func.freeze(prepared_model, freeze_bn=True, freeze_observers=True)
+    stats = {}
+    interpreter = _SensitivityInterpreter(prepared_model, stats)
+    with torch.no_grad():
+        for batch in calibration_batches:
+            args, batch_kwargs = input_fn(batch)
+            interpreter.run(*args, *batch_kwargs.values())
+        #
+    #
+    stats = _get_float_stats(stats)
+    for node_stats in stats.values():
+        node_stats['sensitivity'] = node_stats['error'] / max(node_stats['signal'], 1e-12)
+    #
+    return stats
+
+
+def get_16bit_node_list(model, calibration_batches, max_mac_fraction=None, max_latency_increase=None, cost_16bit_factor=4.0,
+                        node_sensitivity=None, **kwargs):
+    '''
+    selects the conv/linear/matmul nodes to be promoted to 16 bits within a budget, the nodes with the highest
+    quantization error per MAC are promoted first. the returned list can be given to quant_func.init (allow_16bit_node_list)
+    max_mac_fraction: maximum fraction of the total MACs that can be in 16 bits
+    max_latency_increase: maximum estimated latency increase (fraction), assuming that a 16 bit MAC costs cost_16bit_factor 8 bit MACs
+    '''
+    if max_mac_fraction is None and max_latency_increase is None:
+        raise RuntimeError("either max_mac_fraction or max_latency_increase must be provided")
+    #
+    node_sensitivity = node_sensitivity or get_node_sensitivity(model, calibration_batches, **kwargs)
+    total_macs = max(sum(node_stats['macs'] for node_stats in node_sensitivity.values()), 1)
+    candidates = sorted(node_sensitivity.items(), key=lambda kv: kv[1]['sensitivity'] / max(kv[1]['macs'], 1), reverse=True)
+    node_list = []
+    macs_16bit = 0
+    for node_name, node_stats in candidates:
+        if node_stats['sensitivity'] <= 0.0:
+            break
+        #
+        new_macs_16bit = macs_16bit + node_stats['macs']
+        if max_mac_fraction is not None and new_macs_16bit / total_macs > max_mac_fraction:
+            continue
+        #
+        if max_latency_increase is not None and new_macs_16bit * (cost_16bit_factor - 1) / total_macs > max_latency_increase:
+            continue
+        #
+        node_list.append(node_name)
+        macs_16bit = new_macs_16bit
+    #
+    print(f"Mixed precision: {len(node_list)} of {len(node_sensitivity)} nodes in 16 bits, "
+          f"{100.0 * macs_16bit / total_macs:.2f}% of the MACs, estimated latency increase {100.0 * macs_16bit * (cost_16bit_factor - 1) / total_macs:.2f}%")
+    return node_list
@@ -52,6 +52,28 @@ from . import observer_utils
 # observer_utils.MovingAverageRangeShrinkHistogramObserverBase
 
 
+####################################################################
+# the range adjustments are done with tensor ops (without .item()) to avoid a device to host sync in every forward
+def _adjust_range_max(observer):
+    signed_range = torch.min(observer.min_val.detach()) < 0.0
+    min_val = torch.where(signed_range, -observer.range_max, 0.0).to(observer.min_val.dtype)
+    max_val = torch.full_like(min_val, observer.range_max)
+    if observer.fixed_range:
+        observer.min_val.copy_(min_val.expand_as(observer.min_val))
+        observer.max_val.copy_(max_val.expand_as(observer.max_val))
+    else:
+        observer.min_val = torch.clamp(torch.maximum(observer.min_val, min_val), max=0.0)
+        observer.max_val = torch.clamp(torch.minimum(observer.max_val, max_val), min=0.0)
+    #
+
+
+def _symmetric_min_max(min_val, max_val):
+    signed_range = torch.min(min_val.detach()) < 0.0
+    max_abs = torch.max(torch.abs(min_val), torch.abs(max_val))
+    min_val = torch.where(signed_range, -max_abs, max_abs * 0.0)
+    return min_val, max_abs
+
+
 ####################################################################
 class AdaptiveWeightObserver(torch.ao.quantization.MinMaxObserver):
     def __init__(self, *args, quant_min=-128, quant_max=+127, dtype=torch.qint8, qscheme=torch.per_tensor_symmetric, power2_scale=False, range_max=None, fixed_range=False, **kwargs):
@@ -77,16 +99,7 @@ class AdaptiveWeightObserver(torch.ao.quantization.MinMaxObserver):
             return x_orig
         x_orig = super().forward(x_orig)
         if self.range_max is not None:
-            signed_range = torch.min(self.min_val.detach()).item() < 0.0
-            min_val = (-self.range_max) if signed_range else 0.0
-            max_val = (+self.range_max) if signed_range else (+self.range_max)
-            if self.fixed_range:
-                self.min_val.fill_(min_val)
-                self.max_val.fill_(max_val)
-            else:
-                self.min_val = torch.clamp(self.min_val, min=min_val, max=0.0)
-                self.max_val = torch.clamp(self.max_val, min=0.0, max=max_val)
-            #
+            _adjust_range_max(self)
         #
         return x_orig
 
@@ -115,16 +128,7 @@ class AdaptivePerChannelWeightObserver(torch.ao.quantization.PerChannelMinMaxObs
             return x_orig
         x_orig = super().forward(x_orig)
         if self.range_max is not None:
-            signed_range = torch.min(self.min_val.detach()).item() < 0.0
-            min_val = (-self.range_max) if signed_range else 0.0
-            max_val = (+self.range_max) if signed_range else (+self.range_max)
-            if self.fixed_range:
-                self.min_val.fill_(min_val)
-                self.max_val.fill_(max_val)
-            else:
-                self.min_val = torch.clamp(self.min_val, min=min_val, max=0.0)
-                self.max_val = torch.clamp(self.max_val, min=0.0, max=max_val)
-            #
+            _adjust_range_max(self)
         #
         return x_orig
 
@@ -143,10 +147,7 @@ class AdaptiveActivationObserver(observer_utils.CumulativeMSEHistogramObserver):
     def _calculate_qparams(self, min_val, max_val):
         r"""Calculates the quantization parameters."""
         if self.symmetric:
-            signed_range = torch.min(min_val.detach()).item() < 0.0
-            max_abs = torch.max(torch.abs(min_val), torch.abs(max_val))
-            min_val = -max_abs if signed_range else max_abs * 0.0
-            max_val = max_abs
+            min_val, max_val = _symmetric_min_max(min_val, max_val)
 
         scale, zero_point = super()._calculate_qparams(min_val, max_val)
 
@@ -162,16 +163,7 @@ class AdaptiveActivationObserver(observer_utils.CumulativeMSEHistogramObserver):
             return x_orig
         x_orig = super().forward(x_orig)
         if self.range_max is not None:
-            signed_range = torch.min(self.min_val.detach()).item() < 0.0
-            min_val = (-self.range_max) if signed_range else 0.0
-            max_val = (+self.range_max) if signed_range else (+self.range_max)
-            if self.fixed_range:
-                self.min_val.fill_(min_val)
-                self.max_val.fill_(max_val)
-            else:
-                self.min_val = torch.clamp(self.min_val, min=min_val, max=0.0)
-                self.max_val = torch.clamp(self.max_val, min=0.0, max=max_val)
-            #
+            _adjust_range_max(self)
         #
         return x_orig
 
@@ -195,10 +187,7 @@ class AdaptiveMinMaxActivationObserver(torch.ao.quantization.MinMaxObserver):
     def _calculate_qparams(self, min_val, max_val):
         r"""Calculates the quantization parameters."""
         if self.symmetric:
-            signed_range = torch.min(min_val.detach()).item() < 0.0
-            max_abs = torch.max(torch.abs(min_val), torch.abs(max_val))
-            min_val = -max_abs if signed_range else max_abs * 0.0
-            max_val = max_abs
+            min_val, max_val = _symmetric_min_max(min_val, max_val)
 
         scale, zero_point = super()._calculate_qparams(min_val, max_val)
 
@@ -214,16 +203,7 @@ class AdaptiveMinMaxActivationObserver(torch.ao.quantization.MinMaxObserver):
             return x_orig
         x_orig = super().forward(x_orig)
         if self.range_max is not None:
-            signed_range = torch.min(self.min_val.detach()).item() < 0.0
-            min_val = (-self.range_max) if signed_range else 0.0
-            max_val = (+self.range_max) if signed_range else (+self.range_max)
-            if self.fixed_range:
-                self.min_val.fill_(min_val)
-                self.max_val.fill_(max_val)
-            else:
-                self.min_val = torch.clamp(self.min_val, min=min_val, max=0.0)
-                self.max_val = torch.clamp(self.max_val, min=0.0, max=max_val)
-            #
+            _adjust_range_max(self)
         #
         return x_orig
 
@@ -242,10 +222,7 @@ class AdaptiveMovingAverageMinMaxActivationObserver(torch.ao.quantization.Moving
     def _calculate_qparams(self, min_val, max_val):
         r"""Calculates the quantization parameters."""
         if self.symmetric:
-            signed_range = torch.min(min_val.detach()).item() < 0.0
-            max_abs = torch.max(torch.abs(min_val), torch.abs(max_val))
-            min_val = -max_abs if signed_range else max_abs * 0.0
-            max_val = max_abs
+            min_val, max_val = _symmetric_min_max(min_val, max_val)
 
         scale, zero_point = super()._calculate_qparams(min_val, max_val)
 
@@ -261,19 +238,43 @@ class AdaptiveMovingAverageMinMaxActivationObserver(torch.ao.quantization.Moving
             return x_orig
         x_orig = super().forward(x_orig)
         if self.range_max is not None:
-            signed_range = torch.min(self.min_val.detach()).item() < 0.0
-            min_val = (-self.range_max) if signed_range else 0.0
-            max_val = (+self.range_max) if signed_range else (+self.range_max)
-            if self.fixed_range:
-                self.min_val.fill_(min_val)
-                self.max_val.fill_(max_val)
-            else:
-                self.min_val = torch.clamp(self.min_val, min=min_val, max=0.0)
-                self.max_val = torch.clamp(self.max_val, min=0.0, max=max_val)
-            #
+            _adjust_range_max(self)
         #
         return x_orig
 
+
+####################################################################
+# observers for compile_mode - the min/max and the qparams are updated inside torch.fused_moving_avg_obs_fake_quant
+# (see fake_quantize_types.COMPILABLE_FAKE_QUANT_TYPES), so these only hold the state and calculate the qparams for convert
+def _check_compilable_observer_args(power2_scale, range_max, fixed_range, range_shrink_percentile=0, batched_search=False, sample_budget=None):
+    # the fused op has only the moving average min/max - the options that need the adaptive observers are refused
+    if power2_scale or range_max is not None or fixed_range:
+        raise ValueError("power2_scale, range_max and fixed_range are not supported in compile_mode")
+    #
+    if range_shrink_percentile or batched_search or sample_budget is not None:
+        raise ValueError("range_shrink_percentile, batched_search and sample_budget are not supported in compile_mode")
+    #
+
+
+class CompilableMovingAverageObserver(torch.ao.quantization.MovingAverageMinMaxObserver):
+    def __init__(self, *args, quant_min=0, quant_max=255, dtype=torch.quint8, qscheme=torch.per_tensor_affine, power2_scale=False, range_max=None, fixed_range=False, 
+                 range_shrink_percentile=0, batched_search=False, sample_budget=None, **kwargs):
+        _check_compilable_observer_args(power2_scale, range_max, fixed_range, range_shrink_percentile, batched_search, sample_budget)
+        super().__init__(*args, quant_min=quant_min, quant_max=quant_max, dtype=dtype, qscheme=qscheme, **kwargs)
+        self.power2_scale = power2_scale
+        self.range_max = range_max
+        self.fixed_range = fixed_range
+
+
+class CompilableMovingAveragePerChannelObserver(torch.ao.quantization.MovingAveragePerChannelMinMaxObserver):
+    def __init__(self, *args, quant_min=-128, quant_max=+127, dtype=torch.qint8, qscheme=torch.per_channel_symmetric, power2_scale=False, range_max=None, fixed_range=False, **kwargs):
+        _check_compilable_observer_args(power2_scale, range_max, fixed_range)
+        super().__init__(*args, quant_min=quant_min, quant_max=quant_max, dtype=dtype, qscheme=qscheme, **kwargs)
+        self.power2_scale = power2_scale
+        self.range_max = range_max
+        self.fixed_range = fixed_range
+
+
 ####################################################################
 ADAPTIVE_WEIGHT_OBSERVER_TYPES = (AdaptiveWeightObserver,
                                   AdaptivePerChannelWeightObserver)
@@ -66,24 +66,83 @@ def ceil2_num(x):
 
 def _adjust_qparams_power2_scale(min_val, max_val, quant_min, quant_max, scale, zero_point, eps):
     r"""Calculates the quantization parameters."""
-    # make scale a power of 2 value
-    scale = _ceil2_tensor(scale)
+    # make scale a power of 2 value - same as _ceil2_tensor, zero values remain zero (so the all zero check is not needed)
+    scale = torch.sign(scale) * xnn.layers.functional.ceil2_func(torch.abs(scale))
     scale = torch.max(scale, eps)
-    if len(torch.unique(zero_point))>1 or torch.unique(zero_point) not in (0,127):
-        # adjust the zero_point based on new scale
-        min_val_neg = torch.min(min_val, torch.zeros_like(min_val))
-        zero_point = quant_min - torch.round(min_val_neg / scale).to(torch.int)
-        zero_point = torch.clamp(zero_point, quant_min, quant_max)
+    # the zero_point is kept only if all the channels have the same zero_point and it is 0 or 127,
+    # this is found with tensor ops instead of torch.unique so that there is no sort or device sync per channel
+    zero_point_flat = zero_point.reshape(-1)
+    keep_zero_point = torch.all(zero_point_flat == zero_point_flat[:1]) & ((zero_point_flat[:1] == 0) | (zero_point_flat[:1] == 127)).all()
+    # adjust the zero_point based on new scale
+    min_val_neg = torch.min(min_val, torch.zeros_like(min_val))
+    adjusted_zero_point = quant_min - torch.round(min_val_neg / scale).to(torch.int)
+    adjusted_zero_point = torch.clamp(adjusted_zero_point, quant_min, quant_max)
+    # the zero_point keeps its dtype (eg. int64 from calculate_qparams)
+    zero_point = torch.where(keep_zero_point, zero_point, adjusted_zero_point.to(zero_point.dtype))
     return scale, zero_point
 
 
+####################################################################
+def _batched_mse_param_search(histogram, min_val, max_val, dst_nbins, chunk_size=4096):
+    r"""Finds the clipping range with the lowest quantization error (same error measure as
+    HistogramObserver._compute_quantization_error), but evaluates all (start_bin, end_bin)
+    candidates in batched tensor operations instead of the sequential search in python.
+    This is deliberately an exhaustive search (bins*(bins+1)/2 ranges, eg. 32896 for 256 bins): the greedy search of 
+    HistogramObserver shrinks the range from one side at a time and stops at the first increase of the error, 
+    which is a local minimum. Both give the same range for unimodal histograms, otherwise this finds a range
+    with a lower (or equal) error. It is used only with batched_search=True."""
+    bins = histogram.numel()
+    # a zero width histogram is handled with torch.where at the end instead of a check on the host (device sync)
+    is_empty_range = (max_val - min_val) == 0
+    bin_width = torch.where(is_empty_range, torch.ones_like(min_val), (max_val - min_val) / bins)
+    device = histogram.device
+    start_bins, end_bins = torch.triu_indices(bins, bins, device=device)
+    # widest ranges first, so that argmin prefers the wider range in case of a tie
+    order = torch.argsort(start_bins - end_bins, stable=True)
+    start_bins, end_bins = start_bins[order], end_bins[order]
+    src_bin = torch.arange(bins, device=device, dtype=histogram.dtype)
+    density = histogram / bin_width
+
+    def _get_norm(delta_begin, delta_end):
+        return (delta_end * delta_end * delta_end - delta_begin * delta_begin * delta_begin) / 3
+
+    norms = []
+    for chunk_start in range(0, start_bins.numel(), chunk_size):
+        start_bin = start_bins[chunk_start:chunk_start+chunk_size].to(histogram.dtype).unsqueeze(1)
+        end_bin = end_bins[chunk_start:chunk_start+chunk_size].to(histogram.dtype).unsqueeze(1)
+        dst_bin_width = bin_width * (end_bin - start_bin + 1) / dst_nbins
+        src_bin_begin = (src_bin - start_bin) * bin_width
+        src_bin_end = src_bin_begin + bin_width
+        dst_bin_of_begin = torch.clamp(torch.div(src_bin_begin, dst_bin_width, rounding_mode='floor'), 0, dst_nbins - 1)
+        dst_bin_of_end = torch.clamp(torch.div(src_bin_end, dst_bin_width, rounding_mode='floor'), 0, dst_nbins - 1)
+        dst_bin_of_begin_center = (dst_bin_of_begin + 0.5) * dst_bin_width
+        dst_bin_of_end_center = (dst_bin_of_end + 0.5) * dst_bin_width
+        norm = _get_norm(src_bin_begin - dst_bin_of_begin_center, dst_bin_width / 2)
+        norm = norm + (dst_bin_of_end - dst_bin_of_begin - 1) * _get_norm(-dst_bin_width / 2, dst_bin_width / 2)
+        norm = norm + _get_norm(-dst_bin_width / 2, src_bin_end - dst_bin_of_end_center)
+        norms.append((norm * density).sum(dim=1))
+    #
+    best_index = torch.argmin(torch.cat(norms))
+    new_min = torch.where(is_empty_range, min_val, min_val + bin_width * start_bins[best_index])
+    new_max = torch.where(is_empty_range, max_val, min_val + bin_width * (end_bins[best_index] + 1))
+    return new_min, new_max
+
+
 ####################################################################
 # histogram observer from torch.ao.quantization
 # (MSE based and includes merging of histograms across iterations)
 class CumulativeMSEHistogramObserver(torch.ao.quantization.HistogramObserver):
-    def __init__(self, *args, range_shrink_percentile=None, fast_mode=False, **kwargs):
+    def __init__(self, *args, range_shrink_percentile=None, fast_mode=False, batched_search=False, sample_budget=None, **kwargs):
         super().__init__(*args, bins=256, upsample_rate=16, **kwargs)
         self.fast_mode = fast_mode
+        self.batched_search = batched_search
+        # maximum number of elements added to the histogram in each call (None: all the elements)
+        self.sample_budget = sample_budget
+
+    def _non_linear_param_search(self):
+        if self.batched_search:
+            return _batched_mse_param_search(self.histogram, self.min_val, self.max_val, self.dst_nbins)
+        return super()._non_linear_param_search()
 
     def forward(self, x_orig: torch.Tensor) -> torch.Tensor:
         fast_stride = 2
@@ -91,7 +150,18 @@ class CumulativeMSEHistogramObserver(torch.ao.quantization.HistogramObserver):
         is_large_tensor4 = len(x_orig.size()) == 4 and (x_orig.size(-2) > fast_stride2) and (x_orig.size(-1) > fast_stride2)
         is_large_tensor3 = len(x_orig.size()) == 3 and (x_orig.size(-1) > fast_stride2)
         src = x_orig
-        if self.fast_mode and (is_large_tensor3 or is_large_tensor4):
+        if self.sample_budget is not None:
+            src, sample_weight = self._sample(x_orig)
+            if sample_weight != 1.0:
+                # the histogram stays in units of elements (as without sampling, so that it can be merged / saved / synced)
+                # only the sampled counts are scaled: the histogram update (re-binning and add) is linear in the counts,
+                # so (histogram / weight + new_counts) * weight == histogram + new_counts * weight
+                self.histogram.div_(sample_weight)
+                super().forward(src)
+                self.histogram.mul_(sample_weight)
+                return x_orig
+            #
+        elif self.fast_mode and (is_large_tensor3 or is_large_tensor4):
             r_start = random.randint(0, fast_stride - 1)
             c_start = random.randint(0, fast_stride - 1)
             if is_large_tensor4:
@@ -102,6 +172,15 @@ class CumulativeMSEHistogramObserver(torch.ao.quantization.HistogramObserver):
         super().forward(src)
         return x_orig
 
+    def _sample(self, x_orig):
+        # strided sampling with a random offset over the flattened tensor (any rank) - every element has the same 
+        # probability of being sampled, so the cost of the histogram is bounded by sample_budget for any input size.
+        # returns the samples and the number of elements represented by each sample
+        x_flat = x_orig.detach().reshape(-1)
+        stride = max(math.ceil(x_flat.numel() / self.sample_budget), 1)
+        src = x_flat[random.randint(0, stride - 1)::stride] if stride > 1 else x_flat
+        return src, x_flat.numel() / max(src.numel(), 1)
+
 
 class MSEHistogramObserver(CumulativeMSEHistogramObserver):
     def __init__(self, *args, range_shrink_percentile=None, **kwargs):
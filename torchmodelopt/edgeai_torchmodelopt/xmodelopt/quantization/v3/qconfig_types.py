@@ -86,6 +86,9 @@ class QConfigType():
     WC4_AT8 = "WC4_AT8"                         # 4-bits per-channel quantization for weights, 8-bit per-tensor quantization for activations
     WC4M4_AT8 = "WC4M4_AT8"                     # same as above with a maximum weight range
 
+    LSQ_WC8_AT8 = "LSQ_WC8_AT8"                 # WC8_AT8 with learnable scale (LSQ) fake quantization for weights and activations
+    LSQ_WC4_AT8 = "LSQ_WC4_AT8"                 # WC4_AT8 with learnable scale (LSQ) fake quantization for weights and activations
+
     WC16_AT16 = "WC16_AT16"
     WC32_AT32 = "WC32_AT32"
 
@@ -114,7 +117,7 @@ def get_repr_string_from_dict(input_dict):
 
 ####################################################################
 
-def get_weight_quantization_config(weight_qconfig, is_fake_quantize=True):
+def get_weight_quantization_config(weight_qconfig, is_fake_quantize=True, compile_mode=False):
     observer_name = 'CustomAdaptiveWeightObserver' + '__' + get_repr_string_from_dict(weight_qconfig)
     weight_bitwidth = weight_qconfig.get('bitwidth', 8) # needed for 4-bit quantization simulation
     weight_qscheme = weight_qconfig.get('qscheme', torch.per_channel_symmetric)
@@ -122,6 +125,12 @@ def get_weight_quantization_config(weight_qconfig, is_fake_quantize=True):
 
     WeightObserverBaseToUse = observer_types.AdaptivePerChannelWeightObserver \
         if weight_qscheme == torch.per_channel_symmetric else observer_types.AdaptiveWeightObserver
+    # compile_mode: the weight range is found in every step (averaging_constant=1) inside the fused op
+    compile_kwargs = dict()
+    if compile_mode and is_fake_quantize:
+        WeightObserverBaseToUse = observer_types.CompilableMovingAveragePerChannelObserver \
+            if weight_qscheme == torch.per_channel_symmetric else observer_types.CompilableMovingAverageObserver
+        compile_kwargs = dict(averaging_constant=1.0)
     
     weight_observer = xnn.utils.partialclass(WeightObserverBaseToUse,
                                              quant_min=weight_qconfig.get('quant_min', -(2 ** (weight_bitwidth-1))),
@@ -131,14 +140,21 @@ def get_weight_quantization_config(weight_qconfig, is_fake_quantize=True):
                                              power2_scale=weight_qconfig.get('power2_scale', False),
                                              range_max=weight_qconfig.get('range_max', None),
                                              fixed_range=weight_qconfig.get('fixed_range', False),
-                                             class_name=weight_qconfig.get('observer_name', observer_name)
+                                             class_name=weight_qconfig.get('observer_name', observer_name),
+                                             **compile_kwargs
                                              )
     
-    fake_quantized_weight_observer = fake_quantize_types.AdaptiveWeightFakeQuantize.with_args(
+    # learnable_scale: LSQ fake quantize, the observer is used only to initialize the scale
+    learnable_kwargs = dict(init_steps=weight_qconfig.get('init_steps', 1)) if (weight_qconfig.get('learnable_scale', False) and not compile_mode) else dict()
+    WeightFakeQuantizeToUse = fake_quantize_types.LearnableWeightFakeQuantize \
+        if weight_qconfig.get('learnable_scale', False) else fake_quantize_types.AdaptiveWeightFakeQuantize
+    WeightFakeQuantizeToUse = fake_quantize_types.CompilableWeightFakeQuantize if compile_mode else WeightFakeQuantizeToUse
+    
+    fake_quantized_weight_observer = WeightFakeQuantizeToUse.with_args(
         observer=weight_observer, 
         quant_min=weight_qconfig.get('quant_min', -(2 ** (weight_bitwidth-1))),
         quant_max=weight_qconfig.get('quant_max', (2 ** (weight_bitwidth-1)) - 1),
-        dtype=weight_dtype) if is_fake_quantize else weight_observer
+        dtype=weight_dtype, **learnable_kwargs) if is_fake_quantize else weight_observer
         
     weight_quantization_spec = QuantizationSpec(
         dtype=weight_dtype,
@@ -152,12 +168,14 @@ def get_weight_quantization_config(weight_qconfig, is_fake_quantize=True):
     return weight_quantization_spec
 	
 
-def get_act_quantization_config(activation_qconfig, is_fake_quantize=True, fast_mode=False):
+def get_act_quantization_config(activation_qconfig, is_fake_quantize=True, fast_mode=False, compile_mode=False):
     observer_name = 'CustomAdaptiveActivationObserver' + get_repr_string_from_dict(activation_qconfig)
     activation_bitwidth = activation_qconfig.get('bitwidth', 8)
     activation_dtype = activation_qconfig.get('dtype', torch.uint8)
 
     AdaptiveActivationObserverToUse = observer_types.AdaptiveActivationObserverFast if fast_mode else observer_types.AdaptiveActivationObserver
+    # compile_mode: moving average min/max inside the fused op, instead of the histogram based observer
+    AdaptiveActivationObserverToUse = observer_types.CompilableMovingAverageObserver if (compile_mode and is_fake_quantize) else AdaptiveActivationObserverToUse
     # AdaptiveActivationObserverToUse = observer_types.AdaptiveMovingAverageMinMaxActivationObserver
     
     activation_observer = xnn.utils.partialclass(AdaptiveActivationObserverToUse,
@@ -169,13 +187,22 @@ def get_act_quantization_config(activation_qconfig, is_fake_quantize=True, fast_
                                              range_max=activation_qconfig.get('range_max', None),
                                              fixed_range=activation_qconfig.get('fixed_range', False),
                                              class_name=activation_qconfig.get('observer_name', observer_name),
-                                             range_shrink_percentile=activation_qconfig.get('range_shrink_percentile', 0.01))
+                                             # no range shrink by default in compile_mode (the moving average min/max of the fused op does not support it)
+                                             range_shrink_percentile=activation_qconfig.get('range_shrink_percentile', 0 if (compile_mode and is_fake_quantize) else 0.01),
+                                             batched_search=activation_qconfig.get('batched_search', False),
+                                             sample_budget=activation_qconfig.get('sample_budget', None))
+                
+    # learnable_scale: LSQ+ fake quantize, the observer is used only to initialize the scale and zero_point
+    learnable_kwargs = dict(init_steps=activation_qconfig.get('init_steps', 1)) if (activation_qconfig.get('learnable_scale', False) and not compile_mode) else dict()
+    ActivationFakeQuantizeToUse = fake_quantize_types.LearnableActivationFakeQuantize \
+        if activation_qconfig.get('learnable_scale', False) else fake_quantize_types.AdaptiveActivationFakeQuantize
+    ActivationFakeQuantizeToUse = fake_quantize_types.CompilableActivationFakeQuantize if compile_mode else ActivationFakeQuantizeToUse
                 
-    fake_quantized_activation_observer = fake_quantize_types.AdaptiveActivationFakeQuantize.with_args(
+    fake_quantized_activation_observer = ActivationFakeQuantizeToUse.with_args(
         observer=activation_observer, 
         quant_min=activation_qconfig.get('quant_min', torch.iinfo(activation_dtype).min),
         quant_max=activation_qconfig.get('quant_max', torch.iinfo(activation_dtype).max),
-        dtype=activation_dtype) if is_fake_quantize else activation_observer
+        dtype=activation_dtype, **learnable_kwargs) if is_fake_quantize else activation_observer
     
     act_quantization_spec = QuantizationSpec(
         dtype=activation_dtype,
@@ -188,10 +215,11 @@ def get_act_quantization_config(activation_qconfig, is_fake_quantize=True, fast_
     return act_quantization_spec
 
 
-def get_quantization_config(qconfig_dict, is_fake_quantize=False, fast_mode=False):
+def get_quantization_config(qconfig_dict, is_fake_quantize=False, fast_mode=False, compile_mode=False):
     # custom qconfig_type parameters are given in a dict
-    weight_quantization_spec = get_weight_quantization_config(qconfig_dict.get('weight', dict()), is_fake_quantize=is_fake_quantize)
-    act_quantization_spec = get_act_quantization_config(qconfig_dict.get('activation', dict()), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode)
+    weight_quantization_spec = get_weight_quantization_config(qconfig_dict.get('weight', dict()), is_fake_quantize=is_fake_quantize, compile_mode=compile_mode)
+    act_quantization_spec = get_act_quantization_config(qconfig_dict.get('activation', dict()), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode, 
+                                                        compile_mode=compile_mode)
 
     bias_observer_or_fake_quant_ctr: _ObserverOrFakeQuantizeConstructor = torch.ao.quantization.observer.PlaceholderObserver
     bias_quantization_spec = QuantizationSpec(
@@ -210,61 +238,71 @@ def get_quantization_config(qconfig_dict, is_fake_quantize=False, fast_mode=Fals
 
 
 ####################################################################
-def get_quantization_config_default(qconfig_type, is_fake_quantize=True, fast_mode=False):
+def get_quantization_config_default(qconfig_type, is_fake_quantize=True, fast_mode=False, compile_mode=False):
     _QCONFIG_TYPE_TO_DICT = dict()
 
     # per-channel
     _QCONFIG_TYPE_TO_DICT[QConfigType.WC8_AT8] = get_quantization_config(dict(
         weight=dict(qscheme=torch.per_channel_symmetric),
-        activation=dict(qscheme=torch.per_tensor_affine)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode)
+        activation=dict(qscheme=torch.per_tensor_affine)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode, compile_mode=compile_mode)
 
     # per-channel transformers
     _QCONFIG_TYPE_TO_DICT[QConfigType.MSA_WC8_AT8] = get_quantization_config(dict(
         weight=dict(qscheme=torch.per_channel_symmetric),
-        activation=dict(qscheme=torch.per_tensor_affine, range_shrink_percentile=0)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode)
+        activation=dict(qscheme=torch.per_tensor_affine, range_shrink_percentile=0)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode, compile_mode=compile_mode)
 
     # symmetric power-of-2
     _QCONFIG_TYPE_TO_DICT[QConfigType.WT8SYMP2_AT8SYMP2] = get_quantization_config(dict(
         weight=dict(qscheme=torch.per_tensor_symmetric, power2_scale=True),
-        activation=dict(qscheme=torch.per_tensor_symmetric, power2_scale=True)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode)
+        activation=dict(qscheme=torch.per_tensor_symmetric, power2_scale=True)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode, compile_mode=compile_mode)
 
     # per-channel symmetric power-of-2
     _QCONFIG_TYPE_TO_DICT[QConfigType.WC8SYMP2_AT8SYMP2] = get_quantization_config(dict(
         weight=dict(qscheme=torch.per_channel_symmetric, power2_scale=True),
-        activation=dict(qscheme=torch.per_tensor_symmetric, power2_scale=True)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode)
+        activation=dict(qscheme=torch.per_tensor_symmetric, power2_scale=True)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode, compile_mode=compile_mode)
     
     # per-channel power-of-2
     _QCONFIG_TYPE_TO_DICT[QConfigType.WC8P2_AT8P2] = get_quantization_config(dict(
         weight=dict(qscheme=torch.per_channel_symmetric, power2_scale=True),
-        activation=dict(qscheme=torch.per_tensor_affine, power2_scale=True)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode)
+        activation=dict(qscheme=torch.per_tensor_affine, power2_scale=True)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode, compile_mode=compile_mode)
     
     # per-channel power-of-2 transformers
     _QCONFIG_TYPE_TO_DICT[QConfigType.MSA_WC8P2_AT8P2] = get_quantization_config(dict(
         weight=dict(qscheme=torch.per_channel_symmetric, power2_scale=True),
-        activation=dict(qscheme=torch.per_tensor_affine, power2_scale=True, range_shrink_percentile=0)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode)
+        activation=dict(qscheme=torch.per_tensor_affine, power2_scale=True, range_shrink_percentile=0)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode, compile_mode=compile_mode)
 
     # per-channel symmetric power-of-2, fixed activation range
     _QCONFIG_TYPE_TO_DICT[QConfigType.WC8SYMP2_AT8SYMP2R4] = get_quantization_config(dict(
         weight=dict(qscheme=torch.per_channel_symmetric, power2_scale=True),
-        activation=dict(qscheme=torch.per_tensor_symmetric, power2_scale=True, rage_max=4, fixed_range=True)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode)
+        activation=dict(qscheme=torch.per_tensor_symmetric, power2_scale=True, rage_max=4, fixed_range=True)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode, compile_mode=compile_mode)
+
+    # learnable scale (LSQ)
+    _QCONFIG_TYPE_TO_DICT[QConfigType.LSQ_WC8_AT8] = get_quantization_config(dict(
+        weight=dict(qscheme=torch.per_channel_symmetric, learnable_scale=True),
+        activation=dict(qscheme=torch.per_tensor_affine, range_shrink_percentile=0, learnable_scale=True)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode, compile_mode=compile_mode)
+
+    # learnable scale (LSQ), 4 bit weight
+    _QCONFIG_TYPE_TO_DICT[QConfigType.LSQ_WC4_AT8] = get_quantization_config(dict(
+        weight=dict(bitwidth=4, qscheme=torch.per_channel_symmetric, learnable_scale=True),
+        activation=dict(qscheme=torch.per_tensor_affine, learnable_scale=True)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode, compile_mode=compile_mode)
 
     _QCONFIG_TYPE_TO_DICT[QConfigType.WC16_AT16] = get_quantization_config(dict(
         weight=dict(bitwidth=16, qscheme=torch.per_channel_symmetric, dtype=torch.int16),
-        activation=dict(qscheme=torch.per_tensor_affine, bitwidth=16, dtype=torch.int16)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode)
+        activation=dict(qscheme=torch.per_tensor_affine, bitwidth=16, dtype=torch.int16)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode, compile_mode=compile_mode)
     
     _QCONFIG_TYPE_TO_DICT[QConfigType.WC32_AT32] = get_quantization_config(dict(
         weight=dict(bitwidth=32, qscheme=torch.per_channel_symmetric, dtype=torch.int32),
-        activation=dict(qscheme=torch.per_tensor_affine, bitwidth=32, dtype=torch.int32)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode)
+        activation=dict(qscheme=torch.per_tensor_affine, bitwidth=32, dtype=torch.int32)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode, compile_mode=compile_mode)
     
     # 4 bit weight
     _QCONFIG_TYPE_TO_DICT[QConfigType.WC4_AT8] = get_quantization_config(dict(
         weight=dict(bitwidth=4, qscheme=torch.per_channel_symmetric),
-        activation=dict(qscheme=torch.per_tensor_affine)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode)
+        activation=dict(qscheme=torch.per_tensor_affine)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode, compile_mode=compile_mode)
 
     # 4 bit weight, restricted range
     _QCONFIG_TYPE_TO_DICT[QConfigType.WC4M4_AT8] = get_quantization_config(dict(
         weight=dict(bitwidth=4, qscheme=torch.per_channel_symmetric, range_max=4),
-        activation=dict(qscheme=torch.per_tensor_affine)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode)
+        activation=dict(qscheme=torch.per_tensor_affine)), is_fake_quantize=is_fake_quantize, fast_mode=fast_mode, compile_mode=compile_mode)
 
     ###########
     # _QCONFIG_TYPE_TO_DICT[QConfigType.DEFAULT] = _QCONFIG_TYPE_TO_DICT[QConfigType.WC8_AT8]
@@ -275,14 +313,15 @@ def get_quantization_config_default(qconfig_type, is_fake_quantize=True, fast_mo
 ####################################################################
 
 
-def get_qconfig(qconfig_type=None, is_fake_quantize=True, fast_mode=False):
+def get_qconfig(qconfig_type=None, is_fake_quantize=True, fast_mode=False, compile_mode=False):
+    # compile_mode: use the fake quantize / observers that can be captured by torch.compile without graph breaks
     if isinstance(qconfig_type, QuantizationConfig):
         return qconfig_type
     elif isinstance(qconfig_type, str):
-        qconfig_obj = get_quantization_config_default(qconfig_type, is_fake_quantize=is_fake_quantize, fast_mode=fast_mode)
+        qconfig_obj = get_quantization_config_default(qconfig_type, is_fake_quantize=is_fake_quantize, fast_mode=fast_mode, compile_mode=compile_mode)
     elif isinstance(qconfig_type, dict):
         # custom qconfig_type parameters are given in a dict
-        qconfig_obj = get_quantization_config(qconfig_type, is_fake_quantize=is_fake_quantize, fast_mode=fast_mode)
+        qconfig_obj = get_quantization_config(qconfig_type, is_fake_quantize=is_fake_quantize, fast_mode=fast_mode, compile_mode=compile_mode)
     else:
         raise RuntimeError("Unknown qconfig_type: " + str(qconfig_type))
     #
@@ -44,14 +44,17 @@ class QuantPT2EBaseModule(OptimizationBaseModule):
         # self.module = quant_func.init(model, *args, add_methods=add_methods, **kwargs)
         copy_attrs= copy_attrs or []
         super().__init__(model, *args, transformation_dict=transformation_dict, copy_attrs=copy_attrs, **kwargs)
-        self.prepare(self.module, *args, transformation_dict=self.transformation_dict, add_methods=add_methods, **kwargs)
+        # the float model is retained (copied / spilled) only once, by the base module
+        retained_model = self._orig_module if self.transformation_dict is None else None
+        self.prepare(self.module, *args, transformation_dict=self.transformation_dict, add_methods=add_methods, 
+                     retained_model=retained_model, **kwargs)
     
     def prepare(self, model, *args, transformation_dict=None, add_methods=True, **kwargs):
         self.module = quant_func_wrapper.init(model, *args, transformation_dict=transformation_dict, add_methods=add_methods, **kwargs)
 
     @classmethod
     def _add_attrs_to(cls, obj, attr_names=None):
-        attr_names = attr_names or ['load_weights', 'calibrate', 'freeze', 'unfreeze']
+        attr_names = attr_names or ['load_weights', 'calibrate', 'calibrate_from_loader', 'calibrate_bias', 'calibrate_sharded', 'sync_observers', 'save_observer_stats', 'load_observer_stats', 'freeze', 'unfreeze']
         OptimizationBaseModule._add_attrs_to(obj, attr_names)
 
     def load_weights(self, *args, **kwargs):
@@ -62,9 +65,37 @@ class QuantPT2EBaseModule(OptimizationBaseModule):
         self.module = quant_func_wrapper.train(self.module, *args, transformation_dict=self.transformation_dict, **kwargs)
         return self
     
+    def compile(self, *args, **kwargs):
+        self.module = quant_func_wrapper.compile(self.module, *args, **kwargs)
+        return self
+
     def calibrate(self, *args, **kwargs):
         return quant_func_wrapper.calibrate(self.module, *args, **kwargs)
 
+    def calibrate_from_loader(self, *args, **kwargs):
+        self.module = quant_func_wrapper.calibrate_from_loader(self.module, *args, **kwargs)
+        return self
+
+    def calibrate_bias(self, *args, **kwargs):
+        self.module = quant_func_wrapper.calibrate_bias(self.module, *args, **kwargs)
+        return self
+
+    def calibrate_sharded(self, *args, **kwargs):
+        self.module = quant_func_wrapper.calibrate_sharded(self.module, *args, **kwargs)
+        return self
+
+    def sync_observers(self, *args, **kwargs):
+        self.module = quant_func_wrapper.sync_observers(self.module, *args, **kwargs)
+        return self
+
+    def save_observer_stats(self, *args, **kwargs):
+        quant_func_wrapper.save_observer_stats(self.module, *args, **kwargs)
+        return self
+
+    def load_observer_stats(self, *args, **kwargs):
+        self.module = quant_func_wrapper.load_observer_stats(self.module, *args, **kwargs)
+        return self
+
     def freeze(self, *args, **kwargs):
         # return quant_func.freeze(self.module, *args, **kwargs)
         
@@ -82,7 +113,15 @@ class QuantPT2EBaseModule(OptimizationBaseModule):
         return self.module(*args, **kwargs)
 
     def convert(self, *args, **kwargs):
-        if kwargs.pop('make_copy', True):
+        make_copy = kwargs.pop('make_copy', True)
+        if make_copy and kwargs.get('share_params', False) and self.transformation_dict is None:
+            # shallow copy of the wrapper - quant_func.convert makes a light weight copy of the module (with a snapshot of the weights)
+            model = copy.copy(self)
+            model._modules = copy.copy(self._modules)
+            model.module = quant_func_wrapper.convert(self.module, *args, make_copy=True, **kwargs)
+            return model
+        elif make_copy:
+            kwargs.pop('share_params', None)
             model = copy.deepcopy(self) 
             for name, sub_module in self.module.named_modules():
                 if hasattr(sub_module,'__quant_params__'):
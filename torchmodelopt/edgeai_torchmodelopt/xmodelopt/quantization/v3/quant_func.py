@@ -40,20 +40,31 @@ from .... import xnn
 from ... import utils
 from . import qconfig_types
 from . import quant_utils
+from . import export_cache
 from .quantizers import TIDLRTQuantizer
 
 import copy
 import os
 import types 
+import functools
+import io
+import queue
+import traceback
+import time
 
 def init(model, quantizer=None, is_qat=True, total_epochs=0, example_inputs=None, example_kwargs=None, qconfig_type=None,
         qconfig_mode=qconfig_types.QConfigMode.DEFAULT, num_batch_norm_update_epochs=None, num_observer_update_epochs=None, 
-        add_methods=True, fast_mode=False, is_fake_quantize=True, **kwargs):
+        add_methods=True, fast_mode=False, is_fake_quantize=True, export_cache_dir=None, 
+        model_retention=utils.ModelRetention.MEMORY, retention_dir=None, inplace=False, retained_model=None, allow_16bit_node_list=None, compile_mode=False, dynamic_axes=None, **kwargs):
     
     if hasattr(model, '__quant_params__'):
         print('IGNORED: quant init called on a model that was already quantized \n\n\n')
         return model
     
+    if compile_mode and (kwargs.get("bias_calibration_factor", 0) or kwargs.get("outlier_warmup_steps", None) is not None):
+        # these are implemented with hooks, which are not inserted in compile_mode
+        raise ValueError("bias_calibration_factor and outlier_warmup_steps are not supported in compile_mode")
+    #
     example_kwargs = example_kwargs or {} 
     if hasattr(model, '_example_inputs') and hasattr(model, '_example_kwargs'):
         example_inputs = model._example_inputs.pop(0)
@@ -81,19 +92,46 @@ def init(model, quantizer=None, is_qat=True, total_epochs=0, example_inputs=None
                 example_kwargs[key] = value.to(device='cuda:0')
         model = model.to(device='cuda:0')
 
-    orig_model = copy.deepcopy(model)
-        
+    rss_before = utils.get_rss_mb()
+    # inplace=True: export directly from the given model, without a copy - QAT then trains its weights in place
+    export_model = model if inplace else copy.deepcopy(model)
+    if retained_model is not None:
+        # already retained by the caller (eg. the wrapper module) - it is not spilled / copied again
+        orig_model = retained_model
+    elif model_retention == utils.ModelRetention.MEMORY and not inplace:
+        orig_model = export_model
+    else:
+        orig_model = utils.retain_model(model, model_retention, retention_dir)
+    #
     decomposition_table = {torch.ops.aten.layer_norm.default: quant_utils.native_layer_norm}
     
-    m, guards = torchdynamo.export(orig_model, aten_graph=True, assume_static_by_default=True, pre_dispatch=True, decomposition_table=decomposition_table)(*example_inputs, **example_kwargs)
+    flat_dynamic_axes = None
+    if dynamic_axes:
+        # the dims given in dynamic_axes (eg. batch, height, width) are kept symbolic in the exported graph,
+        # so that the prepared model can be run / calibrated / exported at any of these sizes without exporting again
+        example_inputs, example_kwargs, flat_dynamic_axes = quant_utils.mark_dynamic_axes(example_inputs, example_kwargs, dynamic_axes)
+        if export_cache_dir:
+            # the cached graph is loaded without the symbolic shapes (node.meta['val'] is re-created from the example inputs)
+            warnings.warn("export_cache_dir is not used with dynamic_axes - the graph is exported again")
+            export_cache_dir = None
+        #
+    #
+    if export_cache_dir:
+        # reuse the exported graph from an earlier run with the same model, inputs and torch version (if available)
+        graph_cache = export_cache.ExportGraphCache(export_cache_dir)
+        m = graph_cache.export(export_model, example_inputs, example_kwargs, decomposition_table, assume_static_by_default=True)
+    else:
+        m, guards = torchdynamo.export(export_model, aten_graph=True, assume_static_by_default=True, pre_dispatch=True, decomposition_table=decomposition_table)(*example_inputs, **example_kwargs)
     print("Dynamo Export Completed ! \n\n")
     
     is_fake_quantize = True if is_qat else is_fake_quantize
     qconfig_type = qconfig_type or qconfig_types.QConfigType.DEFAULT
-    qconfig_mode = qconfig_types.get_qconfig(qconfig_type, is_fake_quantize=is_fake_quantize, fast_mode=fast_mode)
+    # compile_mode: fake quantize modules without graph breaks and no hooks, so that the model can be used with torch.compile (see compile())
+    qconfig_mode = qconfig_types.get_qconfig(qconfig_type, is_fake_quantize=is_fake_quantize, fast_mode=fast_mode, compile_mode=compile_mode)
     
     # methods to quantize individual layers/modules types are in quantizer
-    quantizer = quantizer or TIDLRTQuantizer(is_qat=is_qat, fast_mode=fast_mode, is_fake_quantize=is_fake_quantize, device=next(iter(m.named_parameters()))[1].device)
+    quantizer = quantizer or TIDLRTQuantizer(is_qat=is_qat, fast_mode=fast_mode, is_fake_quantize=is_fake_quantize, device=next(iter(m.named_parameters()))[1].device,
+                                             allow_16bit_node_list=allow_16bit_node_list, compile_mode=compile_mode)
     quantizer.set_global(qconfig_mode)
     
     # for copy_arg in copy_args:
@@ -118,10 +156,26 @@ def init(model, quantizer=None, is_qat=True, total_epochs=0, example_inputs=None
     model.__quant_params__.num_observer_update_epochs = num_observer_update_epochs
     model.__quant_params__.num_epochs_tracked = 0
     model.__quant_params__.total_epochs = total_epochs
+    model.__quant_params__.compile_mode = compile_mode
+    # keyed by the position of the input in the flattened example inputs / kwargs (see quant_utils.mark_dynamic_axes)
+    model.__quant_params__.dynamic_axes = flat_dynamic_axes
     model.__quant_params__.outlier_hooks = []
     model.__quant_params__.bias_hooks = []
     model.__quant_params__.bias_calibration_factor = kwargs.get("bias_calibration_factor", 0)
+    # opt-in running statistics for the outlier supression in the mlp fc2 layers, frozen after the warmup steps 
+    # (None: statistics of each batch, as before - eg. outlier_warmup_steps=100 to use the running statistics)
+    model.__quant_params__.outlier_warmup_steps = kwargs.get("outlier_warmup_steps", None)
+    model.__quant_params__.outlier_momentum = kwargs.get("outlier_momentum", 0.1)
+    model.__quant_params__.outlier_stats = {}
+    # sync of the observers across the ranks in multi-process training (None: no sync, 0: only when the observers are frozen, 
+    # N: also every N training steps) - all the ranks must then call train()/eval()/freeze() together
+    # (convert()/export() can be called in rank 0 only - they sync only with sync_observers=True)
+    observer_sync_interval = kwargs.get("observer_sync_interval", None)
+    model.__quant_params__.observer_sync = quant_utils.ObserverSync(interval=observer_sync_interval, group=kwargs.get("observer_sync_group", None)) \
+        if observer_sync_interval is not None else None
+    # original_model can be a RetainedModel or None depending on model_retention - use utils.get_retained_model() to access it
     model.__quant_params__.original_model = orig_model
+    model.__quant_params__.export_cache_stats = graph_cache.get_stats() if export_cache_dir else None
 
     if add_methods:
         # add a wrapper for model.train()
@@ -141,19 +195,58 @@ def init(model, quantizer=None, is_qat=True, total_epochs=0, example_inputs=None
         model.convert = types.MethodType(convert, model)
         model.export = types.MethodType(export, model)
         model.__deepcopy__ = types.MethodType(deepcopy_graphmodule, model)
+        model.compile = types.MethodType(compile, model)
+        model.sync_observers = types.MethodType(sync_observers, model)
     #
+    rss_after = utils.get_rss_mb()
+    # resident memory (MB) before / after the preparation, to compare the model_retention modes
+    model.__quant_params__.rss_mb = (rss_before, rss_after)
     print("Model Preparation is now complete! ")
     
-    model = insert_all_hooks(model)
+    if compile_mode:
+        # the hooks cause graph breaks / recompiles with torch.compile
+        if _get_hook_targets(model).outlier:
+            warnings.warn("compile_mode: the outlier supression for the mlp layers is not applied, "
+                          "as it needs hooks - the accuracy of transformer models may be lower")
+        #
+    else:
+        model = insert_all_hooks(model)
+        if model.__quant_params__.observer_sync is not None and model.__quant_params__.observer_sync.interval:
+            model.register_forward_pre_hook(model.__quant_params__.observer_sync)
+        #
+    #
     return model
 
 
+def _get_graph_key(graph):
+    # identifies the nodes of the graph: the node names are unique in a graph and are not reused after a node is erased,
+    # so the key changes when nodes are replaced, even if the number of nodes stays the same
+    return id(graph), hash(tuple((n.name, n.target) for n in graph.nodes))
+
+
+def _get_hook_targets(model):
+    # the modules for the hooks are found once (this needs get_source_partitions on the whole graph) and kept by name
+    # in __quant_params__, so that the hooks removed in eval() are re-attached in train() without searching the graph again
+    hook_targets = model.__quant_params__.get('hook_targets', None)
+    graph_key = _get_graph_key(model.graph)
+    if hook_targets is None or hook_targets.graph_key != graph_key:
+        hook_targets = xnn.utils.AttrDict()
+        hook_targets.graph_key = graph_key
+        hook_targets.outlier = quant_utils.get_fc_outlier_supression_targets(model)
+        hook_targets.bias = quant_utils.get_bias_calibration_targets(model)
+        model.__quant_params__.hook_targets = hook_targets
+    #
+    return hook_targets
+
+
 def insert_all_hooks(model, insert_outlier_hook=True, insert_bias_hook = True):
     if len(model.__quant_params__.outlier_hooks)==0 and insert_outlier_hook:
-        model.__quant_params__.outlier_hooks += quant_utils.add_fc_outlier_supression_hook(model)
+        model.__quant_params__.outlier_hooks += quant_utils.add_fc_outlier_supression_hook(model, \
+                warmup_steps=model.__quant_params__.get('outlier_warmup_steps', None), momentum=model.__quant_params__.get('outlier_momentum', 0.1), 
+                outlier_stats=model.__quant_params__.setdefault('outlier_stats', {}), targets=_get_hook_targets(model).outlier)
     if len(model.__quant_params__.bias_hooks)==0 and insert_bias_hook:
         model.__quant_params__.bias_hooks += quant_utils.add_bias_calibration_hook(model, \
-                calibration_factor = model.__quant_params__.bias_calibration_factor)
+                calibration_factor = model.__quant_params__.bias_calibration_factor, targets=_get_hook_targets(model).bias)
     return model
 
 
@@ -164,38 +257,77 @@ def remove_hooks(hooks):
     return hooks
 
 
+BATCH_NORM_TARGETS = (
+    torch.ops.aten._native_batch_norm_legit.default,
+    torch.ops.aten.cudnn_batch_norm.default,
+    torch.ops.aten.batch_norm.default,
+)
+
+
+def _get_freeze_state(self):
+    # the batchnorm nodes and the observer / fake quant modules are resolved once and reused for every mode switch
+    # the state is rebuilt if the graph is replaced or its nodes are changed
+    state = getattr(self, '_quant_freeze_state', None)
+    graph_key = _get_graph_key(self.graph)
+    if state is None or state.graph_key != graph_key:
+        state = xnn.utils.AttrDict()
+        state.graph_key = graph_key
+        modules = list(self.modules())
+        state.observer_modules = [mod for mod in modules if hasattr(mod, "freeze_observer")]
+        state.fake_quant_modules = [mod for mod in modules if isinstance(mod, torch.ao.quantization.FakeQuantizeBase)]
+        state.bn_modules = [mod for mod in modules if hasattr(mod, "freeze_bn_stats")]
+        state.bn_nodes = [n for n in self.graph.nodes if n.target in BATCH_NORM_TARGETS]
+        self._quant_freeze_state = state
+    #
+    return state
+
+
 def freeze(self, freeze_bn=True, freeze_observers=True):
+    state = _get_freeze_state(self)
+
+    # the ranks have to agree on the ranges before they are frozen
+    observer_sync = self.__quant_params__.get('observer_sync', None) if hasattr(self, '__quant_params__') else None
+    if observer_sync is not None:
+        if freeze_observers and not observer_sync.is_synced:
+            observer_sync.sync(self)
+        elif not freeze_observers:
+            observer_sync.is_synced = False
+        #
+        observer_sync.enabled = not freeze_observers
+    #
 
     # freezing or unfreezing the observers
-    for name, mod in self.named_modules():
-        if hasattr(mod, "freeze_observer"):
+    for mod in state.observer_modules:
+        if mod.freeze_observer != freeze_observers:
             mod.freeze_observer = freeze_observers
     
     # this does not work, neither causes any harm, just here for future
-    if freeze_observers:
-        self.apply(torch.ao.quantization.disable_observer)
-    else:
-        self.apply(torch.ao.quantization.enable_observer)
+    # (always applied - the observers can also be toggled outside of freeze, eg. with enable_observer or load_state_dict)
+    observer_fn = torch.ao.quantization.disable_observer if freeze_observers else torch.ao.quantization.enable_observer
+    for mod in state.fake_quant_modules:
+        observer_fn(mod)
     
     # this does not work, neither causes any harm, just here for future
-    if freeze_bn is True:
-        self.apply(torch.nn.intrinsic.qat.freeze_bn_stats)
-    elif freeze_bn is False:
-        self.apply(torch.nn.intrinsic.qat.update_bn_stats)
+    if freeze_bn in (True, False):
+        bn_fn = torch.nn.intrinsic.qat.freeze_bn_stats if freeze_bn else torch.nn.intrinsic.qat.update_bn_stats
+        for mod in state.bn_modules:
+            bn_fn(mod)
+    #
     
     # freezing the batchnorm update 
-    for n in self.graph.nodes:
-        # Args: input, weight, bias, running_mean, running_var, training, momentum, eps
-        # We set the `training` flag to False here to freeze BN stats
-        if n.target in [
-            torch.ops.aten._native_batch_norm_legit.default,
-            torch.ops.aten.cudnn_batch_norm.default,
-            torch.ops.aten.batch_norm.default,
-        ]:
+    # Args: input, weight, bias, running_mean, running_var, training, momentum, eps
+    # We set the `training` flag to False here to freeze BN stats
+    # only the nodes whose flag changes are modified and the code is regenerated only if there was such a change
+    bn_training = not(freeze_bn)
+    graph_changed = False
+    for n in state.bn_nodes:
+        if n.args[5] != bn_training:
             new_args = list(n.args)
-            new_args[5] = not(freeze_bn)
+            new_args[5] = bn_training
             n.args = tuple(new_args)
-    self.recompile()      
+            graph_changed = True
+    if graph_changed:
+        self.recompile()
             
     return self
 
@@ -215,6 +347,9 @@ def deepcopy_graphmodule(gm, memo=None):
     # Create a new GraphModule
     fake_mod = torch.nn.Module()
     for key in fake_mod.__dict__.keys():
+        if key == '_compiled_call_impl':
+            # the copy is not compiled, compile() can be called on it again
+            continue
         try:
             k_val = copy.deepcopy(gm.__dict__[key]) 
         except:
@@ -251,14 +386,59 @@ def deepcopy_graphmodule(gm, memo=None):
     return new_gm
 
 
-def convert(self, *args, device="cpu", make_copy=True, **kwargs):
+def sharedcopy_graphmodule(gm, device=None):
+    """Copies a GraphModule without a deepcopy of the whole module: the graph and the call_module submodules 
+    (the observers and the fake quantize modules - they are small) are deep copied, and the get_attr parameters 
+    and buffers (the weights / biases) are snapshotted directly on the target device. 
+    The copy does not share any storage with gm, so gm can continue to be trained (the optimizer steps are not 
+    reflected in the copy) and no intermediate copy is made on the device of gm when converting to another device."""
+    new_gm = GraphModule(gm, copy.deepcopy(gm.graph), gm.__class__.__name__)
+    # GraphModule copies references to the submodules and to the attributes - the intermediate modules of nested targets are new
+    for node in new_gm.graph.nodes:
+        if node.op == 'call_module':
+            parent_name, _, attr_name = node.target.rpartition('.')
+            parent = new_gm.get_submodule(parent_name) if parent_name else new_gm
+            setattr(parent, attr_name, copy.deepcopy(gm.get_submodule(node.target)))
+        #
+    #
+    for node in new_gm.graph.nodes:
+        if node.op == 'get_attr':
+            parent_name, _, attr_name = node.target.rpartition('.')
+            parent = new_gm.get_submodule(parent_name) if parent_name else new_gm
+            param = parent._parameters.get(attr_name, None)
+            buffer = parent._buffers.get(attr_name, None)
+            if param is not None:
+                snapshot = param.detach().to(device=device or param.device, copy=True)
+                parent.register_parameter(attr_name, torch.nn.Parameter(snapshot, requires_grad=param.requires_grad))
+            elif buffer is not None:
+                parent.register_buffer(attr_name, buffer.detach().to(device=device or buffer.device, copy=True),
+                                       persistent=attr_name not in parent._non_persistent_buffers_set)
+            #
+        #
+    #
+    new_gm.meta = copy.deepcopy(gm.meta)
+    return new_gm
+
+
+def convert(self, *args, device="cpu", make_copy=True, share_params=False, sync_observers=False, **kwargs):
     if hasattr(self, '__quant_params__'):
+        # the observers are synced when they are frozen (freeze / eval at the epoch end), which all the ranks do together
+        # a sync here is opt-in: convert / export is often called only in rank 0, where a collective would deadlock
+        observer_sync = self.__quant_params__.get('observer_sync', None)
+        if sync_observers and observer_sync is not None and not observer_sync.is_synced:
+            observer_sync.sync(self)
+        #
         orig_quant_params = copy.deepcopy(self.__quant_params__)
     else:
         warnings.warn("__quant_params__ is missing in quant_func module. it may be due to a deepcopy.")
         orig_quant_params = None
 
-    model = copy.deepcopy(self).eval() if make_copy else self.eval() # calls the deepcopy_graphmodule module
+    if make_copy and share_params:
+        # light weight copy: the weights are snapshotted directly on the target device, without a deepcopy of the whole model
+        model = sharedcopy_graphmodule(self, device=device).eval()
+    else:
+        model = copy.deepcopy(self).eval() if make_copy else self.eval() # calls the deepcopy_graphmodule module
+    #
     model = model.to(device=device)
     model = quant_utils.move_node_kwargs_to_device(model, device=device)
     model = quant_utils.remove_to_device_node(model)
@@ -297,9 +477,11 @@ def train(self, mode: bool = True):
         freeze(self, freeze_bn=freeze_bn, freeze_observers=freeze_observers)
         
         # we will probably need better logic to extend to adding more hooks in the toolkit #TODO
-        if len(self.__quant_params__.outlier_hooks)==0 and not(freeze_observers):
+        # no hooks in compile_mode - adding/removing them in every epoch would invalidate the compiled code
+        compile_mode = self.__quant_params__.get('compile_mode', False)
+        if len(self.__quant_params__.outlier_hooks)==0 and not(freeze_observers) and not(compile_mode):
             self = insert_all_hooks(self, insert_bias_hook=False)
-        if len(self.__quant_params__.bias_hooks)==0:
+        if len(self.__quant_params__.bias_hooks)==0 and not(compile_mode):
             self = insert_all_hooks(self, insert_outlier_hook=False)
         
         # Removing the outlier hook when the observers are also frozen
@@ -320,6 +502,36 @@ def eval(self, mode: bool = False):
     return train(self, mode)
 
 
+def compile(self, *args, backend='inductor', **kwargs):
+    '''
+    Compiles the model in place with torch.compile (as in nn.Module.compile), so that the methods added in init 
+    (train/eval/freeze/convert etc.) keep working on the same module and the compiled code is reused across 
+    the epochs and the train()/eval() switches (one graph for each mode).
+    The model should be prepared with compile_mode=True - else the hooks and the observers cause graph breaks.
+    Freezing the batchnorm modifies the graph and causes one recompile in the epoch where it happens.
+    '''
+    if not self.__quant_params__.get('compile_mode', False):
+        warnings.warn("the model was not prepared with compile_mode=True - expect graph breaks and recompiles with torch.compile")
+    #
+    torch.nn.Module.compile(self, *args, backend=backend, **kwargs)
+    return self
+
+
+def sync_observers(self, group=None):
+    '''
+    Syncs the observer states (min/max and histograms) across the ranks of the default (or the given) process group,
+    with a single collective. Can be used in multi-process training/calibration when observer_sync_interval was not 
+    given in init, or in compile_mode where the periodic sync (a forward pre hook) is not used.
+    '''
+    observer_sync = self.__quant_params__.get('observer_sync', None)
+    if observer_sync is not None and group is None:
+        observer_sync.sync(self)
+    else:
+        quant_utils.sync_observer_states(self, group=group)
+    #
+    return self
+
+
 def calibrate(self, freeze_bn=True, freeze_observers=False, freeze_fn=None):
     self.eval()
     freeze_fn=freeze_fn or freeze
@@ -327,6 +539,238 @@ def calibrate(self, freeze_bn=True, freeze_observers=False, freeze_fn=None):
     return self
 
 
+def _update_num_stable_batches(drifts, num_stable_batches, tolerance, patience):
+    # a single device to host copy for the drifts of several batches, converged once there are patience stable batches in a row
+    converged = False
+    drift = float('inf')
+    for drift in torch.stack(drifts).tolist():
+        num_stable_batches = (num_stable_batches + 1) if drift < tolerance else 0
+        converged = converged or (num_stable_batches >= patience)
+    #
+    return num_stable_batches, drift, converged
+
+
+def calibrate_from_loader(self, loader, max_batches=None, tolerance=1e-3, patience=3, input_fn=None, freeze_bn=True):
+    '''
+    PTQ calibration driver: streams the batches from loader through the model and stops early once the 
+    observer ranges (and histograms) change by less than tolerance for patience consecutive batches.
+    input_fn: optional function to map a batch to (args, kwargs) for the model
+    '''
+    calibrate(self, freeze_bn=freeze_bn, freeze_observers=False)
+    observers = quant_utils.get_observer_modules(self)
+    device = next(iter(self.parameters())).device
+    input_fn = input_fn or functools.partial(quant_utils.get_calibration_inputs, device=device)
+    prev_state = None
+    num_stable_batches = 0
+    num_batches = 0
+    drift = float('inf')
+    converged = False
+    # the drifts stay on the device and are copied to the host once every patience batches (instead of a sync per batch),
+    # so the calibration can run up to patience-1 batches more than needed for convergence
+    pending_drifts = []
+    # no_grad instead of inference_mode - the observers re-assign their buffers and those should remain usable for training later
+    with torch.no_grad():
+        for batch in loader:
+            if max_batches is not None and num_batches >= max_batches:
+                break
+            #
+            args, kwargs = input_fn(batch)
+            self(*args, **kwargs)
+            num_batches += 1
+            state = quant_utils.get_observer_state(observers)
+            if prev_state is not None:
+                pending_drifts.append(quant_utils.get_observer_drift(prev_state, state))
+            #
+            prev_state = state
+            if len(pending_drifts) >= max(patience, 1):
+                num_stable_batches, drift, converged = _update_num_stable_batches(pending_drifts, num_stable_batches, tolerance, patience)
+                pending_drifts = []
+                if converged:
+                    print(f"Calibration converged after {num_batches} batches (drift={drift:.6f})")
+                    break
+                #
+            #
+        #
+    #
+    if pending_drifts:
+        num_stable_batches, drift, converged = _update_num_stable_batches(pending_drifts, num_stable_batches, tolerance, patience)
+    #
+    self.__quant_params__.calibration_stats = dict(num_batches=num_batches, drift=drift, converged=converged)
+    return self
+
+
+def calibrate_bias(self, loader, max_batches=None, calibration_factor=1.0, input_fn=None, use_float_model=False):
+    '''
+    PTQ bias correction: accumulates the per channel mean error between the float and the fake quantized outputs 
+    of the conv/linear layers over the batches from loader and corrects the biases once at the end.
+    This does not need the QAT epochs and is much cheaper than the per batch bias calibration hooks.
+    input_fn: optional function to map a batch to (args, kwargs) for the model
+    use_float_model: use the outputs of the layers of the retained original model as the float reference
+        (see model_retention in init), so that the error due to the quantized inputs of each layer is also corrected
+    '''
+    # the observers are frozen, so that the error is found for the final quantization ranges
+    calibrate(self, freeze_bn=True, freeze_observers=True)
+    self.__quant_params__.bias_hooks = remove_hooks(self.__quant_params__.bias_hooks)
+    hooks, accumulators = quant_utils.add_bias_accumulation_hooks(self, targets=_get_hook_targets(self).bias)
+    float_model = None
+    if use_float_model:
+        float_model = utils.get_retained_model(self.__quant_params__.get('original_model', None))
+        assert float_model is not None, "use_float_model needs the original model - it is not retained with model_retention=NONE"
+        float_model.eval()
+        hooks += quant_utils.add_bias_reference_hooks(self, float_model, accumulators)
+    #
+    device = next(iter(self.parameters())).device
+    input_fn = input_fn or functools.partial(quant_utils.get_calibration_inputs, device=device)
+    num_batches = 0
+    with torch.no_grad():
+        for batch in loader:
+            if max_batches is not None and num_batches >= max_batches:
+                break
+            #
+            args, kwargs = input_fn(batch)
+            if float_model is not None:
+                float_model(*args, **kwargs)
+            #
+            self(*args, **kwargs)
+            num_batches += 1
+        #
+        remove_hooks(hooks)
+        if isinstance(self.__quant_params__.get('original_model', None), utils.RetainedModel):
+            # drop the rehydrated float model, it is loaded again when it is needed
+            self.__quant_params__.original_model.release()
+        #
+        corrections = [accumulator.apply(calibration_factor) for accumulator in accumulators]
+        corrections = [correction.abs().max().reshape(1) for correction in corrections if correction is not None]
+    #
+    max_correction = torch.cat(corrections).max().item() if len(corrections) > 0 else 0.0
+    self.__quant_params__.bias_calibration_stats = dict(num_batches=num_batches, num_layers=len(corrections), 
+                                                        max_correction=max_correction*calibration_factor)
+    return self
+
+
+def _calibration_worker(model, dataset, indices, batch_size, collate_fn, input_fn, max_batches, num_threads, result_queue, shard_index):
+    try:
+        torch.set_num_threads(num_threads)
+        shard = torch.utils.data.Subset(dataset, indices)
+        loader = torch.utils.data.DataLoader(shard, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+        num_batches = 0
+        with torch.no_grad():
+            for batch in loader:
+                if max_batches is not None and num_batches >= max_batches:
+                    break
+                #
+                args, kwargs = input_fn(batch)
+                model(*args, **kwargs)
+                num_batches += 1
+            #
+        #
+        observer_state = quant_utils.get_observer_state(quant_utils.get_observer_modules(model))
+        result_queue.put((shard_index, num_batches, observer_state))
+    except Exception:
+        # report the error to the parent instead of leaving it waiting for the result
+        result_queue.put((shard_index, None, traceback.format_exc()))
+    #
+
+
+def _collect_calibration_results(processes, result_queue, timeout=None, poll_interval=1.0):
+    # the results are collected before joining, a worker does not exit while its data is still in the queue
+    # a worker that fails or dies (eg. killed when out of memory) before sending its result raises an error here
+    results = {}
+    start_time = time.perf_counter()
+    while len(results) < len(processes):
+        try:
+            shard_index, num_batches, observer_state = result_queue.get(timeout=poll_interval)
+        except queue.Empty:
+            dead_workers = [shard_index for shard_index, process in enumerate(processes) 
+                            if shard_index not in results and process.exitcode not in (None, 0)]
+            if dead_workers:
+                error = f"calibration worker(s) {dead_workers} exited without a result (exitcode {processes[dead_workers[0]].exitcode})"
+            elif timeout is not None and (time.perf_counter() - start_time) > timeout:
+                error = f"calibration workers did not finish in {timeout} sec"
+            else:
+                continue
+            #
+            for process in processes:
+                process.terminate()
+            #
+            raise RuntimeError(error)
+        #
+        if num_batches is None:
+            for process in processes:
+                process.terminate()
+            #
+            raise RuntimeError(f"calibration worker {shard_index} failed:\n{observer_state}")
+        #
+        results[shard_index] = (num_batches, observer_state)
+    #
+    for process in processes:
+        process.join()
+    #
+    return [results[shard_index] for shard_index in sorted(results.keys())]
+
+
+def calibrate_sharded(self, dataset, num_workers=None, batch_size=1, max_batches=None, collate_fn=None, input_fn=None, 
+                      freeze_bn=True, mp_context='spawn', timeout=None):
+    '''
+    PTQ calibration with the calibration data sharded across a pool of cpu processes.
+    Each worker calibrates its own copy of the prepared model on every num_workers-th sample and the observer states 
+    are merged in the parent in shard order (min/max reduction and histogram merging).
+    Only the min/max and the histogram observers are supported - the state of a moving average observer 
+    depends on the order of the batches and can not be merged to match a sequential calibration (use calibrate_from_loader).
+    dataset: a torch Dataset or a DataLoader (its dataset, batch_size and collate_fn are used)
+    max_batches: maximum number of batches in each worker
+    mp_context: 'spawn' by default - forking after the torch / OpenMP thread pools are initialized can hang the workers.
+        With 'spawn' the dataset, collate_fn and input_fn must be picklable and the calling script must be import safe 
+        (if __name__ == '__main__' guard).
+    timeout: maximum time (sec) to wait for the workers (None: no limit, a worker that dies is still detected)
+    '''
+    if isinstance(dataset, torch.utils.data.DataLoader):
+        batch_size = dataset.batch_size or batch_size
+        collate_fn = collate_fn or dataset.collate_fn
+        dataset = dataset.dataset
+    #
+    observers = quant_utils.get_observer_modules(self)
+    moving_average_observers = [name for name, observer in observers.items() if hasattr(observer, 'averaging_constant')]
+    if moving_average_observers:
+        raise ValueError(f"calibrate_sharded supports only the min/max and histogram observers, found moving average observers: "
+                         f"{moving_average_observers[:4]} - use calibrate_from_loader")
+    #
+    num_workers = num_workers or os.cpu_count()
+    num_threads = max(torch.get_num_threads() // num_workers, 1)
+    calibrate(self, freeze_bn=freeze_bn, freeze_observers=False)
+    device = next(iter(self.parameters())).device
+    input_fn = input_fn or functools.partial(quant_utils.get_calibration_inputs, device=device)
+    # a plain GraphModule with the same submodules and parameters (without the methods added in init), that can be pickled
+    worker_model = GraphModule(self, copy.deepcopy(self.graph), self.__class__.__name__)
+    ctx = torch.multiprocessing.get_context(mp_context)
+    result_queue = ctx.Queue()
+    processes = []
+    for shard_index in range(num_workers):
+        indices = list(range(shard_index, len(dataset), num_workers))
+        process = ctx.Process(target=_calibration_worker, args=(worker_model, dataset, indices, batch_size, collate_fn, input_fn, 
+                                                               max_batches, num_threads, result_queue, shard_index))
+        process.start()
+        processes.append(process)
+    #
+    results = _collect_calibration_results(processes, result_queue, timeout=timeout)
+    states_list = [observer_state for _, observer_state in results]
+    quant_utils.merge_observer_states(observers, states_list)
+    quant_utils.update_fake_quant_qparams(self)
+    self.__quant_params__.calibration_stats = dict(num_batches=sum(r[0] for r in results), num_workers=num_workers)
+    return self
+
+
+def save_observer_stats(self, filename):
+    quant_utils.save_observer_stats(self, filename)
+    return self
+
+
+def load_observer_stats(self, filename, strict=True):
+    # the model should be prepared in the same way (same graph), but the qconfig can be different
+    quant_utils.load_observer_stats(self, filename, strict=strict)
+    return self
+
+
 # dont think that it will be required, atleast for transformers, need to see in other repos
 def load_weights(self, pretrained, *args, strict=True, state_dict_name=None, **kwargs):
     data_dict = torch.load(self, pretrained, *args, **kwargs)
@@ -344,13 +788,67 @@ def _is_observed_module(module) -> bool:
     return hasattr(module, "meta") and "_observed_graph_module_attrs" in module.meta
 
 
+# the protobuf limit - larger onnx models are saved with the weights in an external data file
+ONNX_PROTOBUF_LIMIT = 2**31 - 1
+
+
+def _is_large_onnx_model(onnx_model):
+    return onnx_model.ByteSize() >= ONNX_PROTOBUF_LIMIT
+
+
+def _export_onnx_model(model, example_inputs, filename, **export_kwargs):
+    # the model is exported to memory, except for the models over the protobuf limit - torch.onnx.export needs a file
+    # for these (the weights are written to external data files next to it), the model is then loaded from that file
+    import onnx
+    onnx_buffer = io.BytesIO()
+    try:
+        torch.onnx.export(model, example_inputs, onnx_buffer, **export_kwargs)
+    except (RuntimeError, ValueError) as e:
+        if '2GiB' not in str(e) and '2GB' not in str(e):
+            raise
+        #
+        del onnx_buffer
+        torch.onnx.export(model, example_inputs, filename, **export_kwargs)
+        return onnx.load(filename)
+    #
+    # getbuffer() gives a view of the exported bytes, instead of the copy from getvalue()
+    onnx_model = onnx.load_model_from_string(onnx_buffer.getbuffer())
+    return onnx_model
+
+
+def _save_onnx_model(onnx_model, filename):
+    import onnx
+    if _is_large_onnx_model(onnx_model):
+        onnx.save_model(onnx_model, filename, save_as_external_data=True, all_tensors_to_one_file=True, 
+                        location=os.path.basename(filename) + '.data')
+    else:
+        onnx.save_model(onnx_model, filename)
+    #
+
+
+def _remove_onnx_model(filename):
+    os.remove(filename)
+    if os.path.exists(filename + '.data'):
+        os.remove(filename + '.data')
+    #
+
+
+def _insert_metadata(onnx_model):
+    from ....version import __version__
+    # inserted only once, even if it is called again after the metadata is kept through a conversion
+    meta = next((prop for prop in onnx_model.metadata_props if prop.key == "model_source"), None) or onnx_model.metadata_props.add()
+    meta.key = "model_source"
+    meta.value = f"edgeai_torchmodelopt_{__version__}"
+
+
 def export(self, example_inputs, filename='model.onnx', opset_version=17, model_qconfig_format=None, preserve_qdq_model=True,
-           simplify=True, skipped_optimizers=None, device='cpu', make_copy=True, insert_metadata=True, is_converted=False, **export_kwargs):
+           simplify=True, skipped_optimizers=None, device='cpu', make_copy=True, insert_metadata=True, is_converted=False, optimize_qdq=False, 
+           sync_observers=False, **export_kwargs):
 
     if _is_observed_module(self):
-        model = convert(self, device=device, make_copy=make_copy)
+        model = convert(self, device=device, make_copy=make_copy, sync_observers=sync_observers)
     elif not is_converted:
-        model = convert(self, device=device, make_copy=make_copy)
+        model = convert(self, device=device, make_copy=make_copy, sync_observers=sync_observers)
     else:
         model = self
         warnings.warn("model has already been converted before calling export. make sure it is done correctly.")
@@ -358,19 +856,65 @@ def export(self, example_inputs, filename='model.onnx', opset_version=17, model_
     model.module = quant_utils.remove_loss_branch(model.module)
     quant_utils.register_onnx_symbolics()
 
+    dynamic_axes = getattr(self, '__quant_params__', {}).get('dynamic_axes', None)
+    if dynamic_axes and 'dynamic_axes' not in export_kwargs:
+        # export the dims that were declared dynamic in init as dynamic axes of the onnx model
+        # the onnx inputs are the tensors of example_inputs, in the same order as the inputs / kwargs given to init
+        if not export_kwargs.get('input_names', None):
+            inputs_to_name = [val for val in example_inputs.values() if not isinstance(val, list)] \
+                if isinstance(example_inputs, dict) else example_inputs
+            num_inputs = quant_utils._get_num_tensors(inputs_to_name)
+            export_kwargs['input_names'] = [f'input_{i}' for i in range(num_inputs)]
+        #
+        export_kwargs['dynamic_axes'] = quant_utils.get_onnx_dynamic_axes(dynamic_axes, export_kwargs['input_names'])
+    #
+
+    # the onnx model is kept in memory through export -> simplify -> metadata and is serialized only once
+    import onnx
+    export_timing = {}
+    qdq_report = None
+    start_time = time.perf_counter()
+
     if model_qconfig_format == qconfig_types.QConfigFormat.INT_MODEL:
         # # Convert QDQ format to Int8 format
         import onnxruntime as ort
         qdq_filename = os.path.splitext(filename)[0] + '_qdq.onnx'
-        torch.onnx.export(model, example_inputs.to('cpu'), qdq_filename, opset_version=opset_version, training=torch._C._onnx.TrainingMode.PRESERVE, **export_kwargs)
+        onnx_model = _export_onnx_model(model, example_inputs.to('cpu'), qdq_filename, opset_version=opset_version, training=torch._C._onnx.TrainingMode.PRESERVE, **export_kwargs)
+        export_timing['export'] = time.perf_counter() - start_time
+        if optimize_qdq:
+            # fold the redundant QDQ nodes before the conversion by onnxruntime
+            from .... import xonnx
+            start_time = time.perf_counter()
+            onnx_model, qdq_report = xonnx.optimize_qdq_model(onnx_model)
+            export_timing['optimize_qdq'] = time.perf_counter() - start_time
+        #
+        if insert_metadata:
+            # the metadata is kept by onnxruntime in the converted model
+            _insert_metadata(onnx_model)
+        #
+        start_time = time.perf_counter()
         so = ort.SessionOptions()
         so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
         so.optimized_model_filepath = filename
         # logger.info("Inplace conversion of QDQ model to INT8 model at: {}".format(onnx_file))
-        ort.InferenceSession(qdq_filename, so)
-        if not preserve_qdq_model:
-            os.remove(qdq_filename)
+        if preserve_qdq_model or _is_large_onnx_model(onnx_model):
+            # the models over the protobuf limit can be given to onnxruntime only as a file (with the external data)
+            if _is_large_onnx_model(onnx_model):
+                so.add_session_config_entry('session.optimized_model_external_initializers_file_name', os.path.basename(filename) + '.data')
+            #
+            _save_onnx_model(onnx_model, qdq_filename)
+            del onnx_model
+            ort.InferenceSession(qdq_filename, so)
+            if not preserve_qdq_model:
+                _remove_onnx_model(qdq_filename)
+            #
+        else:
+            ort.InferenceSession(onnx_model.SerializeToString(), so)
+            del onnx_model
         #
+        export_timing['int_conversion'] = time.perf_counter() - start_time
+        # onnxruntime can write the optimized model only to a file - it is loaded back only if it has to be simplified
+        onnx_model = onnx.load(filename) if simplify else None
     else:
         if isinstance(example_inputs, dict):
             input_to_export = ()
@@ -380,20 +924,31 @@ def export(self, example_inputs, filename='model.onnx', opset_version=17, model_
                 input_to_export += tuple([val.to(device=device)])
         else:
             input_to_export = example_inputs.to(device=device)
-        torch.onnx.export(model, input_to_export, filename, opset_version=opset_version, training=torch._C._onnx.TrainingMode.PRESERVE, **export_kwargs)
+        onnx_model = _export_onnx_model(model, input_to_export, filename, opset_version=opset_version, training=torch._C._onnx.TrainingMode.PRESERVE, **export_kwargs)
+        export_timing['export'] = time.perf_counter() - start_time
+    #
 
     if simplify:
-        import onnx
         from onnxsim import simplify
-        onnx_model = onnx.load(filename)
+        start_time = time.perf_counter()
         onnx_model, check = simplify(onnx_model, skipped_optimizers=skipped_optimizers)
-        onnx.save(onnx_model, filename)
+        export_timing['simplify'] = time.perf_counter() - start_time
+    
+    if optimize_qdq and model_qconfig_format != qconfig_types.QConfigFormat.INT_MODEL:
+        from .... import xonnx
+        start_time = time.perf_counter()
+        onnx_model, qdq_report = xonnx.optimize_qdq_model(onnx_model)
+        export_timing['optimize_qdq'] = time.perf_counter() - start_time
     
-    if insert_metadata:
-        import onnx
-        from ....version import __version__
-        onnx_model = onnx.load(filename)
-        meta = onnx_model.metadata_props.add()
-        meta.key = "model_source"
-        meta.value = f"edgeai_torchmodelopt_{__version__}"
-        onnx.save(onnx_model, filename)
+    if insert_metadata and onnx_model is not None:
+        _insert_metadata(onnx_model)
+    
+    if onnx_model is not None:
+        start_time = time.perf_counter()
+        _save_onnx_model(onnx_model, filename)
+        export_timing['save'] = time.perf_counter() - start_time
+    #
+    print("ONNX export timing (sec): " + ", ".join(f"{stage}={duration:.2f}" for stage, duration in export_timing.items()))
+    if hasattr(self, '__quant_params__'):
+        self.__quant_params__.export_timing = export_timing
+        self.__quant_params__.qdq_report = qdq_report
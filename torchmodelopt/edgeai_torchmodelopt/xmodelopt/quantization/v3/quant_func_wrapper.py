@@ -43,10 +43,38 @@ def export(self, *args, transformation_dict = None, is_converted = False, device
     return
 
 
+def compile(*args, **kwargs):
+    return quant_func.compile(*args, **kwargs)
+
+
 def calibrate(*args, **kwargs):
     return quant_func.calibrate(*args, freeze_bn = freeze, **kwargs)
 
 
+def calibrate_from_loader(*args, **kwargs):
+    return quant_func.calibrate_from_loader(*args, **kwargs)
+
+
+def calibrate_bias(*args, **kwargs):
+    return quant_func.calibrate_bias(*args, **kwargs)
+
+
+def calibrate_sharded(*args, **kwargs):
+    return quant_func.calibrate_sharded(*args, **kwargs)
+
+
+def sync_observers(*args, **kwargs):
+    return quant_func.sync_observers(*args, **kwargs)
+
+
+def save_observer_stats(*args, **kwargs):
+    return quant_func.save_observer_stats(*args, **kwargs)
+
+
+def load_observer_stats(*args, **kwargs):
+    return quant_func.load_observer_stats(*args, **kwargs)
+
+
 def remove_hooks(*args, **kwargs):
     return wrapped_transformation_fn(quant_func.remove_hooks, *args, **kwargs)
 
@@ -29,6 +29,8 @@
 #
 #################################################################################
 
+import re
+import copy
 import torch
 import statistics
 from torch.onnx import symbolic_helper, register_custom_op_symbolic, _type_utils
@@ -86,6 +88,8 @@ class QuantAttention(nn.Module):
         self.proj_drop = nn.Dropout(proj_drop)
         self.softmax = nn.Softmax(dim=-1)
         self.relative_position_bias_table = None
+        # scale for q as a vector (so that it is quantized as a tensor input of mul), created once and moved along with the module
+        self.register_buffer('scale_tensor', torch.full((self.head_dim,), self.scale), persistent=False)
 
     def forward(self, x: torch.Tensor, **kwargs) -> torch.Tensor:
         B, N, C = x.shape
@@ -94,7 +98,7 @@ class QuantAttention(nn.Module):
         q, k = self.q_norm(q), self.k_norm(k)
 
         #q = torch.mul(q, torch.tensor(self.scale))
-        q = torch.mul(q, torch.tensor([self.scale]*self.head_dim))
+        q = torch.mul(q, self.scale_tensor)
         attn = torch.matmul(q, k.transpose(-2, -1))
         if self.relative_position_bias_table is not None:
             attn = attn + _get_rel_pos_bias(self.relative_position_bias_table, self.relative_position_index, self.window_area)
@@ -109,8 +113,8 @@ class QuantAttention(nn.Module):
 
 
 def LayerNormWithoutGB(x, eps):
-    mean = torch.mean(x, dim=-1, keepdim=True)
-    var = torch.pow(x - mean, 2).mean(dim=-1, keepdim=True)
+    # single var_mean reduction and one (x - mean) intermediate, the normalization is still a single div node
+    var, mean = torch.var_mean(x, dim=-1, keepdim=True, correction=0)
     return (x - mean) / torch.sqrt(var + eps)
 
 def native_layer_norm(input, normalized_shape, weight, bias, eps: float = 1e-5,):
@@ -300,35 +304,77 @@ def remove_to_device_node(model):
     model.recompile()
     return model      
 
-def _bias_calibration_hook(m, x, y, calibration_factor, bias_module):
-    bias_error = 0
-    if isinstance(x, tuple):
-        x = x[0]
+def _get_bias_reduce_dims(x, bias_module):
+    # dims over which the per channel mean of the output is found, None if the layout is not supported
     if len(x.shape) == 3:
-        if x.shape[1] == bias_module.shape[0]:
-            float_mean = x.mean(dim=(0,2))
-            quant_mean = y.mean(dim=(0,2))
-            bias_error = float_mean - quant_mean 
-        else:
-            float_mean = x.mean(dim=(0,1))
-            quant_mean = y.mean(dim=(0,1))
-            bias_error = float_mean - quant_mean 
+        return (0,2) if x.shape[1] == bias_module.shape[0] else (0,1)
     elif len(x.shape) == 4:
         if x.shape[1] == bias_module.shape[0]:
-            float_mean = x.mean(dim=(0,2,3))
-            quant_mean = y.mean(dim=(0,2,3)) 
-            bias_error = float_mean - quant_mean                                          
+            return (0,2,3)
         elif x.shape[3] == bias_module.shape[0]:
-            float_mean = x.mean(dim=(0,1,2))    
-            quant_mean = y.mean(dim=(0,1,2))  
-            bias_error = float_mean - quant_mean 
+            return (0,1,2)
+    return None
+
+
+def _bias_calibration_hook(m, x, y, calibration_factor, bias_module):
+    bias_error = 0
+    if isinstance(x, tuple):
+        x = x[0]
+    reduce_dims = _get_bias_reduce_dims(x, bias_module)
+    if reduce_dims is not None:
+        float_mean = x.mean(dim=reduce_dims)
+        quant_mean = y.mean(dim=reduce_dims)
+        bias_error = float_mean - quant_mean
 
     bias_module.data += (bias_error * calibration_factor)
     return y
 
 
-def add_bias_calibration_hook(model, calibration_factor=0):
-    all_hooks = []    
+class BiasCalibrationAccumulator():
+    '''
+    Forward hook for the fake quantize module after a conv/linear layer, that accumulates the per channel
+    error between the float and the fake quantized outputs across batches (on the device of the output).
+    The float output is the input of the fake quantize module, or the output of the corresponding layer in the 
+    float model if it was set in reference_output (see add_bias_reference_hooks).
+    The bias is not modified in the hook - apply() makes a single correction with the mean error at the end.
+    '''
+    def __init__(self, bias_module, fake_quantize_module=None):
+        self.bias_module = bias_module
+        self.fake_quantize_module = fake_quantize_module
+        self.reference_output = None
+        self.error_sum = None
+        self.count = 0
+
+    def __call__(self, m, x, y):
+        if isinstance(x, tuple):
+            x = x[0]
+        reference_output, self.reference_output = self.reference_output, None
+        if reference_output is not None and reference_output.shape == x.shape:
+            x = reference_output
+        #
+        reduce_dims = _get_bias_reduce_dims(x, self.bias_module)
+        if reduce_dims is not None:
+            # single reduction of the difference instead of the two means
+            error_sum = (x.detach() - y.detach()).sum(dim=reduce_dims, dtype=torch.float32)
+            self.error_sum = error_sum if self.error_sum is None else (self.error_sum + error_sum)
+            self.count += x.numel() // self.bias_module.shape[0]
+        return y
+
+    def get_correction(self):
+        if self.error_sum is None or self.count == 0:
+            return None
+        return self.error_sum / self.count
+
+    def apply(self, calibration_factor=1.0):
+        correction = self.get_correction()
+        if correction is not None:
+            self.bias_module.data += (correction * calibration_factor).to(self.bias_module.dtype)
+        return correction
+
+
+def get_bias_calibration_targets(model):
+    # (name of the bias, name of the fake quantize module at the output) for each of the conv/linear layers with a bias
+    bias_calibration_targets = []
     module_partitions = get_source_partitions(
         model.graph, [torch.nn.Linear, torch.nn.functional.linear, torch.nn.Conv2d, torch.nn.functional.conv2d]
     )
@@ -342,9 +388,7 @@ def add_bias_calibration_hook(model, calibration_factor=0):
                     bias_node = param_node
                 #
             #
-            if bias_node is not None:
-                bias_module = getattr(model, bias_node.target)
-            else:
+            if bias_node is None:
                 continue
             
             output_node = None
@@ -364,12 +408,73 @@ def add_bias_calibration_hook(model, calibration_factor=0):
                 assert output_node.next.target in [torch.ops.aten.relu.default, torch.ops.aten.relu_.default]
                 output_node = output_node.next
             #
-            fake_quantize_module = getattr(model, output_node.next.target)
-            
-            _bias_calibration_hook_binded = partial(_bias_calibration_hook, \
-                calibration_factor=calibration_factor, bias_module=bias_module)
-            this_hook = fake_quantize_module.register_forward_hook(_bias_calibration_hook_binded)
-            all_hooks.append(this_hook)
+            bias_calibration_targets.append((bias_node.target, output_node.next.target))
+        #
+    #
+    return bias_calibration_targets
+
+
+def _get_bias_calibration_modules(model, targets=None):
+    # (bias, fake quantize module at the output) for each of the conv/linear layers with a bias
+    targets = targets if targets is not None else get_bias_calibration_targets(model)
+    return [(getattr(model, bias_name), getattr(model, fake_quantize_name)) for bias_name, fake_quantize_name in targets]
+
+
+def add_bias_calibration_hook(model, calibration_factor=0, targets=None):
+    # targets: from get_bias_calibration_targets(), to avoid finding them again when the hooks are re-inserted
+    all_hooks = []    
+    for bias_module, fake_quantize_module in _get_bias_calibration_modules(model, targets):
+        _bias_calibration_hook_binded = partial(_bias_calibration_hook, \
+            calibration_factor=calibration_factor, bias_module=bias_module)
+        this_hook = fake_quantize_module.register_forward_hook(_bias_calibration_hook_binded)
+        all_hooks.append(this_hook)
+    #
+    return all_hooks
+
+
+def add_bias_accumulation_hooks(model, targets=None):
+    all_hooks = []
+    accumulators = []
+    for bias_module, fake_quantize_module in _get_bias_calibration_modules(model, targets):
+        accumulator = BiasCalibrationAccumulator(bias_module, fake_quantize_module)
+        all_hooks.append(fake_quantize_module.register_forward_hook(accumulator))
+        accumulators.append(accumulator)
+    #
+    return all_hooks, accumulators
+
+
+def _normalize_module_path(path):
+    # nn_module_stack paths look like "L['self'].layer1[0].conv1" or "L__self___layer1_0_conv1" depending on the torch version
+    path = re.sub(r'[^0-9a-zA-Z]+', '_', path).strip('_')
+    return re.sub(r'^L_self_?', '', path)
+
+
+def add_bias_reference_hooks(model, float_model, accumulators):
+    '''
+    forward hooks on the conv/linear layers of the float model (eg. the retained original model), that set the output of 
+    the layer as the reference of the accumulator of the corresponding layer in the prepared model - so that the bias 
+    correction also covers the error of the quantized inputs of the layer. The float model must be run before the 
+    prepared model on each batch. Layers that are not found in the float model (or are fused with relu) use the 
+    input of the fake quantize module as reference.
+    '''
+    float_modules = {_normalize_module_path(name): module for name, module in float_model.named_modules()
+                     if isinstance(module, (torch.nn.Conv2d, torch.nn.Linear))}
+    fake_quantize_inputs = {node.target: node.args[0] for node in model.graph.nodes if node.op == 'call_module' and len(node.args) > 0}
+    named_fake_quantize_modules = {module: name for name, module in model.named_modules()}
+    all_hooks = []
+    for accumulator in accumulators:
+        input_node = fake_quantize_inputs.get(named_fake_quantize_modules.get(accumulator.fake_quantize_module, None), None)
+        nn_module_stack = input_node.meta.get('nn_module_stack', None) if isinstance(input_node, Node) else None
+        if not nn_module_stack or input_node.target not in (torch.ops.aten.conv2d.default, torch.ops.aten.linear.default):
+            continue
+        #
+        key, value = list(nn_module_stack.items())[-1]
+        float_module = float_modules.get(_normalize_module_path(value[0] if isinstance(value, tuple) else key), None)
+        if float_module is not None:
+            def _reference_hook(module, inputs, output, accumulator=accumulator):
+                accumulator.reference_output = output.detach()
+            #
+            all_hooks.append(float_module.register_forward_hook(_reference_hook))
         #
     #
     return all_hooks
@@ -386,6 +491,52 @@ def _fc_outlier_supression_hook(m, x):
     return tuple([x])
 
 
+class OutlierSupressionStats():
+    '''
+    Forward pre hook with the running (exponential moving average) mean and std of the fc2 activation, that are 
+    frozen after warmup_steps updates. The 3 sigma clip then reuses the stored values instead of reducing the 
+    whole activation in every step. The object is kept in __quant_params__, so that the statistics survive 
+    the removal and re-insertion of the hooks in train()/eval().
+    '''
+    def __init__(self, warmup_steps=100, momentum=0.1):
+        self.warmup_steps = warmup_steps
+        self.momentum = momentum
+        self.num_steps = 0
+        self.running_mean = None
+        self.running_std = None
+        self.clip_val_min = None
+        self.clip_val_max = None
+
+    def is_frozen(self):
+        return self.num_steps >= self.warmup_steps
+
+    def update(self, x):
+        with torch.no_grad():
+            mean_val = x.mean(dim=(0,1))
+            std_val = x.std(dim=(0,1))
+            if self.running_mean is None:
+                self.running_mean, self.running_std = mean_val, std_val
+            else:
+                self.running_mean = torch.lerp(self.running_mean, mean_val, self.momentum)
+                self.running_std = torch.lerp(self.running_std, std_val, self.momentum)
+            #
+            self.clip_val_max = self.running_mean + 3*self.running_std
+            self.clip_val_min = self.running_mean - 3*self.running_std
+        #
+        self.num_steps += 1
+
+    def __call__(self, m, x):
+        if isinstance(x, tuple):
+            x = x[0]
+        if self.clip_val_min is None or not self.is_frozen():
+            self.update(x)
+        #
+        if self.clip_val_min.device != x.device:
+            self.clip_val_min, self.clip_val_max = self.clip_val_min.to(x.device), self.clip_val_max.to(x.device)
+        x = torch.clip(x, min=self.clip_val_min, max=self.clip_val_max)
+        return tuple([x])
+
+
 def is_mlp_fc2_layer(node, find_level, found_gelu=False, gelu_node=None):
     if find_level < 0 or not(hasattr(node, 'target')):
         return False, gelu_node
@@ -408,10 +559,9 @@ def is_mlp_fc2_layer(node, find_level, found_gelu=False, gelu_node=None):
     #
 
 
-def add_fc_outlier_supression_hook(model):
-    all_modules = dict(model.named_modules())
-    all_hooks = []
-    
+def get_fc_outlier_supression_targets(model):
+    # names of the modules (at the output of the mlp fc2 layers) where the outlier supression hook is inserted
+    outlier_supression_targets = []
     module_partitions = get_source_partitions(
         model.graph, [torch.nn.Linear, torch.nn.functional.linear]
     )
@@ -440,9 +590,491 @@ def add_fc_outlier_supression_hook(model):
                         act_node = output_node
                     else:
                         act_node = output_node.next
-                this_hook1 = getattr(model, act_node.target).register_forward_pre_hook(_fc_outlier_supression_hook)
-                # this_hook2 = getattr(model, gelu_node.next.target).register_forward_pre_hook(_fc_outlier_supression_hook)
-                all_hooks.append(this_hook1)
-                # all_hooks.append(this_hook2)
+                outlier_supression_targets.append(act_node.target)
                 
-    return all_hooks
\ No newline at end of file
+    return outlier_supression_targets
+
+
+def add_fc_outlier_supression_hook(model, warmup_steps=None, momentum=0.1, outlier_stats=None, targets=None):
+    # warmup_steps=None finds the statistics of the activation in every step, 
+    # else running statistics are used (kept in outlier_stats, by the name of the module, if it is given)
+    # targets: from get_fc_outlier_supression_targets(), to avoid finding them again when the hooks are re-inserted
+    outlier_stats = outlier_stats if outlier_stats is not None else {}
+    targets = targets if targets is not None else get_fc_outlier_supression_targets(model)
+    all_hooks = []
+    for target in targets:
+        if warmup_steps is None:
+            outlier_hook = _fc_outlier_supression_hook
+        else:
+            if target not in outlier_stats:
+                outlier_stats[target] = OutlierSupressionStats(warmup_steps=warmup_steps, momentum=momentum)
+            outlier_hook = outlier_stats[target]
+        #
+        all_hooks.append(getattr(model, target).register_forward_pre_hook(outlier_hook))
+    #
+    return all_hooks
+
+
+def get_observer_modules(model):
+    # observers are either inside the fake quantize modules (activation_post_process) or directly in the graph (ptq)
+    return {name: module for name, module in model.named_modules() if isinstance(module, torch.ao.quantization.ObserverBase)}
+
+
+def get_observer_state(observers):
+    observer_state = {}
+    for name, observer in observers.items():
+        state = {}
+        for key in ('min_val', 'max_val', 'histogram'):
+            value = getattr(observer, key, None)
+            if isinstance(value, torch.Tensor):
+                state[key] = value.detach().clone()
+            #
+        #
+        observer_state[name] = state
+    #
+    return observer_state
+
+
+def get_observer_drift(prev_state, state, eps=1e-12):
+    # maximum relative change in the observed ranges (and histogram shape) between two observer states
+    # as a 0 dim tensor on the device of the observers (no device to host sync)
+    drifts = []
+    device = next((value.device for cur in state.values() for value in cur.values()), torch.device('cpu'))
+    for name, cur in state.items():
+        prev = prev_state.get(name, None)
+        if prev is None or 'min_val' not in cur or cur['min_val'].shape != prev['min_val'].shape:
+            continue
+        #
+        value_range = torch.clamp(torch.abs(cur['max_val'] - cur['min_val']), min=eps)
+        min_drift = torch.abs(cur['min_val'] - prev['min_val']) / value_range
+        max_drift = torch.abs(cur['max_val'] - prev['max_val']) / value_range
+        drifts.append(torch.max(torch.amax(min_drift), torch.amax(max_drift)).reshape(1))
+        if 'histogram' in cur and cur['histogram'].shape == prev['histogram'].shape:
+            hist_cur = cur['histogram'] / torch.clamp(cur['histogram'].sum(), min=eps)
+            hist_prev = prev['histogram'] / torch.clamp(prev['histogram'].sum(), min=eps)
+            drifts.append((torch.abs(hist_cur - hist_prev).sum() * 0.5).reshape(1))
+        #
+    #
+    if len(drifts) == 0:
+        return torch.tensor(float('inf'), device=device)
+    #
+    # a range that is still inf (observer not yet updated) is treated as not converged
+    drift = torch.nan_to_num(torch.cat([d.float() for d in drifts]), nan=float('inf'))
+    return drift.max()
+
+
+def compute_observer_drift(prev_state, state, eps=1e-12):
+    return get_observer_drift(prev_state, state, eps=eps).item()
+
+
+def get_calibration_inputs(batch, device=None):
+    # default mapping from a dataloader batch to the model inputs: (input, target, ...) tuples use the first entry
+    if isinstance(batch, dict):
+        args, kwargs = (), batch
+    elif isinstance(batch, (list, tuple)):
+        args, kwargs = (batch[0],), {}
+    else:
+        args, kwargs = (batch,), {}
+    #
+    if device is not None:
+        args = tuple(a.to(device) if isinstance(a, torch.Tensor) else a for a in args)
+        kwargs = {k: (v.to(device) if isinstance(v, torch.Tensor) else v) for k, v in kwargs.items()}
+    #
+    return args, kwargs
+
+
+def get_graph_args(graph_module, args, kwargs):
+    '''
+    the inputs of a graph module as positional args for an fx Interpreter (Interpreter.run does not take keyword inputs).
+    the keyword inputs are matched by name with the inputs of the original forward (exported graphs, the interpreter 
+    flattens them) or with the placeholders (traced graphs), in the order of the graph - not in the order of kwargs.
+    '''
+    if not kwargs:
+        return tuple(args)
+    #
+    pytree_info = getattr(graph_module.graph._codegen, 'pytree_info', None)
+    placeholders = [node for node in graph_module.graph.nodes if node.op == 'placeholder']
+    if pytree_info is not None:
+        names, defaults = list(pytree_info.orig_args), {}
+    else:
+        names = [node.target.lstrip('*') for node in placeholders]
+        defaults = {node.target: node.args[0] for node in placeholders if len(node.args) > 0}
+    #
+    unexpected = [name for name in kwargs if name not in names[len(args):]]
+    if unexpected:
+        raise TypeError(f"unexpected keyword inputs for the graph: {unexpected}")
+    #
+    graph_args = list(args)
+    for name in names[len(args):]:
+        if name in kwargs:
+            graph_args.append(kwargs[name])
+        elif name in defaults:
+            graph_args.append(defaults[name])
+        else:
+            raise TypeError(f"missing input for the graph: {name}")
+        #
+    #
+    return tuple(graph_args)
+
+
+def _merge_histograms(states, bins, eps=1e-12):
+    # re-bin every histogram onto the combined range assuming a uniform density inside each source bin
+    min_val = torch.min(torch.stack([state['min_val'] for state in states]))
+    max_val = torch.max(torch.stack([state['max_val'] for state in states]))
+    dst_edges = torch.linspace(0.0, 1.0, bins + 1, device=min_val.device) * (max_val - min_val) + min_val
+    merged = torch.zeros(bins, device=min_val.device, dtype=states[0]['histogram'].dtype)
+    for state in states:
+        histogram = state['histogram']
+        src_width = state['max_val'] - state['min_val']
+        if src_width.item() <= eps:
+            dst_index = torch.clamp(torch.bucketize(state['min_val'], dst_edges[1:-1]), 0, bins - 1)
+            merged[dst_index] += histogram.sum()
+            continue
+        #
+        src_edges = torch.linspace(0.0, 1.0, histogram.numel() + 1, device=min_val.device) * src_width + state['min_val']
+        overlap_begin = torch.maximum(src_edges[:-1].unsqueeze(1), dst_edges[:-1].unsqueeze(0))
+        overlap_end = torch.minimum(src_edges[1:].unsqueeze(1), dst_edges[1:].unsqueeze(0))
+        overlap = torch.clamp(overlap_end - overlap_begin, min=0) / (src_edges[1:] - src_edges[:-1]).unsqueeze(1)
+        merged += histogram @ overlap.to(histogram.dtype)
+    #
+    return dict(min_val=min_val, max_val=max_val, histogram=merged)
+
+
+def merge_observer_states(observers, states_list):
+    '''
+    merges the observer states collected on different shards of the calibration data into the given observers.
+    states_list must be in a fixed (shard) order so that the result is deterministic.
+    '''
+    for name, observer in observers.items():
+        states = [states[name] for states in states_list if name in states and 'min_val' in states[name]]
+        # shards that did not see any data still have the initial inf ranges
+        states = [state for state in states if torch.isfinite(state['min_val']).all() and torch.isfinite(state['max_val']).all()]
+        if len(states) == 0:
+            continue
+        #
+        if isinstance(observer, torch.ao.quantization.HistogramObserver) and 'histogram' in states[0]:
+            merged_state = _merge_histograms(states, observer.bins)
+        elif getattr(observer, 'moving_average', hasattr(observer, 'averaging_constant')):
+            # moving average observers - the average of the per shard averages (used to sync the ranks that run the same steps,
+            # this is not the same as a sequential calibration - calibrate_sharded does not support these observers)
+            merged_state = dict(min_val=torch.mean(torch.stack([state['min_val'] for state in states]), dim=0),
+                                max_val=torch.mean(torch.stack([state['max_val'] for state in states]), dim=0))
+        else:
+            merged_state = dict(min_val=torch.amin(torch.stack([state['min_val'] for state in states]), dim=0),
+                                max_val=torch.amax(torch.stack([state['max_val'] for state in states]), dim=0))
+        #
+        load_observer_state(observer, merged_state)
+    #
+    return observers
+
+
+def load_observer_state(observer, state):
+    for key, value in state.items():
+        device = getattr(observer, key).device
+        setattr(observer, key, value.detach().clone().to(device))
+    #
+    return observer
+
+
+def update_fake_quant_qparams(model):
+    # the scale/zero_point buffers of the fake quantize modules are updated only in their forward
+    # refresh them after the observer states were changed from outside
+    num_learned_qparams = 0
+    for module in model.modules():
+        if isinstance(module, torch.ao.quantization.FakeQuantizeBase) and hasattr(module, 'activation_post_process'):
+            if isinstance(module.scale, torch.nn.Parameter):
+                # learned qparams (LearnableFakeQuantize) are not derived from the observer once they are initialized
+                # (before that calculate_qparams uses the observer) - they are kept, and in sync with DDP as parameters
+                num_learned_qparams += int(getattr(module, 'num_init_steps', 1) > 0)
+                continue
+            #
+            scale, zero_point = module.calculate_qparams()
+            scale, zero_point = scale.to(module.scale.device), zero_point.to(module.zero_point.device)
+            if module.scale.shape != scale.shape:
+                module.scale.resize_(scale.shape)
+                module.zero_point.resize_(zero_point.shape)
+            #
+            module.scale.copy_(scale)
+            module.zero_point.copy_(zero_point)
+        #
+    #
+    if num_learned_qparams > 0:
+        warnings.warn(f"the learned scale/zero_point of {num_learned_qparams} fake quantize modules are not updated from the observer states")
+    #
+    return model
+
+
+def _pack_observer_states(observer_state):
+    # flattens the observer states (in a fixed order) into a single tensor, so that they can be exchanged in one collective
+    layout, tensors = [], []
+    for name in sorted(observer_state.keys()):
+        for key in sorted(observer_state[name].keys()):
+            value = observer_state[name][key]
+            layout.append((name, key, value.shape, value.dtype))
+            tensors.append(value.reshape(-1).to(torch.float32))
+        #
+    #
+    flat_state = torch.cat(tensors) if tensors else torch.zeros(0)
+    return flat_state, layout
+
+
+def _unpack_observer_states(flat_state, layout):
+    observer_state = {}
+    offset = 0
+    for name, key, shape, dtype in layout:
+        numel = shape.numel()
+        observer_state.setdefault(name, {})[key] = flat_state[offset:offset+numel].reshape(shape).to(dtype)
+        offset += numel
+    #
+    return observer_state
+
+
+def sync_observer_states(model, group=None):
+    '''
+    all-gathers the observer states (min/max and histograms) of all the ranks of the process group with a single 
+    collective and merges them with merge_observer_states (in rank order), so that every rank ends up with the same 
+    observer states and qparams. As with any collective, all the ranks must call this at the same point.
+    '''
+    import torch.distributed as dist
+    if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size(group) == 1:
+        return model
+    #
+    world_size = dist.get_world_size(group)
+    observers = get_observer_modules(model)
+    flat_state, layout = _pack_observer_states(get_observer_state(observers))
+    if dist.get_backend(group) == dist.Backend.GLOO:
+        flat_state = flat_state.cpu()
+    #
+    # the layout is the same in all the ranks, as the model is the same
+    gathered_states = [torch.empty_like(flat_state) for _ in range(world_size)]
+    dist.all_gather(gathered_states, flat_state, group=group)
+    merge_observer_states(observers, [_unpack_observer_states(flat, layout) for flat in gathered_states])
+    for observer in observers.values():
+        # the merged histogram has the counts of all the ranks, and it is now present in each of them 
+        # scale it down, so that the shared history is not counted once per rank again in the next sync
+        if isinstance(observer, torch.ao.quantization.HistogramObserver):
+            observer.histogram.div_(world_size)
+        #
+    #
+    update_fake_quant_qparams(model)
+    return model
+
+
+class ObserverSync():
+    '''
+    Synchronization of the observers across the ranks in multi-process (DDP) training. Used as a forward pre hook 
+    of the model, it syncs the observer states every interval training steps (interval=0: no periodic sync). 
+    is_synced tracks whether the observers were updated after the last sync, so that freeze() (and convert() with 
+    sync_observers=True) sync only when it is needed. The object is kept in __quant_params__.
+    '''
+    def __init__(self, interval=0, group=None):
+        self.interval = interval
+        self.group = group
+        self.num_steps = 0
+        self.is_synced = False
+        # the periodic sync is not needed when the observers are frozen
+        self.enabled = True
+
+    def __deepcopy__(self, memo):
+        # a process group can not be copied - the copies (eg. made in convert) share it
+        new_sync = copy.copy(self)
+        memo[id(self)] = new_sync
+        return new_sync
+
+    def sync(self, model):
+        sync_observer_states(model, group=self.group)
+        self.is_synced = True
+
+    def __call__(self, model, args):
+        if not (model.training and self.enabled):
+            return
+        #
+        if self.interval and self.num_steps > 0 and self.num_steps % self.interval == 0:
+            self.sync(model)
+        #
+        self.num_steps += 1
+        self.is_synced = False
+
+
+OBSERVER_STATS_FORMAT_VERSION = 2
+
+
+def _get_observer_graph_nodes(model):
+    # the observer/fake quantize modules are called from the graph by their top level name
+    return {node.target: node for node in model.graph.nodes if node.op == 'call_module'}
+
+
+def _get_observer_node_info(name, graph_nodes):
+    node = graph_nodes.get(name.split('.')[0], None)
+    if node is None:
+        return None, None
+    #
+    input_node = node.args[0] if len(node.args) > 0 and isinstance(node.args[0], Node) else None
+    return node.name, (input_node.name if input_node is not None else None)
+
+
+def _get_observer_config(observer):
+    # only plain python types are saved (the stats file is loaded with weights_only=True)
+    return dict(observer_type=type(observer).__name__, qscheme=str(getattr(observer, 'qscheme', None)),
+                dtype=str(getattr(observer, 'dtype', None)), ch_axis=getattr(observer, 'ch_axis', None))
+
+
+def _check_observer_state(name, observer, state):
+    # the saved statistics must have the shape of the observer state
+    # (per channel observers that have not seen any data have an empty state, only the rank is checked for these)
+    errors = []
+    for key, value in state.items():
+        current_value = getattr(observer, key, None)
+        if not isinstance(current_value, torch.Tensor):
+            errors.append(f"{name}: unexpected observer state {key}")
+        elif current_value.numel() > 0 and current_value.shape != value.shape:
+            errors.append(f"{name}: shape mismatch for {key} - expected {tuple(current_value.shape)}, got {tuple(value.shape)}")
+        elif current_value.dim() != value.dim():
+            errors.append(f"{name}: rank mismatch for {key} - expected {current_value.dim()}, got {value.dim()}")
+        #
+    #
+    return errors
+
+
+def save_observer_stats(model, filename):
+    observers = get_observer_modules(model)
+    observer_states = get_observer_state(observers)
+    graph_nodes = _get_observer_graph_nodes(model)
+    observer_stats = {}
+    for name, observer in observers.items():
+        node_name, input_node_name = _get_observer_node_info(name, graph_nodes)
+        try:
+            qparams = tuple(q.detach().cpu() for q in observer.calculate_qparams())
+        except Exception:
+            # an observer that has not seen any data can not compute the qparams
+            qparams = None
+        #
+        observer_stats[name] = dict(node_name=node_name, input_node_name=input_node_name,
+                                    state={k: v.cpu() for k, v in observer_states[name].items()}, qparams=qparams,
+                                    **_get_observer_config(observer))
+    #
+    torch.save(dict(format_version=OBSERVER_STATS_FORMAT_VERSION, torch_version=str(torch.__version__), observers=observer_stats), filename)
+
+
+def load_observer_stats(model, filename, strict=True):
+    '''
+    loads the observer statistics saved by save_observer_stats into a model that was prepared in the same way.
+    the graph node, observer type, qscheme, dtype and the shapes of the statistics are checked for every observer - 
+    with strict=False the mismatching observers are not loaded (with a warning) and the others are loaded.
+    '''
+    # the stats file contains only tensors and plain python types
+    data = torch.load(filename, map_location='cpu', weights_only=True)
+    if data.get('format_version', None) != OBSERVER_STATS_FORMAT_VERSION:
+        raise RuntimeError(f"unsupported observer stats format in {filename}")
+    #
+    observers = get_observer_modules(model)
+    graph_nodes = _get_observer_graph_nodes(model)
+    errors = []
+    missing = [name for name in observers if name not in data['observers']]
+    unexpected = [name for name in data['observers'] if name not in observers]
+    if missing or unexpected:
+        errors.append(f"observers missing in the stats: {missing}, unexpected observers in the stats: {unexpected}")
+    #
+    for name, observer_stats in data['observers'].items():
+        if name not in observers:
+            continue
+        #
+        observer = observers[name]
+        node_info = _get_observer_node_info(name, graph_nodes)
+        if node_info != (observer_stats['node_name'], observer_stats['input_node_name']):
+            errors.append(f"{name}: graph node mismatch - expected {(observer_stats['node_name'], observer_stats['input_node_name'])}, got {node_info}")
+            continue
+        #
+        observer_config = _get_observer_config(observer)
+        config_errors = [f"{name}: {key} mismatch - expected {value}, got {observer_stats[key]}" 
+                         for key, value in observer_config.items() if observer_stats[key] != value]
+        state = observer_stats['state']
+        state_errors = _check_observer_state(name, observer, state)
+        if config_errors or state_errors:
+            # statistics of a different observer (eg. min/max vs histogram, per tensor vs per channel) can not be used
+            errors.extend(config_errors + state_errors)
+            continue
+        #
+        load_observer_state(observer, state)
+    #
+    if errors:
+        message = "could not load the observer stats from {}:\n{}".format(filename, '\n'.join(errors))
+        if strict:
+            raise RuntimeError(message)
+        #
+        warnings.warn(message)
+    #
+    update_fake_quant_qparams(model)
+    return model
+
+
+def get_compile_stats():
+    # number of graph breaks and of the graphs compiled so far (more graphs than expected indicates recompiles)
+    from torch._dynamo.utils import counters
+    return dict(graph_breaks=sum(counters['graph_break'].values()), unique_graphs=counters['stats']['unique_graphs'],
+                calls_captured=counters['stats']['calls_captured'])
+
+
+def _get_dynamic_dims(axes):
+    # axes can be given in the onnx style {dim: name} or as a list of dims
+    return sorted(axes.keys()) if isinstance(axes, dict) else sorted(axes)
+
+
+def mark_dynamic_axes(example_inputs, example_kwargs, dynamic_axes):
+    # dynamic_axes: {input index or kwarg name: {dim: name} or [dims]} - e.g. {0: {0: 'batch', 2: 'height', 3: 'width'}}
+    # the marked dims are kept symbolic by torchdynamo.export, the other dims are specialized to the example inputs
+    # the given tensors are not modified, clones of the inputs are marked and returned (example_inputs, example_kwargs),
+    # along with the dynamic_axes keyed by the position of the input in the flattened (example_inputs, example_kwargs)
+    example_inputs = list(example_inputs) if isinstance(example_inputs, (list, tuple)) else [example_inputs]
+    example_kwargs = dict(example_kwargs)
+    input_keys = list(range(len(example_inputs))) + list(example_kwargs.keys())
+    flat_dynamic_axes = {}
+    for key, axes in dynamic_axes.items():
+        if isinstance(key, int) and key < len(example_inputs):
+            inp = example_inputs[key]
+        elif key in example_kwargs:
+            inp = example_kwargs[key]
+        else:
+            raise ValueError(f"dynamic_axes: could not find the input {key} in the example inputs / kwargs")
+        #
+        if not isinstance(inp, torch.Tensor):
+            raise ValueError(f"dynamic_axes: the input {key} is not a tensor")
+        #
+        inp = inp.clone()
+        for dim in _get_dynamic_dims(axes):
+            if inp.shape[dim] <= 1:
+                # dynamo specializes the dims of size 0 / 1
+                raise ValueError(f"dynamic_axes: the example input {key} must have size > 1 in the dynamic dim {dim}, got {inp.shape[dim]}")
+            #
+            torch._dynamo.mark_dynamic(inp, dim)
+        #
+        if isinstance(key, int) and key < len(example_inputs):
+            example_inputs[key] = inp
+        else:
+            example_kwargs[key] = inp
+        #
+        # the onnx inputs are the tensors of the flattened inputs, in the same order
+        input_index = input_keys.index(key)
+        flat_index = sum(_get_num_tensors(example_inputs[k] if isinstance(k, int) else example_kwargs[k]) for k in input_keys[:input_index])
+        flat_dynamic_axes[flat_index] = axes
+    #
+    return example_inputs, example_kwargs, flat_dynamic_axes
+
+
+def _get_num_tensors(inp):
+    return len([leaf for leaf in torch.utils._pytree.tree_leaves(inp) if isinstance(leaf, torch.Tensor)])
+
+
+def get_onnx_dynamic_axes(flat_dynamic_axes, input_names):
+    # convert the dynamic_axes from mark_dynamic_axes (keyed by the position in the flattened inputs)
+    # to the format of torch.onnx.export (keyed by the onnx input names)
+    onnx_dynamic_axes = {}
+    for flat_index, axes in flat_dynamic_axes.items():
+        if flat_index >= len(input_names):
+            warnings.warn(f"dynamic_axes: the input {flat_index} is not an input of the onnx model, it will be exported with static shape")
+            continue
+        #
+        name = input_names[flat_index]
+        onnx_dynamic_axes[name] = dict(axes) if isinstance(axes, dict) else {dim: f'{name}_dim{dim}' for dim in axes}
+    #
+    return onnx_dynamic_axes
@@ -53,6 +53,7 @@ from torch.ao.quantization.quantizer.quantizer import (
 # might move to torch/ao/quantization/utils.py later on
 # from torch.ao.quantization.pt2e.utils import _is_conv_or_conv_transpose_node
 # from torch.nn.utils.fusion import fuse_conv_bn_weights
+import dataclasses
 import itertools
 import operator
 from typing import Dict, List, Optional, Any
@@ -62,6 +63,7 @@ from torch.fx import Node, GraphModule
 from torch.fx.passes.utils.source_matcher_utils import get_source_partitions
 
 from . import qconfig_types
+from . import fake_quantize_types
 
 import warnings
 
@@ -114,6 +116,31 @@ def is_mlp_add_layer(node, find_level, found_linear=False, linear_node=None):
             break
     return is_mlp_add_layer(prev_node, find_level-1, found_linear, linear_node)
 
+def _is_tensor_node(node) -> bool:
+    # in a graph exported with dynamic shapes, sizes are computed by sym_size nodes and can be inputs of the arithmetic ops
+    # these symbolic int/float values must not be observed
+    return isinstance(node, Node) and not isinstance(node.meta.get('val', None), (torch.SymInt, torch.SymFloat, torch.SymBool, int, float, bool))
+
+def _weight_qspec_with_channel_len(weight_qspec, weight_node, gm=None):
+    # the learnable (LSQ) fake quantize needs the number of channels at construction for per channel quantization,
+    # so that its scale / zero_point parameters have the final shape before the optimizer is created
+    ctr = weight_qspec.observer_or_fake_quant_ctr
+    is_learnable = hasattr(ctr, "p") and isinstance(ctr.p.func, type) and \
+        issubclass(ctr.p.func, fake_quantize_types.LearnableFakeQuantize)
+    if not is_learnable or weight_qspec.qscheme not in (torch.per_channel_symmetric, torch.per_channel_affine):
+        return weight_qspec
+    #
+    weight_val = weight_node.meta.get('val', None)
+    if weight_val is None and gm is not None and weight_node.op == 'get_attr':
+        weight_val = getattr(gm, weight_node.target, None)
+    #
+    if not isinstance(weight_val, torch.Tensor):
+        return weight_qspec
+    #
+    channel_len = weight_val.shape[weight_qspec.ch_axis or 0]
+    return dataclasses.replace(weight_qspec, observer_or_fake_quant_ctr=ctr.with_args(channel_len=channel_len))
+
+
 def _derive_bias_qparams_fn(
         obs_or_fqs: List,
     ):
@@ -154,15 +181,54 @@ def _derived_bias_quant_spec(weight_node, input_act_node, curr_node) -> DerivedQ
             qscheme=torch.per_channel_symmetric,
         )
 
+
+class _AnnotationGraphIndex():
+    # index of the graph built in a single traversal, so that the annotation passes
+    # only visit the nodes / partitions they are interested in, instead of walking the whole graph each time
+    def __init__(self, gm: GraphModule, partition_types: List):
+        self.gm = gm
+        self.partition_types = partition_types
+        self.node_position = {}
+        self.nodes_by_target = {}
+        self.skip_nodes = []
+        for position, node in enumerate(gm.graph.nodes):
+            self.node_position[node] = position
+            if node.op == 'call_function':
+                self.nodes_by_target.setdefault(node.target, []).append(node)
+            if 'stack_trace' in node.meta and 'bbox_coder' in node.meta['stack_trace']:  #skipping the annotation for bbox coder in fcos3d
+                self.skip_nodes.append(node)
+            #
+        #
+        self._partitions = None
+
+    def get_nodes(self, targets: List) -> List[Node]:
+        # nodes with any of the given targets, in the order of the graph
+        nodes = [node for target in targets for node in self.nodes_by_target.get(target, [])]
+        if len(targets) > 1:
+            nodes.sort(key=self.node_position.__getitem__)
+        return nodes
+
+    def get_partitions(self, wanted_sources: List) -> Dict[Any, List]:
+        # a single get_source_partitions call for all the source types used by the annotation passes
+        if self._partitions is None:
+            self._partitions = get_source_partitions(self.gm.graph, self.partition_types)
+        return {source: partitions for source, partitions in self._partitions.items() if source in wanted_sources}
+
+    def invalidate_partitions(self):
+        # to be called if nodes are inserted in the graph, the partitions will be recomputed on next use
+        self._partitions = None
+
+
 class TIDLRTQuantizer(Quantizer):
 
-    def __init__(self, is_qat, fast_mode=False, is_fake_quantize=True, device=None):
+    def __init__(self, is_qat, fast_mode=False, is_fake_quantize=True, device=None, allow_16bit_node_list=None, compile_mode=False):
         super().__init__()
         self.global_config: QuantizationConfig = None  # type: ignore[assignment]
         self.operator_type_config: Dict[str, Optional[QuantizationConfig]] = {}
         self.is_qat = is_qat 
         self.fast_mode = fast_mode
         self.is_fake_quantize = is_fake_quantize
+        self.compile_mode = compile_mode
         self.single_input_single_output_shared_nodes = [torch.ops.aten.max_pool2d.default, 
                                                         torch.ops.aten.flatten.using_ints, 
                                                         torch.ops.aten.slice.Tensor,
@@ -182,6 +248,16 @@ class TIDLRTQuantizer(Quantizer):
             self.device = device
         else:
             self.device = torch.device('cuda:0')
+        # names of the conv/linear/matmul nodes that are to be quantized with 16 bits (for example from mixed_precision.get_16bit_node_list)
+        self.allow_16bit_node_list = list(allow_16bit_node_list or [])
+        self._config_16bit = None
+        # source types for which the partitions are found by the annotation passes
+        self.conv_partition_types = [torch.nn.Conv2d, torch.nn.functional.conv2d]
+        self.linear_partition_types = [torch.nn.Linear, torch.nn.functional.linear]
+        self.matmul_partition_types = [torch.matmul, torch.bmm, operator.matmul]
+        self.layernorm_partition_types = [torch.nn.LayerNorm, torch.nn.functional.layer_norm]
+        self.cat_partition_types = [torch.cat]
+        self._graph_index = None
 
     def set_global(self, quantization_config: QuantizationConfig):
         """set global QuantizationConfig used for the backend.
@@ -195,17 +271,19 @@ class TIDLRTQuantizer(Quantizer):
         to convey the desired way of quantization.
         """
         global_config = self.global_config
-        self.annotate_config(model, global_config)
+        self.annotate_config(model, global_config, self.allow_16bit_node_list)
 
         return model
 
     def annotate_config(
         self, model: torch.fx.GraphModule, config: QuantizationConfig, allow_16bit_node_list: list = []
     ) -> torch.fx.GraphModule:
-        # allow_16bit_node_list : TODO
+        # allow_16bit_node_list : names of the conv/linear/matmul nodes to be quantized with 16 bits
         # quantize the weight of that layer as well as the output to 16 bit, however, input is still 8 bit quantized
         # further, the quantization also flows, which means, if the input is 16 bit, then weights will also be in 16 bit
         # but the output will be in 8 bit
+        # the graph is indexed once and all the passes below use that index, the order of the passes is retained
+        self._graph_index = _AnnotationGraphIndex(model, self._get_partition_types())
         self._skip_annotation(model, config)
         self._annotate_deformconv2d(model, config)
         self._annotate_layernorm(model, config) # the weights and bias also need to be quantized, first so not to quantize nodes internally which might happen later on
@@ -213,22 +291,43 @@ class TIDLRTQuantizer(Quantizer):
         self._annotate_two_inputs_single_output(model, config)
         self._annotate_cat(model, config)
         self._annotate_view(model, config) # view possible in loss which creates issues, mostly it needs to be quantized to support bias quantization.
-        self._annotate_matmul(model, config)
+        self._annotate_matmul(model, config, allow_16bit_node_list)
         self._annotate_conv2d(model, config, allow_16bit_node_list)
         self._annotate_linear(model, config, allow_16bit_node_list)
         self._annotate_single_input_single_output_shared(model, config) # reshape in weight of conv avoided quantization by moving this to last
         # self._transfer_model_to_device(model)
+        self._graph_index = None
         return model
 
+    def _get_partition_types(self):
+        return self.layernorm_partition_types + self.cat_partition_types + self.matmul_partition_types + \
+            self.conv_partition_types + self.linear_partition_types
+
+    def _get_graph_index(self, gm):
+        # the passes can also be called individually, in which case the index is built for that pass
+        if self._graph_index is None or self._graph_index.gm is not gm:
+            return _AnnotationGraphIndex(gm, self._get_partition_types())
+        return self._graph_index
+
+
+    def _get_node_config(self, node, quantization_config, allow_16bit_node_list):
+        # the weight and output of the nodes in allow_16bit_node_list use the 16 bit config
+        if node is None or node.name not in (allow_16bit_node_list or []):
+            return quantization_config
+        #
+        if self._config_16bit is None:
+            self._config_16bit = qconfig_types.get_qconfig(qconfig_types.QConfigType.WC16_AT16, 
+                                                           is_fake_quantize=self.is_fake_quantize, fast_mode=self.fast_mode, compile_mode=self.compile_mode)
+        #
+        return self._config_16bit
 
     def _skip_annotation(
         self, gm: torch.fx.GraphModule, quantization_config: QuantizationConfig
     ) -> None:
-        for node in gm.graph.nodes:
-            if 'stack_trace' in node.meta and 'bbox_coder' in node.meta['stack_trace']:  #skipping the annotation for bbox coder in fcos3d
-                node.meta["quantization_annotation"] = QuantizationAnnotation(  # type: ignore[union-attr]
-                    _annotated=True,
-                )
+        for node in self._get_graph_index(gm).skip_nodes:
+            node.meta["quantization_annotation"] = QuantizationAnnotation(  # type: ignore[union-attr]
+                _annotated=True,
+            )
 
     def _annotate_deformconv2d(
         self, gm: torch.fx.GraphModule, quantization_config: QuantizationConfig
@@ -239,7 +338,7 @@ class TIDLRTQuantizer(Quantizer):
     def _annotate_single_input_single_output_shared(
         self, gm: torch.fx.GraphModule, quantization_config: QuantizationConfig
     ) -> None:
-        for node in gm.graph.nodes:
+        for node in self._get_graph_index(gm).get_nodes(self.single_input_single_output_shared_nodes):
             # skip annotation if it is already annotated
             if _is_annotated([node]):
                 continue
@@ -259,7 +358,7 @@ class TIDLRTQuantizer(Quantizer):
     def _annotate_single_input_single_output_different(
         self, gm: torch.fx.GraphModule, quantization_config: QuantizationConfig
     ) -> None:
-        for node in gm.graph.nodes:
+        for node in self._get_graph_index(gm).get_nodes(self.single_input_single_output_different_nodes):
             # skip annotation if it is already annotated
             if _is_annotated([node]):
                 continue
@@ -279,9 +378,7 @@ class TIDLRTQuantizer(Quantizer):
     def _annotate_conv2d(
         self, gm: torch.fx.GraphModule, quantization_config: QuantizationConfig, allow_16bit_node_list: list
     ) -> None:
-        conv_partitions = get_source_partitions(
-            gm.graph, [torch.nn.Conv2d, torch.nn.functional.conv2d]
-        )
+        conv_partitions = self._get_graph_index(gm).get_partitions(self.conv_partition_types)
         conv_partitions = list(itertools.chain(*conv_partitions.values()))
         for conv_partition in conv_partitions:
             if len(conv_partition.output_nodes) > 1:
@@ -296,6 +393,7 @@ class TIDLRTQuantizer(Quantizer):
             if _is_annotated([conv_node]):
                 continue
 
+            node_config = self._get_node_config(conv_node, quantization_config, allow_16bit_node_list)
             input_qspec_map = {}
             input_act = conv_node.args[0]
             assert isinstance(input_act, Node)
@@ -303,7 +401,7 @@ class TIDLRTQuantizer(Quantizer):
 
             weight = conv_node.args[1]
             assert isinstance(weight, Node)
-            input_qspec_map[weight] = get_weight_qspec(quantization_config)
+            input_qspec_map[weight] = _weight_qspec_with_channel_len(get_weight_qspec(node_config), weight, gm)
 
             # if reshape in weight node, add annotated flag to that node so other annototaion does not change it
             if weight.target == torch.ops.aten.reshape.default:
@@ -326,7 +424,7 @@ class TIDLRTQuantizer(Quantizer):
             if output_node is conv_node:
                 output_node.meta["quantization_annotation"] = QuantizationAnnotation(
                     input_qspec_map=input_qspec_map,
-                    output_qspec=get_output_act_qspec(quantization_config),
+                    output_qspec=get_output_act_qspec(node_config),
                     _annotated=True,
                 )
             else:
@@ -335,18 +433,15 @@ class TIDLRTQuantizer(Quantizer):
                     _annotated=True,
                 )
                 output_node.meta["quantization_annotation"] = QuantizationAnnotation(
-                    output_qspec=get_output_act_qspec(quantization_config),
+                    output_qspec=get_output_act_qspec(node_config),
                     _annotated=True,
                 )
         
     def _annotate_linear(
         self, gm: torch.fx.GraphModule, quantization_config: QuantizationConfig, allow_16bit_node_list: list
     ) -> None:
-        module_partitions = get_source_partitions(
-            gm.graph, [torch.nn.Linear, torch.nn.functional.linear]
-        )
+        module_partitions = self._get_graph_index(gm).get_partitions(self.linear_partition_types)
         act_qspec = get_input_act_qspec(quantization_config)
-        weight_qspec = get_weight_qspec(quantization_config)
         for module_or_fn_type, partitions in module_partitions.items():
             if module_or_fn_type == torch.nn.Linear:
                 for p in partitions:
@@ -362,6 +457,9 @@ class TIDLRTQuantizer(Quantizer):
                             bias_node = node
                     if weight_node is None:
                         raise ValueError("No weight found in Linear pattern")
+                    node_config = self._get_node_config(output_node, quantization_config, allow_16bit_node_list)
+                    node_weight_qspec = _weight_qspec_with_channel_len(get_weight_qspec(node_config), weight_node, gm)
+                    node_output_qspec = get_input_act_qspec(node_config)
                     # find use of act node within the matched pattern
                     act_use_node = None
                     for node in p.nodes:
@@ -379,9 +477,9 @@ class TIDLRTQuantizer(Quantizer):
                             act_qspec,
                         )
                     if _is_annotated([weight_node]) is False:  # type: ignore[list-item]
-                        _annotate_output_qspec(weight_node, weight_qspec)
+                        _annotate_output_qspec(weight_node, node_weight_qspec)
                     if _is_annotated([output_node]) is False:
-                        _annotate_output_qspec(output_node, act_qspec)
+                        _annotate_output_qspec(output_node, node_output_qspec)
                     if bias_node and _is_annotated([bias_node]) is False:
                         if _is_annotated([act_node]):
                             bias_qspec = _derived_bias_quant_spec(weight_node, act_node, None)
@@ -395,7 +493,7 @@ class TIDLRTQuantizer(Quantizer):
     def _annotate_view(
         self, gm: torch.fx.GraphModule, quantization_config: QuantizationConfig
     ) -> None:
-        for node in gm.graph.nodes:
+        for node in self._get_graph_index(gm).get_nodes([torch.ops.aten.view.default]):
             # skip annotation if it is already annotated
             if _is_annotated([node]):
                 continue
@@ -412,11 +510,9 @@ class TIDLRTQuantizer(Quantizer):
             )
 
     def _annotate_matmul(
-        self, gm: torch.fx.GraphModule, quantization_config: QuantizationConfig
+        self, gm: torch.fx.GraphModule, quantization_config: QuantizationConfig, allow_16bit_node_list: list = []
     ) -> None:
-        module_partitions = get_source_partitions(
-            gm.graph, [torch.matmul, torch.bmm, operator.matmul]
-        )
+        module_partitions = self._get_graph_index(gm).get_partitions(self.matmul_partition_types)
         # TODO take care of the bias term from bmm
         matmul_partitions = list(itertools.chain(*module_partitions.values()))
         for matmul_partition in matmul_partitions:
@@ -435,14 +531,21 @@ class TIDLRTQuantizer(Quantizer):
                 observer = act_qspec.observer_or_fake_quant_ctr.p.keywords['observer']
             else:
                 observer = act_qspec.observer_or_fake_quant_ctr
+            learnable_scale = hasattr(act_qspec.observer_or_fake_quant_ctr, "p") and \
+                isinstance(act_qspec.observer_or_fake_quant_ctr.p.func, type) and \
+                issubclass(act_qspec.observer_or_fake_quant_ctr.p.func, fake_quantize_types.LearnableFakeQuantize)
             act_qspec_symmetric = qconfig_types.get_act_quantization_config(
                 dict(
                     qscheme=torch.per_tensor_symmetric, 
                     power2_scale=observer.__init__._partialmethod.keywords['power2_scale'], 
-                    range_shrink_percentile=observer.__init__._partialmethod.keywords['range_shrink_percentile']
+                    range_shrink_percentile=observer.__init__._partialmethod.keywords['range_shrink_percentile'],
+                    batched_search=observer.__init__._partialmethod.keywords.get('batched_search', False),
+                    sample_budget=observer.__init__._partialmethod.keywords.get('sample_budget', None),
+                    learnable_scale=learnable_scale
                 ),
                 is_fake_quantize=self.is_fake_quantize,
-                fast_mode=self.fast_mode
+                fast_mode=self.fast_mode,
+                compile_mode=self.compile_mode
             )
 
             input_act0 = matmul_node.args[0]  # type: ignore[union-attr]
@@ -466,16 +569,14 @@ class TIDLRTQuantizer(Quantizer):
                     input_act0: input_act0_spec,
                     input_act1: input_act1_spec,
                 },
-                output_qspec=get_output_act_qspec(quantization_config),
+                output_qspec=get_output_act_qspec(self._get_node_config(matmul_node, quantization_config, allow_16bit_node_list)),
                 _annotated=True,
             )
             
     def _annotate_layernorm(
         self, gm: torch.fx.GraphModule, quantization_config: QuantizationConfig
     ) -> None:
-        module_partitions = get_source_partitions(
-            gm.graph, [torch.nn.LayerNorm, torch.nn.functional.layer_norm]
-        )
+        module_partitions = self._get_graph_index(gm).get_partitions(self.layernorm_partition_types)
         layernorm_partitions = list(itertools.chain(*module_partitions.values()))
         for layernorm_partition in layernorm_partitions:
             output_node = layernorm_partition.output_nodes[0]
@@ -522,7 +623,9 @@ class TIDLRTQuantizer(Quantizer):
     def _annotate_two_inputs_single_output(
         self, gm: GraphModule, quantization_config: QuantizationConfig
     ) -> None: 
-        for node in gm.graph.nodes:
+        graph_index = self._get_graph_index(gm)
+        two_input_nodes = graph_index.get_nodes(self.two_inputs_single_output_nodes)
+        for node in two_input_nodes:
             if _is_annotated([node]):
                 continue
             if node.target in self.two_inputs_single_output_nodes:
@@ -534,22 +637,21 @@ class TIDLRTQuantizer(Quantizer):
                             t_name = f'{node.name}_inp_{i}'
                             gm.register_buffer(t_name, t, persistent=True)
                             args[i] = gm.graph.get_attr(t_name)
+                            graph_index.invalidate_partitions()
                 node.args = tuple(args)
         gm.graph.lint()
         gm.recompile()
         
-        for node in gm.graph.nodes:
+        for node in two_input_nodes:
             # skip annotation if it is already annotated
             if _is_annotated([node]):
                 continue
             if node.target in self.two_inputs_single_output_nodes:
-                input_act1 = node.args[0]
-                input_act2 = node.args[1]
+                input_acts = [input_act for input_act in node.args[:2] if _is_tensor_node(input_act)]
+                if not input_acts:
+                    continue
                 node.meta["quantization_annotation"] = QuantizationAnnotation(  # type: ignore[union-attr]
-                    input_qspec_map={
-                        input_act1: get_input_act_qspec(quantization_config),
-                        input_act2: get_input_act_qspec(quantization_config),
-                    },
+                    input_qspec_map={input_act: get_input_act_qspec(quantization_config) for input_act in input_acts},
                     output_qspec=get_output_act_qspec(quantization_config),
                     _annotated=True,
                 )
@@ -557,9 +659,7 @@ class TIDLRTQuantizer(Quantizer):
     def _annotate_cat(
         self, gm: torch.fx.GraphModule, quantization_config: Optional[QuantizationConfig]
     ) -> None:
-        cat_partitions = get_source_partitions(
-            gm.graph, [torch.cat]
-        )
+        cat_partitions = self._get_graph_index(gm).get_partitions(self.cat_partition_types)
         cat_partitions = list(itertools.chain(*cat_partitions.values()))
         for cat_partition in cat_partitions:
             cat_node = cat_partition.output_nodes[0] if len(cat_partition.output_nodes) > 0 else cat_partition.nodes[0]
@@ -6,3 +6,4 @@ from .model_optimzation_v2 import ModelOptimizationWrapperV2
 from .model_optimzation_v3 import ModelOptimizationWrapperV3
 from .transformation_dict import get_transformation_for_model
 from .hooks import add_example_args_kwargs
+from .model_retention import ModelRetention, RetainedModel, retain_model, get_retained_model, get_rss_mb
@@ -0,0 +1,163 @@
+import os
+import pickle
+import tempfile
+import torch
+from torch import nn
+from copy import copy, deepcopy
+
+
+class ModelRetention:
+    '''
+    How the float model is kept by quant init. With MMAP and NONE there is no copy of the float model in memory 
+    in addition to the prepared model. The model given to init is not modified, unless init is called with inplace=True - 
+    then the given model is exported directly (without a copy) and QAT trains its weights in place.
+    '''
+    MEMORY = "MEMORY"   # keep a deepcopy of the float model in memory (default)
+    MMAP = "MMAP"       # spill the float model to a file and memory map it lazily when it is needed
+    NONE = "NONE"       # do not keep the float model
+
+    @classmethod
+    def choices(cls):
+        return [value for value in dir(cls) if not value.startswith('__') and value != 'choices']
+
+
+class RetainedModel():
+    '''
+    A float model that has been spilled to disk. The model is loaded with mmap only when get() is called,
+    so the weights are backed by the page cache and do not add to the resident memory until they are used.
+    The spilled file is shared by the copies of this object (deepcopy / pickle) and is removed when the last copy 
+    in the process that created it is released - copies in other processes (eg. the calibration workers) never remove it.
+    If the model can not be pickled (eg. it has lambdas or local classes), only its state_dict is spilled and the 
+    structure of the model is kept with the weights on the meta device (available only in the process that created it).
+    '''
+    # number of live RetainedModel objects for each spilled file, in this process
+    _file_refs = {}
+
+    def __init__(self, model, retention_dir=None):
+        fd, self.filename = tempfile.mkstemp(suffix='.pt', prefix='retained_model_', dir=retention_dir)
+        os.close(fd)
+        try:
+            torch.save(model, self.filename)
+            self.skeleton = None
+        except (pickle.PicklingError, AttributeError, TypeError):
+            torch.save(model.state_dict(), self.filename)
+            self.skeleton = _get_meta_copy(model)
+        #
+        self.weights_only = (self.skeleton is not None)
+        self.device = next(iter(model.parameters()), torch.empty(0)).device
+        self.model = None
+        self.owner_pid = os.getpid()
+        self._add_ref()
+
+    def _add_ref(self):
+        file_refs = type(self)._file_refs
+        file_refs[self.filename] = file_refs.get(self.filename, 0) + 1
+
+    def get(self):
+        if self.model is None:
+            if self.weights_only:
+                if self.skeleton is None:
+                    raise RuntimeError("the model could not be pickled when it was retained - "
+                                       "it is available only in the process that retained it")
+                #
+                model = deepcopy(self.skeleton)
+                model.load_state_dict(_load(self.filename, weights_only=True), assign=True)
+            else:
+                model = _load(self.filename, weights_only=False)
+            #
+            self.model = model.to(device=self.device)
+        #
+        return self.model
+
+    def release(self):
+        # drop the rehydrated model, it will be loaded again in the next call to get()
+        self.model = None
+
+    def __deepcopy__(self, memo):
+        # the spilled file is read-only, so the copies can share it - the rehydrated model is not copied
+        new_model = copy(self)
+        new_model.model = None
+        new_model._add_ref()
+        memo[id(self)] = new_model
+        return new_model
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['model'] = None
+        # the structure of the model could not be pickled when it was retained (weights_only)
+        state['skeleton'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._add_ref()
+
+    def __del__(self):
+        filename = getattr(self, 'filename', None)
+        file_refs = type(self)._file_refs
+        if filename is None or filename not in file_refs:
+            return
+        #
+        file_refs[filename] -= 1
+        if file_refs[filename] <= 0:
+            del file_refs[filename]
+            if self.owner_pid == os.getpid() and os.path.exists(filename):
+                os.remove(filename)
+            #
+        #
+
+
+def retain_model(model, model_retention=ModelRetention.MEMORY, retention_dir=None):
+    if model_retention == ModelRetention.MEMORY:
+        return deepcopy(model)
+    elif model_retention == ModelRetention.MMAP:
+        return RetainedModel(model, retention_dir=retention_dir)
+    elif model_retention in (ModelRetention.NONE, None):
+        return None
+    else:
+        raise RuntimeError(f"Unknown model_retention: {model_retention}, choices are {ModelRetention.choices()}")
+
+
+def get_retained_model(retained_model):
+    if isinstance(retained_model, RetainedModel):
+        return retained_model.get()
+    #
+    return retained_model
+
+
+def get_rss_mb():
+    '''
+    current resident memory of the process in MB (unlike the peak from getrusage, this also goes down when memory is released)
+    '''
+    try:
+        with open('/proc/self/statm') as fp:
+            resident_pages = int(fp.read().split()[1])
+        #
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        pass
+    #
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    except ImportError:
+        return None
+
+
+def _load(filename, weights_only):
+    try:
+        return torch.load(filename, map_location='cpu', mmap=True, weights_only=weights_only)
+    except TypeError:
+        # older versions of torch do not support mmap
+        return torch.load(filename, map_location='cpu')
+
+
+def _get_meta_copy(model):
+    # copy of the model with the tensors of the state_dict on the meta device - the deepcopy picks them up from the memo
+    memo = {}
+    for tensor in model.state_dict(keep_vars=True).values():
+        meta_tensor = torch.empty_like(tensor, device='meta')
+        memo[id(tensor)] = nn.Parameter(meta_tensor, requires_grad=tensor.requires_grad) \
+            if isinstance(tensor, nn.Parameter) else meta_tensor
+    #
+    return deepcopy(model, memo)
@@ -4,6 +4,8 @@ import types
 import warnings
 from copy import deepcopy
 
+from .model_retention import ModelRetention, retain_model
+
 
 def add_attrs(self, attrs, src):
     if isinstance(src, type):
@@ -38,7 +40,8 @@ class OptimizationBaseModule(nn.Module):
     def __init__(self, model, *args, transformation_dict=None, copy_attrs=None, **kwargs):
         copy_attrs = copy_attrs or []
         super().__init__()
-        self._orig_module = deepcopy(model)
+        # with ModelRetention.MMAP, _orig_module is a RetainedModel - use get_retained_model() to access it
+        self._orig_module = retain_model(model, kwargs.get('model_retention', ModelRetention.MEMORY), kwargs.get('retention_dir', None))
         self.module = model
         self.transformation_dict = transformation_dict
         add_attrs(self, copy_attrs, self.module)
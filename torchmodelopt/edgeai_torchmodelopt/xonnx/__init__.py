@@ -35,4 +35,5 @@ except:
     pass
     
 from .rename_onnx_layers import *
+from .optimize_qdq import optimize_qdq_model
 
@@ -0,0 +1,406 @@
+#################################################################################
+# Copyright (c) 2018-2023, Texas Instruments Incorporated - http://www.ti.com
+# All Rights Reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#################################################################################
+
+
+import hashlib
+import numpy as np
+import onnx
+from onnx import helper, numpy_helper, shape_inference
+
+
+QDQ_DATA_MOVEMENT_OPS = ('Reshape', 'Transpose', 'Squeeze', 'Unsqueeze', 'Flatten')
+
+# assumed memory bandwidth for the estimate of the latency saving - QDQ and data movement nodes are memory bound
+DEFAULT_BANDWIDTH_GBPS = 10.0
+
+
+def _get_constants(graph):
+    constants = {init.name: init for init in graph.initializer}
+    for node in graph.node:
+        if node.op_type == 'Constant' and len(node.attribute) > 0 and node.attribute[0].name == 'value':
+            constants[node.output[0]] = node.attribute[0].t
+        #
+    #
+    return constants
+
+
+def _get_subgraphs(node):
+    # the body graphs of the control flow nodes (If/Loop/Scan)
+    for attr in node.attribute:
+        if attr.type == onnx.AttributeProto.GRAPH:
+            yield attr.g
+        elif attr.type == onnx.AttributeProto.GRAPHS:
+            yield from attr.graphs
+        #
+    #
+
+
+def _iter_nodes(graph):
+    # the nodes of the graph and of all the nested subgraphs
+    for node in graph.node:
+        yield node
+        for subgraph in _get_subgraphs(node):
+            yield from _iter_nodes(subgraph)
+        #
+    #
+
+
+def _get_used_names(graph):
+    # names used in the graph, including the outer scope names used in the subgraphs
+    used_names = set(output.name for output in graph.output)
+    for node in _iter_nodes(graph):
+        used_names.update(node.input)
+        for subgraph in _get_subgraphs(node):
+            used_names.update(output.name for output in subgraph.output)
+        #
+    #
+    return used_names
+
+
+def _get_consumers(graph):
+    # a node with subgraphs is also a consumer of the outer scope names used in its subgraphs
+    consumers = {}
+    for node in graph.node:
+        names = set(node.input)
+        for subgraph in _get_subgraphs(node):
+            names.update(_get_used_names(subgraph))
+        #
+        for name in names:
+            consumers.setdefault(name, []).append(node)
+        #
+    #
+    return consumers
+
+
+def _get_elem_types(model):
+    # element type of the tensors, from shape inference and the initializers
+    elem_types = {init.name: init.data_type for init in model.graph.initializer}
+    try:
+        inferred_model = shape_inference.infer_shapes(model)
+    except Exception:
+        inferred_model = model
+    #
+    for value_info in list(inferred_model.graph.value_info) + list(inferred_model.graph.input) + list(inferred_model.graph.output):
+        if value_info.type.tensor_type.elem_type:
+            elem_types.setdefault(value_info.name, value_info.type.tensor_type.elem_type)
+        #
+    #
+    return elem_types
+
+
+def _get_attribute(node, name, default=None):
+    for attr in node.attribute:
+        if attr.name == name:
+            return helper.get_attribute_value(attr)
+        #
+    #
+    return default
+
+
+def _is_same_constant(constants, name1, name2):
+    if name1 == name2:
+        return True
+    elif name1 not in constants or name2 not in constants:
+        return False
+    #
+    tensor1, tensor2 = numpy_helper.to_array(constants[name1]), numpy_helper.to_array(constants[name2])
+    return tensor1.dtype == tensor2.dtype and tensor1.shape == tensor2.shape and np.array_equal(tensor1, tensor2)
+
+
+def _is_same_qparams(constants, dq_node, q_node, elem_types):
+    # scale, zero_point (optional) and axis of a DequantizeLinear and a QuantizeLinear node are the same
+    if _get_attribute(dq_node, 'axis', 1) != _get_attribute(q_node, 'axis', 1):
+        return False
+    if not _is_same_constant(constants, dq_node.input[1], q_node.input[1]):
+        return False
+    dq_zero_point = dq_node.input[2] if len(dq_node.input) > 2 else ''
+    q_zero_point = q_node.input[2] if len(q_node.input) > 2 else ''
+    if dq_zero_point == '' or q_zero_point == '':
+        # a missing zero_point is 0 of the DQ input type, but the Q output is uint8 (or output_dtype) 
+        # - equal only if both are missing and the types match
+        q_output_type = _get_attribute(q_node, 'output_dtype', 0) or onnx.TensorProto.UINT8
+        return dq_zero_point == q_zero_point and elem_types.get(dq_node.input[0], None) == q_output_type
+    #
+    return _is_same_constant(constants, dq_zero_point, q_zero_point)
+
+
+def _is_per_tensor(constants, node):
+    # the data movement ops can change the channel axis - only per tensor parameters can be moved across them
+    return node.input[1] in constants and numpy_helper.to_array(constants[node.input[1]]).size == 1
+
+
+def _replace_input_names(graph, rename):
+    # the outer scope names can be used in the subgraphs (names can not be shadowed in onnx)
+    # rename can have chains (a -> b, b -> c) from the folds in the same pass, these are followed to the end
+    for node in _iter_nodes(graph):
+        for index, name in enumerate(node.input):
+            if name in rename:
+                while name in rename:
+                    name = rename[name]
+                #
+                node.input[index] = name
+            #
+        #
+    #
+
+
+def deduplicate_initializers(model):
+    '''
+    Removes the initializers that have the same dtype, shape and data as an earlier one (for example the constant scales
+    and zero_points of the QDQ nodes) and points their uses to the first one. Returns the number of initializers removed.
+    '''
+    graph = model.graph
+    graph_input_names = set(graph_input.name for graph_input in graph.input)
+    unique_initializers = {}
+    rename = {}
+    for init in graph.initializer:
+        if init.name in graph_input_names:
+            # initializers that are also graph inputs can be overridden, do not merge them
+            continue
+        #
+        key = (init.data_type, tuple(init.dims), hashlib.sha1(numpy_helper.to_array(init).tobytes()).hexdigest())
+        if key in unique_initializers:
+            rename[init.name] = unique_initializers[key]
+        else:
+            unique_initializers[key] = init.name
+        #
+    #
+    if len(rename) == 0:
+        return 0
+    #
+    for node in _iter_nodes(graph):
+        for index, name in enumerate(node.input):
+            if name in rename:
+                node.input[index] = rename[name]
+            #
+        #
+    #
+    kept_initializers = [init for init in graph.initializer if init.name not in rename]
+    del graph.initializer[:]
+    graph.initializer.extend(kept_initializers)
+    return len(rename)
+
+
+def fold_redundant_qdq(model):
+    '''
+    Folds DequantizeLinear -> QuantizeLinear pairs with identical parameters (the output of the QuantizeLinear is the input 
+    of the DequantizeLinear) and DequantizeLinear -> Reshape/Transpose/... -> QuantizeLinear chains with identical parameters 
+    (the data movement op is done directly on the quantized tensor). Returns the removed nodes.
+    All the candidates are folded in one pass over the graph (the renames and node removals are applied once at the end 
+    of the pass), the passes are repeated only for the chains that become foldable after a pass.
+    '''
+    graph = model.graph
+    constants = _get_constants(graph)
+    elem_types = _get_elem_types(model)
+    graph_output_names = set(output.name for output in graph.output)
+    removed_nodes = []
+    changed = True
+    while changed:
+        changed = False
+        consumers = _get_consumers(graph)
+        num_consumers = {name: len(nodes) for name, nodes in consumers.items()}
+        producers = {output: node for node in graph.node for output in node.output}
+        rename = {}
+        # the nodes removed or modified in this pass (by id, the protobuf messages are not hashable)
+        removed_ids = set()
+        touched_ids = set()
+
+        def _release_dq(dq_node):
+            # one consumer less for the DQ output, the DQ is removed when it has no consumers left
+            num_consumers[dq_node.output[0]] -= 1
+            if num_consumers[dq_node.output[0]] == 0 and dq_node.output[0] not in graph_output_names:
+                removed_ids.add(id(dq_node))
+                removed_nodes.append(dq_node)
+            #
+
+        for q_node in graph.node:
+            if q_node.op_type != 'QuantizeLinear' or q_node.output[0] in graph_output_names:
+                continue
+            #
+            prev_node = producers.get(q_node.input[0], None)
+            if prev_node is None or id(prev_node) in removed_ids or id(prev_node) in touched_ids:
+                continue
+            elif prev_node.op_type == 'DequantizeLinear' and _is_same_qparams(constants, prev_node, q_node, elem_types):
+                # DQ -> Q: the Q output is the same as the DQ input
+                rename[q_node.output[0]] = prev_node.input[0]
+                removed_ids.add(id(q_node))
+                removed_nodes.append(q_node)
+                _release_dq(prev_node)
+                changed = True
+            elif prev_node.op_type in QDQ_DATA_MOVEMENT_OPS and num_consumers.get(prev_node.output[0], 0) == 1 \
+                    and prev_node.output[0] not in graph_output_names:
+                dq_node = producers.get(prev_node.input[0], None)
+                if dq_node is None or dq_node.op_type != 'DequantizeLinear' or id(dq_node) in removed_ids \
+                        or not _is_per_tensor(constants, dq_node) or not _is_same_qparams(constants, dq_node, q_node, elem_types):
+                    continue
+                #
+                # DQ -> Reshape -> Q: reshape the quantized tensor (per tensor quantization only)
+                prev_node.input[0] = dq_node.input[0]
+                prev_node.output[0] = q_node.output[0]
+                touched_ids.add(id(prev_node))
+                removed_ids.add(id(q_node))
+                removed_nodes.append(q_node)
+                _release_dq(dq_node)
+                changed = True
+            #
+        #
+        if changed:
+            kept_nodes = [node for node in graph.node if id(node) not in removed_ids]
+            del graph.node[:]
+            graph.node.extend(kept_nodes)
+            _replace_input_names(graph, rename)
+        #
+    #
+    return removed_nodes
+
+
+def remove_unused_initializers(model):
+    graph = model.graph
+    used_names = _get_used_names(graph)
+    kept_initializers = [init for init in graph.initializer if init.name in used_names]
+    num_removed = len(graph.initializer) - len(kept_initializers)
+    del graph.initializer[:]
+    graph.initializer.extend(kept_initializers)
+    return num_removed
+
+
+def _get_num_elements(model):
+    # number of elements of the intermediate tensors, from shape inference (0 for unknown shapes)
+    num_elements = {}
+    try:
+        inferred_model = shape_inference.infer_shapes(model)
+    except Exception:
+        return num_elements
+    #
+    for value_info in list(inferred_model.graph.value_info) + list(inferred_model.graph.input) + list(inferred_model.graph.output):
+        dims = value_info.type.tensor_type.shape.dim
+        if len(dims) > 0 and all(dim.HasField('dim_value') for dim in dims):
+            num_elements[value_info.name] = int(np.prod([dim.dim_value for dim in dims]))
+        #
+    #
+    return num_elements
+
+
+def get_random_inputs(model, seed=0):
+    # random inputs for the graph inputs (that are not initializers), symbolic dims are taken as 1
+    rng = np.random.default_rng(seed)
+    initializer_names = set(init.name for init in model.graph.initializer)
+    inputs = {}
+    for graph_input in model.graph.input:
+        if graph_input.name in initializer_names:
+            continue
+        #
+        tensor_type = graph_input.type.tensor_type
+        shape = [dim.dim_value if dim.HasField('dim_value') else 1 for dim in tensor_type.shape.dim]
+        dtype = helper.tensor_dtype_to_np_dtype(tensor_type.elem_type)
+        if np.issubdtype(dtype, np.floating):
+            inputs[graph_input.name] = rng.standard_normal(shape).astype(dtype)
+        else:
+            inputs[graph_input.name] = rng.integers(0, 2, size=shape).astype(dtype)
+        #
+    #
+    return inputs
+
+
+def validate_models(model1, model2, num_runs=1, atol=0.0):
+    '''
+    Runs both the models with onnxruntime on the same random inputs and returns the maximum absolute difference 
+    of the outputs and whether it is within atol
+    '''
+    import onnxruntime as ort
+    try:
+        session1 = ort.InferenceSession(model1.SerializeToString(), providers=['CPUExecutionProvider'])
+        session2 = ort.InferenceSession(model2.SerializeToString(), providers=['CPUExecutionProvider'])
+    except Exception as e:
+        # for example an invalid graph after the optimization - reported as a validation failure
+        print(f"QDQ optimization: onnxruntime could not create the session for validation: {e}")
+        return False, float('inf')
+    #
+    max_abs_diff = 0.0
+    for run_index in range(num_runs):
+        inputs = get_random_inputs(model1, seed=run_index)
+        try:
+            outputs1 = session1.run(None, inputs)
+            outputs2 = session2.run(None, inputs)
+        except Exception as e:
+            print(f"QDQ optimization: onnxruntime failed to run the models for validation: {e}")
+            return False, float('inf')
+        #
+        for output1, output2 in zip(outputs1, outputs2):
+            max_abs_diff = max(max_abs_diff, float(np.max(np.abs(output1.astype(np.float64) - output2.astype(np.float64)))) 
+                               if output1.size > 0 else 0.0)
+        #
+    #
+    return max_abs_diff <= atol, max_abs_diff
+
+
+def optimize_qdq_model(model, output_path=None, validate=True, num_validation_runs=1, atol=0.0, bandwidth_gbps=DEFAULT_BANDWIDTH_GBPS):
+    '''
+    Post export optimization of QDQ onnx models: folds the redundant DequantizeLinear -> QuantizeLinear pairs and
+    DQ -> Reshape/Transpose -> Q chains with identical parameters and deduplicates the initializers.
+    model: onnx ModelProto or path. Returns the optimized ModelProto and a report with the node counts, 
+    the estimated latency saving (removed memory traffic at bandwidth_gbps) and the onnxruntime validation result.
+    '''
+    if isinstance(model, str):
+        model = onnx.load_model(model)
+    #
+    original_model = onnx.ModelProto()
+    original_model.CopyFrom(model)
+    num_elements = _get_num_elements(model)
+
+    num_nodes_before = len(model.graph.node)
+    num_duplicate_initializers = deduplicate_initializers(model)
+    removed_nodes = fold_redundant_qdq(model)
+    num_unused_initializers = remove_unused_initializers(model)
+
+    # each removed node read and wrote its tensor once (elements of int8/float tensors counted as 1 and 4 bytes)
+    removed_bytes = 0
+    for node in removed_nodes:
+        elements = num_elements.get(node.output[0], 0)
+        removed_bytes += elements * (5 if node.op_type in ('QuantizeLinear', 'DequantizeLinear') else 2)
+    #
+    report = dict(num_nodes_before=num_nodes_before, num_nodes_after=len(model.graph.node), 
+                  num_qdq_nodes_removed=sum(node.op_type in ('QuantizeLinear', 'DequantizeLinear') for node in removed_nodes),
+                  num_initializers_removed=num_duplicate_initializers + num_unused_initializers,
+                  estimated_latency_saving_ms=removed_bytes / (bandwidth_gbps * 1e9) * 1e3)
+    if validate:
+        report['validated'], report['max_abs_diff'] = validate_models(original_model, model, num_runs=num_validation_runs, atol=atol)
+        if not report['validated']:
+            print(f"QDQ optimization changed the outputs (max abs diff: {report['max_abs_diff']}), returning the original model")
+            model = original_model
+        #
+    #
+    print(f"QDQ optimization: nodes {report['num_nodes_before']} -> {report['num_nodes_after']}, "
+          f"estimated latency saving: {report['estimated_latency_saving_ms']:.3f} ms")
+    if output_path is not None:
+        onnx.save_model(model, output_path)
+    #
+    return model, report
@@ -0,0 +1,96 @@
+"""
+Micro-benchmarks of the v3 observers.
+Usage: python tests/benchmarks/bench_observers.py [--device cuda]
+"""
+import argparse
+import time
+
+import torch
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import observer_utils, observer_types, qconfig_types
+
+
+def _timeit(fn, device, repeats=10):
+    fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    #
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start_time) / repeats * 1000
+
+
+def bench_mse_param_search(device):
+    # the greedy sequential search compared to the exhaustive batched search, always also on cpu
+    devices = ['cpu'] if device == 'cpu' else ['cpu', device]
+    for search_device in devices:
+        observer = observer_utils.CumulativeMSEHistogramObserver().to(search_device)
+        observer(torch.randn(8, 64, 56, 56, device=search_device))
+        sequential_ms = _timeit(lambda: torch.ao.quantization.HistogramObserver._non_linear_param_search(observer), search_device, repeats=3)
+        batched_ms = _timeit(lambda: observer_utils._batched_mse_param_search(observer.histogram, observer.min_val, observer.max_val, observer.dst_nbins), search_device)
+        print(f"mse param search ({search_device}): sequential={sequential_ms:.2f}ms, batched={batched_ms:.2f}ms, speedup={sequential_ms/batched_ms:.1f}x")
+    #
+
+
+class _LegacyWeightObserver(observer_types.AdaptiveWeightObserver):
+    # range_max adjustment with the host sync (.item()), as it was before the tensor version
+    def forward(self, x_orig):
+        torch.ao.quantization.MinMaxObserver.forward(self, x_orig)
+        signed_range = torch.min(self.min_val.detach()).item() < 0.0
+        self.min_val = torch.clamp(self.min_val, min=(-self.range_max if signed_range else 0.0), max=0.0)
+        self.max_val = torch.clamp(self.max_val, min=0.0, max=self.range_max)
+        return x_orig
+
+
+def bench_range_max_observer(device, num_observers=50):
+    # one QAT step worth of weight observer updates (one observer per layer)
+    weights = [torch.randn(64, 64, 3, 3, device=device) for _ in range(num_observers)]
+    def _step(observers):
+        for observer, weight in zip(observers, weights):
+            observer(weight)
+    #
+    legacy_observers = [_LegacyWeightObserver(range_max=2.0).to(device) for _ in weights]
+    observers = [observer_types.AdaptiveWeightObserver(range_max=2.0).to(device) for _ in weights]
+    legacy_ms = _timeit(lambda: _step(legacy_observers), device)
+    tensor_ms = _timeit(lambda: _step(observers), device)
+    print(f"range_max observers ({num_observers} layers / step): with host sync={legacy_ms:.2f}ms, without={tensor_ms:.2f}ms")
+
+
+def bench_learnable_fake_quantize(device, num_layers=50):
+    # one QAT step (forward + backward) of the weight fake quantize, LSQ compared to the observer based fake quantize
+    weights = [torch.randn(64, 64, 3, 3, device=device, requires_grad=True) for _ in range(num_layers)]
+    def _make_fake_quantizers(learnable_scale):
+        weight_qspec = qconfig_types.get_weight_quantization_config(dict(learnable_scale=learnable_scale))
+        ctr = weight_qspec.observer_or_fake_quant_ctr
+        ctr = ctr.with_args(channel_len=64) if learnable_scale else ctr
+        fake_quantizers = [ctr().to(device) for _ in weights]
+        for fake_quantize, weight in zip(fake_quantizers, weights):
+            fake_quantize(weight.detach())
+        #
+        return fake_quantizers
+    #
+    def _step(fake_quantizers):
+        loss = sum(fake_quantize(weight).sum() for fake_quantize, weight in zip(fake_quantizers, weights))
+        loss.backward()
+    #
+    fake_quantizers = _make_fake_quantizers(False)
+    learnable_fake_quantizers = _make_fake_quantizers(True)
+    observer_ms = _timeit(lambda: _step(fake_quantizers), device)
+    learnable_ms = _timeit(lambda: _step(learnable_fake_quantizers), device)
+    print(f"weight fake quantize step ({num_layers} layers): observer={observer_ms:.2f}ms, learnable={learnable_ms:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    bench_mse_param_search(args.device)
+    bench_range_max_observer(args.device)
+    bench_learnable_fake_quantize(args.device)
+
+
+if __name__ == '__main__':
+    main()
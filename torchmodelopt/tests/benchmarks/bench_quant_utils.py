@@ -0,0 +1,61 @@
+"""
+Micro-benchmarks of the v3 quant_utils modules / decompositions.
+Usage: python tests/benchmarks/bench_quant_utils.py [--device cuda]
+"""
+import argparse
+import types
+
+import torch
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import quant_utils
+
+from bench_observers import _timeit
+
+
+def _legacy_attention_forward(self, x):
+    # q scale vector created from a python list in every call, as before the scale buffer
+    B, N, C = x.shape
+    qkv = torch.permute(self.qkv(x).reshape(B, N, 3, self.num_heads, -1), (2, 0, 3, 1, 4))
+    q, k, v = qkv.unbind(0)
+    q = torch.mul(q, torch.tensor([self.scale]*self.head_dim, device=x.device))
+    attn = self.softmax(torch.matmul(q, k.transpose(-2, -1)))
+    x = torch.matmul(attn, v).transpose(1, 2).reshape(B, N, -1)
+    return self.proj(x)
+
+
+def bench_quant_attention(device):
+    attention = quant_utils.QuantAttention(dim=192, num_heads=3).to(device).eval()
+    legacy_attention = quant_utils.QuantAttention(dim=192, num_heads=3).to(device).eval()
+    legacy_attention.forward = types.MethodType(_legacy_attention_forward, legacy_attention)
+    x = torch.randn(8, 197, 192, device=device)
+    with torch.no_grad():
+        legacy_ms = _timeit(lambda: legacy_attention(x), device, repeats=50)
+        buffer_ms = _timeit(lambda: attention(x), device, repeats=50)
+    #
+    print(f"QuantAttention forward: scale from list={legacy_ms:.3f}ms, scale buffer={buffer_ms:.3f}ms")
+
+
+def _legacy_layer_norm_without_gb(x, eps):
+    # two reductions and two (x - mean) intermediates, as before var_mean
+    mean = torch.mean(x, dim=-1, keepdim=True)
+    var = torch.pow(x - mean, 2).mean(dim=-1, keepdim=True)
+    return (x - mean) / torch.sqrt(var + eps)
+
+
+def bench_layer_norm_without_gb(device):
+    x = torch.randn(64, 197, 768, device=device)
+    legacy_ms = _timeit(lambda: _legacy_layer_norm_without_gb(x, 1e-5), device, repeats=50)
+    var_mean_ms = _timeit(lambda: quant_utils.LayerNormWithoutGB(x, 1e-5), device, repeats=50)
+    print(f"LayerNormWithoutGB: mean + pow + mean={legacy_ms:.3f}ms, var_mean={var_mean_ms:.3f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    bench_quant_attention(args.device)
+    bench_layer_norm_without_gb(args.device)
+
+
+if __name__ == '__main__':
+    main()
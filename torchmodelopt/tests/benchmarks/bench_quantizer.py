@@ -0,0 +1,81 @@
+"""
+Benchmark of the TIDLRTQuantizer annotation time with the model depth, for conv/bn blocks and transformer blocks 
+(linear / layernorm / matmul).
+Usage: python tests/benchmarks/bench_quantizer.py
+"""
+import copy
+import time
+
+import torch
+import torch._dynamo as torchdynamo
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import quantizers, qconfig_types, quant_utils
+
+
+class _Block(torch.nn.Module):
+    def __init__(self, channels):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(channels, channels, 3, padding=1)
+        self.bn = torch.nn.BatchNorm2d(channels)
+
+    def forward(self, x):
+        return torch.relu(self.bn(self.conv(x))) + x
+
+
+class _TransformerBlock(torch.nn.Module):
+    def __init__(self, dim, num_heads=2):
+        super().__init__()
+        self.num_heads = num_heads
+        self.norm1 = torch.nn.LayerNorm(dim)
+        self.qkv = torch.nn.Linear(dim, dim * 3)
+        self.proj = torch.nn.Linear(dim, dim)
+        self.norm2 = torch.nn.LayerNorm(dim)
+        self.fc1 = torch.nn.Linear(dim, dim * 4)
+        self.gelu = torch.nn.GELU()
+        self.fc2 = torch.nn.Linear(dim * 4, dim)
+
+    def forward(self, x):
+        batch_size, seq_len, dim = x.shape
+        qkv = self.qkv(self.norm1(x)).reshape(batch_size, seq_len, 3, self.num_heads, dim // self.num_heads).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        attn = torch.softmax(torch.matmul(q, k.transpose(-2, -1)) * (dim // self.num_heads) ** -0.5, dim=-1)
+        y = torch.matmul(attn, v).transpose(1, 2).reshape(batch_size, seq_len, dim)
+        x = x + self.proj(y)
+        return x + self.fc2(self.gelu(self.fc1(self.norm2(x))))
+
+
+def _get_model(block_type, num_blocks):
+    if block_type == 'transformer':
+        return torch.nn.Sequential(*[_TransformerBlock(16) for _ in range(num_blocks)]).eval(), torch.randn(1, 8, 16)
+    #
+    return torch.nn.Sequential(*[_Block(8) for _ in range(num_blocks)]).eval(), torch.randn(1, 8, 16, 16)
+
+
+def bench_annotation(block_type, num_blocks, repeats=3):
+    model, example_input = _get_model(block_type, num_blocks)
+    # the same layernorm decomposition as in quant_func.init
+    decomposition_table = {torch.ops.aten.layer_norm.default: quant_utils.native_layer_norm}
+    gm, _ = torchdynamo.export(model, aten_graph=True, assume_static_by_default=True, pre_dispatch=True, 
+                               decomposition_table=decomposition_table)(example_input)
+    durations = []
+    for _ in range(repeats):
+        graph_module = copy.deepcopy(gm)
+        quantizer = quantizers.TIDLRTQuantizer(is_qat=False)
+        quantizer.set_global(qconfig_types.get_qconfig(qconfig_types.QConfigType.DEFAULT, is_fake_quantize=False))
+        start_time = time.perf_counter()
+        quantizer.annotate(graph_module)
+        durations.append(time.perf_counter() - start_time)
+    #
+    print(f"annotation: {num_blocks} {block_type} blocks ({len(gm.graph.nodes)} nodes) - {min(durations)*1000:.1f}ms")
+
+
+def main():
+    for block_type in ('conv', 'transformer'):
+        for num_blocks in (8, 32, 128):
+            bench_annotation(block_type, num_blocks)
+        #
+    #
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import quant_func, quant_utils
+
+
+def _get_calibrated_model():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 8, 3, padding=1), torch.nn.ReLU(), torch.nn.Conv2d(8, 8, 3, padding=1))
+    model = quant_func.init(model, is_qat=False, total_epochs=2, example_inputs=(torch.randn(2, 3, 16, 16),))
+    model.calibrate()
+    with torch.no_grad():
+        for batch in _get_batches():
+            model(batch)
+        #
+    #
+    # the observers are frozen, the same ranges are used by both the bias correction paths
+    model.freeze()
+    return model
+
+
+def _get_batches(num_batches=3):
+    generator = torch.Generator().manual_seed(1)
+    return [torch.randn(2, 3, 16, 16, generator=generator) for _ in range(num_batches)]
+
+
+def _get_biases(model):
+    return [bias_module.detach().clone() for bias_module, _ in quant_utils._get_bias_calibration_modules(model)]
+
+
+def _hook_correction(model, batch, calibration_factor):
+    # the correction of the per batch bias calibration hooks (that are used in QAT) for a single batch
+    model = copy.deepcopy(model)
+    biases = _get_biases(model)
+    hooks = quant_utils.add_bias_calibration_hook(model, calibration_factor=calibration_factor)
+    with torch.no_grad():
+        model(batch)
+    #
+    quant_func.remove_hooks(hooks)
+    return [bias - prev_bias for bias, prev_bias in zip(_get_biases(model), biases)]
+
+
+@pytest.mark.parametrize('calibration_factor', [1.0, 0.5])
+def test_bias_correction_matches_the_hook_for_a_single_batch(calibration_factor):
+    model = _get_calibrated_model()
+    batch = _get_batches(1)[0]
+    expected_corrections = _hook_correction(model, batch, calibration_factor)
+    biases = _get_biases(model)
+    model.calibrate_bias([batch], calibration_factor=calibration_factor)
+    corrections = [bias - prev_bias for bias, prev_bias in zip(_get_biases(model), biases)]
+    assert len(corrections) == 2
+    for correction, expected_correction in zip(corrections, expected_corrections):
+        assert torch.allclose(correction, expected_correction, atol=1e-6)
+    #
+    assert model.__quant_params__.bias_calibration_stats['num_batches'] == 1
+
+
+def test_bias_correction_is_the_mean_of_the_hook_corrections():
+    # with the biases fixed during the pass (the hooks change them after each batch), the correction over
+    # batches of the same size is the mean of the per batch corrections of the hooks
+    model = _get_calibrated_model()
+    batches = _get_batches()
+    hook_corrections = [_hook_correction(model, batch, 1.0) for batch in batches]
+    expected_corrections = [torch.stack(layer_corrections).mean(dim=0) for layer_corrections in zip(*hook_corrections)]
+    biases = _get_biases(model)
+    model.calibrate_bias(batches)
+    corrections = [bias - prev_bias for bias, prev_bias in zip(_get_biases(model), biases)]
+    for correction, expected_correction in zip(corrections, expected_corrections):
+        assert torch.allclose(correction, expected_correction, atol=1e-6)
+    #
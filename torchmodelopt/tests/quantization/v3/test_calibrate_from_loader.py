@@ -0,0 +1,52 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import quant_func, quant_utils
+
+
+def _get_prepared_model():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 8, 3, padding=1), torch.nn.ReLU())
+    return quant_func.init(model, is_qat=False, total_epochs=2, example_inputs=(torch.randn(2, 3, 16, 16),))
+
+
+def test_observer_drift():
+    prev_state = dict(a=dict(min_val=torch.tensor(-1.0), max_val=torch.tensor(1.0)))
+    state = dict(a=dict(min_val=torch.tensor(-1.0), max_val=torch.tensor(1.5)))
+    drift = quant_utils.get_observer_drift(prev_state, state)
+    # the drift is a tensor (no device to host sync), relative to the current range
+    assert isinstance(drift, torch.Tensor) and drift.dim() == 0
+    assert drift.item() == pytest.approx(0.5 / 2.5)
+    assert quant_utils.compute_observer_drift(prev_state, prev_state) == 0.0
+    # not yet updated observers and no common observers are not converged
+    inf_state = dict(a=dict(min_val=torch.tensor(float('inf')), max_val=torch.tensor(float('-inf'))))
+    assert quant_utils.compute_observer_drift(inf_state, inf_state) == float('inf')
+    assert quant_utils.compute_observer_drift({}, state) == float('inf')
+
+
+def test_calibration_converges_for_the_same_batch():
+    model = _get_prepared_model()
+    batch = torch.randn(2, 3, 16, 16)
+    quant_func.calibrate_from_loader(model, [batch] * 20, patience=3)
+    # the drifts of batches 2..4 are 0 and are checked together after batch 4
+    assert model.__quant_params__.calibration_stats == dict(num_batches=4, drift=0.0, converged=True)
+
+
+def test_calibration_syncs_once_every_patience_batches(monkeypatch):
+    calls = []
+    update_num_stable_batches = quant_func._update_num_stable_batches
+
+    def _update(drifts, *args):
+        calls.append(len(drifts))
+        return update_num_stable_batches(drifts, *args)
+    #
+    monkeypatch.setattr(quant_func, '_update_num_stable_batches', _update)
+    monkeypatch.setattr(quant_utils, 'compute_observer_drift', None)
+    model = _get_prepared_model()
+    # a growing range in every batch - does not converge
+    batches = [torch.randn(2, 3, 16, 16) * (index + 1) for index in range(12)]
+    quant_func.calibrate_from_loader(model, batches, patience=3)
+    assert calls == [3, 3, 3, 2]
+    stats = model.__quant_params__.calibration_stats
+    assert stats['num_batches'] == 12 and not stats['converged'] and stats['drift'] > 1e-3
@@ -0,0 +1,80 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import quant_func, quant_utils, qconfig_types
+
+
+class _TensorDataset(torch.utils.data.Dataset):
+    def __init__(self, num_samples=8, fail_index=None):
+        self.num_samples = num_samples
+        self.fail_index = fail_index
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, index):
+        if index == self.fail_index:
+            raise ValueError(f"bad sample {index}")
+        #
+        generator = torch.Generator().manual_seed(index)
+        return torch.randn(3, 16, 16, generator=generator)
+
+
+def _get_prepared_model():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 8, 3, padding=1), torch.nn.ReLU())
+    return quant_func.init(model, is_qat=False, total_epochs=2, example_inputs=(torch.randn(2, 3, 16, 16),))
+
+
+def _calibrate_single_process(model, dataset, num_workers, batch_size):
+    # the same batches as in the workers, in one process
+    model.calibrate()
+    with torch.no_grad():
+        for shard_index in range(num_workers):
+            shard = torch.utils.data.Subset(dataset, list(range(shard_index, len(dataset), num_workers)))
+            for batch in torch.utils.data.DataLoader(shard, batch_size=batch_size, shuffle=False):
+                model(batch)
+            #
+        #
+    #
+    return model
+
+
+def test_calibrate_sharded_merges_the_worker_results():
+    dataset = _TensorDataset()
+    model = _get_prepared_model()
+    quant_func.calibrate_sharded(model, dataset, num_workers=2, batch_size=2)
+    assert model.__quant_params__.calibration_stats == dict(num_batches=4, num_workers=2)
+
+    reference_model = _calibrate_single_process(_get_prepared_model(), dataset, num_workers=2, batch_size=2)
+    observers = quant_utils.get_observer_modules(model)
+    reference_observers = quant_utils.get_observer_modules(reference_model)
+    states = quant_utils.get_observer_state(observers)
+    reference_states = quant_utils.get_observer_state(reference_observers)
+    assert len(states) > 0 and states.keys() == reference_states.keys()
+    for name, state in states.items():
+        # the min/max reduction is exact, the histograms are re-binned onto the same range with the same total count
+        assert torch.equal(state['min_val'], reference_states[name]['min_val']), name
+        assert torch.equal(state['max_val'], reference_states[name]['max_val']), name
+        if 'histogram' in state:
+            assert torch.allclose(state['histogram'].sum(), reference_states[name]['histogram'].sum()), name
+        #
+    #
+    for name, observer in observers.items():
+        scale, zero_point = observer.calculate_qparams()
+        reference_scale, reference_zero_point = reference_observers[name].calculate_qparams()
+        if isinstance(observer, torch.ao.quantization.HistogramObserver):
+            # the range search on the merged histogram finds (nearly) the same range
+            assert torch.allclose(scale, reference_scale, rtol=0.05), name
+            assert torch.allclose(zero_point.float(), reference_zero_point.float(), atol=2), name
+        else:
+            assert torch.equal(scale, reference_scale) and torch.equal(zero_point, reference_zero_point), name
+        #
+    #
+
+
+def test_calibrate_sharded_raises_the_worker_error():
+    model = _get_prepared_model()
+    with pytest.raises(RuntimeError, match="bad sample"):
+        quant_func.calibrate_sharded(model, _TensorDataset(fail_index=3), num_workers=2, batch_size=2, timeout=120)
@@ -0,0 +1,68 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import quant_func, quant_utils, qconfig_types, fake_quantize_types
+
+
+class _ConvNet(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(3, 8, 3, padding=1)
+        self.bn = torch.nn.BatchNorm2d(8)
+        self.fc = torch.nn.Linear(8, 4)
+
+    def forward(self, x):
+        x = torch.relu(self.bn(self.conv(x)))
+        return self.fc(x.mean(dim=(2, 3)))
+
+
+def _run_epoch(model, x):
+    model.train()
+    for _ in range(2):
+        model(x).sum().backward()
+    #
+    model.eval()
+    with torch.no_grad():
+        model(x)
+    #
+
+
+def test_compile_mode_has_no_graph_breaks_or_recompiles():
+    torch._dynamo.reset()
+    x = torch.randn(2, 3, 8, 8)
+    model = quant_func.init(_ConvNet(), is_qat=True, total_epochs=20, example_inputs=(x,), compile_mode=True)
+    model.compile(backend='eager')
+    for _ in range(2):
+        _run_epoch(model, x)
+    #
+    compile_stats = quant_utils.get_compile_stats()
+    assert compile_stats['graph_breaks'] == 0
+    # further epochs (before the freeze epochs) reuse the graphs compiled for the train and eval modes
+    for _ in range(2):
+        _run_epoch(model, x)
+    #
+    assert quant_utils.get_compile_stats() == compile_stats
+
+
+@pytest.mark.parametrize('option', [dict(bias_calibration_factor=0.01), dict(outlier_warmup_steps=100)])
+def test_compile_mode_refuses_the_hook_based_options(option):
+    with pytest.raises(ValueError):
+        quant_func.init(_ConvNet(), is_qat=True, total_epochs=20, example_inputs=(torch.randn(2, 3, 8, 8),), 
+                        compile_mode=True, **option)
+
+
+@pytest.mark.parametrize('option', [dict(range_shrink_percentile=0.01), dict(batched_search=True), dict(sample_budget=1024)])
+def test_compile_mode_refuses_the_adaptive_observer_options(option):
+    act_qspec = qconfig_types.get_act_quantization_config(dict(qscheme=torch.per_tensor_affine, **option), compile_mode=True)
+    with pytest.raises(ValueError, match="compile_mode"):
+        act_qspec.observer_or_fake_quant_ctr()
+    #
+
+
+def test_compile_mode_default_activation_fake_quantize():
+    # the default range shrink of the adaptive observers is not used in compile_mode
+    act_qspec = qconfig_types.get_act_quantization_config(dict(qscheme=torch.per_tensor_affine), compile_mode=True)
+    fake_quantize = act_qspec.observer_or_fake_quant_ctr()
+    assert isinstance(fake_quantize, fake_quantize_types.CompilableActivationFakeQuantize)
+    assert isinstance(fake_quantize, torch.ao.quantization.FusedMovingAvgObsFakeQuantize)
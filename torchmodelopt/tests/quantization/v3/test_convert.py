@@ -0,0 +1,74 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import quant_func, qconfig_types
+
+
+class _ConvNet(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(3, 8, 3, padding=1)
+        self.bn = torch.nn.BatchNorm2d(8)
+        self.relu = torch.nn.ReLU()
+        self.fc = torch.nn.Linear(8, 4)
+
+    def forward(self, x):
+        x = self.relu(self.bn(self.conv(x)))
+        return self.fc(x.mean(dim=(2, 3)))
+
+
+def _train_step(model, optimizer, device):
+    model.train()
+    loss = model(torch.randn(4, 3, 16, 16, device=device)).square().mean()
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+
+
+def _get_module_state(model):
+    return {name: (module.training, tuple((key, id(value), value.device) for key, value in module._parameters.items()),
+                   tuple((key, value.device) for key, value in module._buffers.items() if value is not None))
+            for name, module in model.named_modules()}
+
+
+@pytest.mark.parametrize('qconfig_type', [qconfig_types.QConfigType.DEFAULT, qconfig_types.QConfigType.LSQ_WC8_AT8])
+def test_shared_params_convert_does_not_affect_the_qat_model(qconfig_type):
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = _ConvNet().to(device)
+    model = quant_func.init(model, is_qat=True, total_epochs=4, qconfig_type=qconfig_type,
+                            example_inputs=(torch.randn(2, 3, 16, 16, device=device),))
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    _train_step(model, optimizer, device)
+
+    module_state = _get_module_state(model)
+    param_ids = [id(p) for p in model.parameters()]
+    model.convert(device='cpu', make_copy=True, share_params=True)
+
+    # the training mode, the devices and the parameter objects of the qat model are unchanged
+    assert _get_module_state(model) == module_state
+    assert [id(p) for p in model.parameters()] == param_ids
+    assert [id(p) for group in optimizer.param_groups for p in group['params']] == param_ids
+
+    # and the parameters are still updated by the optimizer
+    params_before = [p.detach().clone() for p in model.parameters()]
+    _train_step(model, optimizer, device)
+    assert any(not torch.equal(before, p) for before, p in zip(params_before, model.parameters()))
+
+
+def test_shared_params_convert_is_not_changed_by_later_training():
+    model = quant_func.init(_ConvNet(), is_qat=True, total_epochs=4, example_inputs=(torch.randn(2, 3, 16, 16),))
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    _train_step(model, optimizer, 'cpu')
+    converted_model = model.convert(device='cpu', make_copy=True, share_params=True)
+    x = torch.randn(2, 3, 16, 16)
+    with torch.no_grad():
+        output_before = converted_model(x)
+    #
+    # the weights and the batchnorm statistics of the qat model change, the converted model is a snapshot
+    for _ in range(2):
+        _train_step(model, optimizer, 'cpu')
+    #
+    with torch.no_grad():
+        assert torch.equal(converted_model(x), output_before)
+    #
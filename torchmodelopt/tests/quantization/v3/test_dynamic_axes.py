@@ -0,0 +1,63 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import quant_func, quant_utils
+
+
+class _ConvNet(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv1 = torch.nn.Conv2d(3, 8, 3, padding=1)
+        self.relu = torch.nn.ReLU()
+        self.conv2 = torch.nn.Conv2d(8, 4, 3, padding=1)
+
+    def forward(self, x):
+        return self.conv2(self.relu(self.conv1(x)))
+
+
+DYNAMIC_AXES = {0: {0: 'batch', 2: 'height', 3: 'width'}}
+
+
+def test_mark_dynamic_axes_does_not_modify_the_given_inputs():
+    example_input = torch.randn(2, 3, 16, 16)
+    example_kwargs = dict(mask=torch.ones(2, 16))
+    example_inputs, marked_kwargs, flat_dynamic_axes = quant_utils.mark_dynamic_axes(
+        (example_input,), example_kwargs, {0: [0], 'mask': [1]})
+    assert not hasattr(example_input, '_dynamo_dynamic_indices')
+    assert not hasattr(example_kwargs['mask'], '_dynamo_dynamic_indices')
+    assert example_inputs[0] is not example_input and torch.equal(example_inputs[0], example_input)
+    assert marked_kwargs['mask'] is not example_kwargs['mask']
+    assert flat_dynamic_axes == {0: [0], 1: [1]}
+
+
+def test_prepared_model_calibrates_converts_and_runs_at_two_resolutions():
+    resolutions = [(16, 16), (24, 32)]
+    model = quant_func.init(_ConvNet(), is_qat=False, total_epochs=2, example_inputs=(torch.randn(2, 3, 16, 16),),
+                            dynamic_axes=DYNAMIC_AXES)
+    model.train()
+    with torch.no_grad():
+        for height, width in resolutions:
+            for _ in range(2):
+                model(torch.randn(2, 3, height, width))
+            #
+        #
+    #
+    converted_model = model.convert(device='cpu', make_copy=True)
+    with torch.no_grad():
+        for height, width in resolutions:
+            x = torch.randn(3, 3, height, width)
+            assert model(x).shape == (3, 4, height, width)
+            assert converted_model(x).shape == (3, 4, height, width)
+        #
+    #
+
+
+def test_export_cache_is_not_used_with_dynamic_axes(tmp_path):
+    with pytest.warns(UserWarning, match="export_cache_dir"):
+        model = quant_func.init(_ConvNet(), is_qat=False, total_epochs=2, example_inputs=(torch.randn(2, 3, 16, 16),),
+                                dynamic_axes=DYNAMIC_AXES, export_cache_dir=str(tmp_path))
+    #
+    assert list(tmp_path.iterdir()) == []
+    with torch.no_grad():
+        assert model(torch.randn(3, 3, 24, 32)).shape == (3, 4, 24, 32)
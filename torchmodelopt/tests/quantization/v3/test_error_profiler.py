@@ -0,0 +1,82 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import error_profiler, quant_func, quant_utils
+
+
+class _Net(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(3, 8, 3, padding=1)
+        self.relu = torch.nn.ReLU()
+
+    def forward(self, x, offset=None, gain=None):
+        return self.relu(self.conv(x * gain + offset))
+
+
+def _get_inputs():
+    generator = torch.Generator().manual_seed(0)
+    return (torch.randn(2, 3, 16, 16, generator=generator), dict(gain=torch.full((1,), 2.0), offset=torch.full((1,), 0.5)))
+
+
+def test_get_graph_args_matches_the_keyword_inputs_by_name():
+    class _Add(torch.nn.Module):
+        def forward(self, x, y, z=None):
+            return x - y * 2 + (z if z is not None else 0)
+        #
+    #
+    graph_module = torch.fx.symbolic_trace(_Add())
+    x, y, z = torch.randn(3), torch.randn(3), torch.randn(3)
+    graph_args = quant_utils.get_graph_args(graph_module, (x,), dict(z=z, y=y))
+    assert all(a is b for a, b in zip(graph_args, (x, y, z)))
+    assert torch.equal(torch.fx.Interpreter(graph_module).run(*graph_args), graph_module(x, y=y, z=z))
+    with pytest.raises(TypeError):
+        quant_utils.get_graph_args(graph_module, (x,), dict(w=y))
+    #
+
+
+def test_profiler_with_keyword_inputs():
+    torch.manual_seed(0)
+    x, kwargs = _get_inputs()
+    model = quant_func.init(_Net(), is_qat=False, total_epochs=2, example_inputs=(x,), example_kwargs=kwargs)
+    model.calibrate()
+    with torch.no_grad():
+        model(x, **kwargs)
+    #
+    model.freeze()
+    profiler = error_profiler.QuantErrorProfiler(model)
+    # the keyword inputs in a different order than in the forward signature
+    profiler.update(x, gain=kwargs['gain'], offset=kwargs['offset'])
+    report = {r['layer']: r for r in profiler.get_report()}
+    profiler.remove_hooks()
+    # the output of the relu is the output of the model: the error is the same as for the outputs of the models
+    with torch.no_grad():
+        float_output = profiler.float_model(x, gain=kwargs['gain'], offset=kwargs['offset'])
+        quant_output = model(x, gain=kwargs['gain'], offset=kwargs['offset'])
+    #
+    error = torch.sum((quant_output - float_output) ** 2)
+    expected_sqnr = 10 * torch.log10(torch.sum(float_output ** 2) / error).item()
+    assert report['relu']['sqnr_db'] == pytest.approx(expected_sqnr, rel=1e-4)
+    assert report['relu']['mse'] == pytest.approx(error.item() / float_output.numel(), rel=1e-4)
+
+
+def test_per_channel_clip_range():
+    fake_quant = torch.ao.quantization.FakeQuantize(observer=torch.ao.quantization.PerChannelMinMaxObserver, quant_min=-128, quant_max=127, 
+                                                    dtype=torch.qint8, qscheme=torch.per_channel_symmetric, ch_axis=1)
+    # a different range in each channel
+    channel_range = torch.tensor([1.0, 2.0, 4.0, 8.0]).reshape(1, 4, 1, 1)
+    x = (torch.rand(2, 4, 5, 5) * 2 - 1) * channel_range
+    fake_quant(x)
+    graph = torch.fx.Graph()
+    node = graph.call_module('fake_quant', (graph.placeholder('x'),))
+    profiler = error_profiler.QuantErrorProfiler.__new__(error_profiler.QuantErrorProfiler)
+    profiler.modules = dict(fake_quant=fake_quant)
+    clip_min, clip_max = profiler._get_clip_range(node, {}, x.dim())
+    assert clip_min.shape == (1, 4, 1, 1) and clip_max.shape == (1, 4, 1, 1)
+    assert torch.all(clip_max < channel_range * 1.01) and torch.all(clip_max > torch.amax(x.abs(), dim=(0, 2, 3), keepdim=True) * 0.99)
+    # values beyond the range of their channel are counted as clipped (twice the range of every channel)
+    stats = error_profiler._RunningErrorStats()
+    stats.update(x * 2, fake_quant(x * 2), (clip_min, clip_max))
+    in_range = ((x * 2).abs() <= torch.amax(x.abs(), dim=(0, 2, 3), keepdim=True)).sum().item()
+    assert stats.num_clipped == pytest.approx(x.numel() - in_range, abs=x.shape[1])
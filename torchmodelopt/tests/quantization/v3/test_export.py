@@ -0,0 +1,84 @@
+import io
+
+import pytest
+
+torch = pytest.importorskip("torch")
+onnx = pytest.importorskip("onnx")
+ort = pytest.importorskip("onnxruntime")
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import quant_func, quant_utils, qconfig_types
+
+
+class _ConvNet(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(3, 8, 3, padding=1)
+        self.relu = torch.nn.ReLU()
+
+    def forward(self, x):
+        return self.relu(self.conv(x))
+
+
+def _get_prepared_model():
+    torch.manual_seed(0)
+    model = quant_func.init(_ConvNet(), is_qat=False, total_epochs=2, example_inputs=(torch.randn(1, 3, 16, 16),))
+    with torch.no_grad():
+        for _ in range(2):
+            model(torch.randn(1, 3, 16, 16))
+        #
+    #
+    return model
+
+
+def _export_with_the_old_path(model, example_input, filename, int_model):
+    # torch.onnx.export to the file and the conversion by onnxruntime from that file, as before the in memory export
+    converted_model = model.convert(device='cpu', make_copy=True)
+    converted_model.module = quant_utils.remove_loss_branch(converted_model.module)
+    quant_utils.register_onnx_symbolics()
+    qdq_filename = str(filename).replace('.onnx', '_qdq.onnx') if int_model else str(filename)
+    torch.onnx.export(converted_model, example_input, qdq_filename, opset_version=17, training=torch._C._onnx.TrainingMode.PRESERVE)
+    if int_model:
+        so = ort.SessionOptions()
+        so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+        so.optimized_model_filepath = str(filename)
+        ort.InferenceSession(qdq_filename, so)
+    #
+
+
+def _get_metadata(onnx_model):
+    return {prop.key: prop.value for prop in onnx_model.metadata_props}
+
+
+@pytest.mark.parametrize('int_model', [False, True])
+def test_export_matches_the_file_based_export(tmp_path, int_model):
+    model = _get_prepared_model()
+    example_input = torch.randn(1, 3, 16, 16)
+    model_qconfig_format = qconfig_types.QConfigFormat.INT_MODEL if int_model else None
+    quant_func.export(model, example_input, filename=str(tmp_path / 'model.onnx'), simplify=False, model_qconfig_format=model_qconfig_format)
+    _export_with_the_old_path(model, example_input, tmp_path / 'reference.onnx', int_model)
+
+    onnx_model = onnx.load(str(tmp_path / 'model.onnx'))
+    reference_model = onnx.load(str(tmp_path / 'reference.onnx'))
+    assert onnx_model.graph == reference_model.graph
+    assert 'model_source' in _get_metadata(onnx_model)
+    if int_model:
+        qdq_model = onnx.load(str(tmp_path / 'model_qdq.onnx'))
+        assert qdq_model.graph == onnx.load(str(tmp_path / 'reference_qdq.onnx')).graph
+    #
+
+
+def test_export_falls_back_to_a_file_for_large_models(tmp_path, monkeypatch):
+    model = _get_prepared_model()
+    example_input = torch.randn(1, 3, 16, 16)
+    torch_onnx_export = torch.onnx.export
+    def _export_with_protobuf_limit(model, args, f, *export_args, **export_kwargs):
+        if isinstance(f, io.BytesIO):
+            raise RuntimeError("The serialized model is larger than the 2GiB limit imposed by the protobuf library.")
+        #
+        return torch_onnx_export(model, args, f, *export_args, **export_kwargs)
+    #
+    monkeypatch.setattr(torch.onnx, 'export', _export_with_protobuf_limit)
+    quant_func.export(model, example_input, filename=str(tmp_path / 'model.onnx'), simplify=False)
+    monkeypatch.setattr(torch.onnx, 'export', torch_onnx_export)
+    _export_with_the_old_path(model, example_input, tmp_path / 'reference.onnx', int_model=False)
+    assert onnx.load(str(tmp_path / 'model.onnx')).graph == onnx.load(str(tmp_path / 'reference.onnx')).graph
@@ -0,0 +1,118 @@
+import importlib
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import export_cache
+
+
+DECOMPOSITION_SOURCE = '''
+import torch
+
+def _helper(x):
+    return x * {scale}
+
+def decomposition(x):
+    return _helper(x)
+'''
+
+
+def _write_decomposition_module(path, scale):
+    path.write_text(DECOMPOSITION_SOURCE.format(scale=scale))
+
+
+def test_changed_decomposition_helper_invalidates_cache_key(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    module_file = tmp_path / 'export_cache_test_decomposition.py'
+    _write_decomposition_module(module_file, '1.0')
+    decomposition_module = importlib.import_module('export_cache_test_decomposition')
+    try:
+        model = torch.nn.Sequential(torch.nn.Linear(4, 4))
+        example_inputs = (torch.ones(1, 4),)
+        decomposition_table = {torch.ops.aten.layer_norm.default: decomposition_module.decomposition}
+        key = export_cache.get_export_cache_key(model, example_inputs, {}, decomposition_table)
+        assert key == export_cache.get_export_cache_key(model, example_inputs, {}, decomposition_table)
+
+        # only the helper changes - the source of the decomposition function itself is the same
+        _write_decomposition_module(module_file, '2.0 + 0.0')
+        decomposition_module = importlib.reload(decomposition_module)
+        decomposition_table = {torch.ops.aten.layer_norm.default: decomposition_module.decomposition}
+        assert key != export_cache.get_export_cache_key(model, example_inputs, {}, decomposition_table)
+    finally:
+        sys.modules.pop('export_cache_test_decomposition', None)
+
+
+def test_cache_key_depends_on_package_version(monkeypatch):
+    model = torch.nn.Sequential(torch.nn.Linear(4, 4))
+    example_inputs = (torch.ones(1, 4),)
+    key = export_cache.get_export_cache_key(model, example_inputs, {}, {})
+    monkeypatch.setattr(export_cache, '__version__', '0.0.0')
+    assert key != export_cache.get_export_cache_key(model, example_inputs, {}, {})
+
+
+HELPER_SOURCE = '''
+def scale(x):
+    return x * {scale}
+'''
+
+MODEL_SOURCE = '''
+import torch
+import export_cache_test_helpers as helpers
+
+def _activation(x):
+    return helpers.scale(x).relu()
+
+class Net(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.fc = torch.nn.Linear(4, 4)
+
+    def forward(self, x):
+        return _activation(self.fc(x))
+'''
+
+
+def test_changed_helper_in_another_module_invalidates_cache_key(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    helper_file = tmp_path / 'export_cache_test_helpers.py'
+    helper_file.write_text(HELPER_SOURCE.format(scale='1.0'))
+    (tmp_path / 'export_cache_test_model.py').write_text(MODEL_SOURCE)
+    try:
+        model_module = importlib.import_module('export_cache_test_model')
+        model = model_module.Net()
+        example_inputs = (torch.ones(1, 4),)
+        key = export_cache.get_export_cache_key(model, example_inputs, {}, {})
+        # a free function called by forward, that calls a function of another module
+        helper_file.write_text(HELPER_SOURCE.format(scale='2.0'))
+        importlib.reload(sys.modules['export_cache_test_helpers'])
+        assert key != export_cache.get_export_cache_key(model, example_inputs, {}, {})
+    finally:
+        sys.modules.pop('export_cache_test_model', None)
+        sys.modules.pop('export_cache_test_helpers', None)
+
+
+def test_cache_key_does_not_depend_on_the_weights():
+    model = torch.nn.Sequential(torch.nn.Linear(4, 4))
+    example_inputs = (torch.ones(1, 4),)
+    key = export_cache.get_export_cache_key(model, example_inputs, {}, {})
+    with torch.no_grad():
+        model[0].weight.add_(1.0)
+    #
+    assert key == export_cache.get_export_cache_key(model, example_inputs, {}, {})
+
+
+def test_cached_graph_uses_the_weights_of_the_given_model(tmp_path):
+    example_inputs = (torch.randn(2, 4),)
+    first_cache = export_cache.ExportGraphCache(str(tmp_path))
+    first_cache.export(torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.ReLU()), example_inputs, {}, {})
+    assert first_cache.get_stats()['misses'] == 1
+
+    model = torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.ReLU())
+    second_cache = export_cache.ExportGraphCache(str(tmp_path))
+    gm = second_cache.export(model, example_inputs, {}, {})
+    # the stats are kept for each cache
+    assert second_cache.get_stats()['hits'] == 1 and second_cache.get_stats()['misses'] == 0
+    assert first_cache.get_stats()['hits'] == 0
+    assert torch.equal(gm(*example_inputs), model(*example_inputs))
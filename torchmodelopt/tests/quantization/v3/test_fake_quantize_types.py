@@ -0,0 +1,80 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import qconfig_types, fake_quantize_types
+
+
+def _learnable_weight_fake_quantize(**kwargs):
+    weight_qspec = qconfig_types.get_weight_quantization_config(dict(learnable_scale=True))
+    return weight_qspec.observer_or_fake_quant_ctr.with_args(**kwargs)()
+
+
+def test_per_channel_qparams_have_the_channel_shape_before_the_first_forward():
+    fake_quantize = _learnable_weight_fake_quantize(channel_len=16)
+    assert isinstance(fake_quantize, fake_quantize_types.LearnableWeightFakeQuantize)
+    assert fake_quantize.scale.shape == (16,) and fake_quantize.zero_point.shape == (16,)
+    # the parameters are updated in place, so an optimizer created before the first forward keeps training them
+    scale = fake_quantize.scale
+    fake_quantize(torch.randn(16, 8, 3, 3))
+    assert fake_quantize.scale is scale and fake_quantize.scale.shape == (16,)
+
+
+def test_load_state_dict_into_a_fake_quantize_with_channel_len():
+    fake_quantize = _learnable_weight_fake_quantize(channel_len=16)
+    fake_quantize(torch.randn(16, 8, 3, 3))
+    loaded_fake_quantize = _learnable_weight_fake_quantize(channel_len=16)
+    loaded_fake_quantize.load_state_dict(fake_quantize.state_dict())
+    assert torch.equal(loaded_fake_quantize.scale, fake_quantize.scale)
+    assert loaded_fake_quantize.num_init_steps == loaded_fake_quantize.init_steps
+
+
+def test_observer_flag_follows_enable_observer():
+    fake_quantize = _learnable_weight_fake_quantize(channel_len=16)
+    fake_quantize.disable_observer()
+    fake_quantize(torch.randn(16, 8, 3, 3))
+    assert fake_quantize.num_init_steps == 0 and not fake_quantize.scale.requires_grad
+    fake_quantize.enable_observer()
+    fake_quantize(torch.randn(16, 8, 3, 3))
+    assert fake_quantize.num_init_steps == 1
+
+
+def test_per_channel_requires_channel_len():
+    with pytest.raises(ValueError, match="channel_len"):
+        _learnable_weight_fake_quantize()
+    #
+
+
+def test_optimizer_keeps_training_the_loaded_parameters():
+    fake_quantize = _learnable_weight_fake_quantize(channel_len=16)
+    optimizer = torch.optim.Adam(fake_quantize.parameters(), lr=1e-3)
+    fake_quantize(torch.randn(16, 8, 3, 3)).sum().backward()
+    optimizer.step()
+    trained_fake_quantize = _learnable_weight_fake_quantize(channel_len=16)
+    trained_fake_quantize(torch.randn(16, 8, 3, 3) * 2)
+    fake_quantize.load_state_dict(trained_fake_quantize.state_dict())
+    # the parameters are loaded in place - still the ones in the optimizer (and its state)
+    assert any(fake_quantize.scale is param for param in optimizer.param_groups[0]['params'])
+    assert fake_quantize.scale in optimizer.state and torch.equal(fake_quantize.scale, trained_fake_quantize.scale)
+
+
+def test_load_state_dict_with_a_different_channel_len_fails():
+    fake_quantize = _learnable_weight_fake_quantize(channel_len=8)
+    fake_quantize(torch.randn(8, 4, 3, 3))
+    loaded_fake_quantize = _learnable_weight_fake_quantize(channel_len=16)
+    with pytest.raises(RuntimeError, match="size mismatch"):
+        loaded_fake_quantize.load_state_dict(fake_quantize.state_dict())
+    #
+    assert loaded_fake_quantize.scale.shape == (16,)
+
+
+def test_update_fake_quant_qparams_warns_for_the_learned_qparams():
+    from edgeai_torchmodelopt.xmodelopt.quantization.v3 import quant_utils
+    fake_quantize = _learnable_weight_fake_quantize(channel_len=16)
+    fake_quantize(torch.randn(16, 8, 3, 3))
+    scale = fake_quantize.scale.detach().clone()
+    fake_quantize.activation_post_process(torch.randn(16, 8, 3, 3) * 10)
+    with pytest.warns(UserWarning, match="learned scale/zero_point"):
+        quant_utils.update_fake_quant_qparams(fake_quantize)
+    #
+    assert torch.equal(fake_quantize.scale, scale)
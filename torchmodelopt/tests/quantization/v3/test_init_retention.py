@@ -0,0 +1,68 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from edgeai_torchmodelopt.xmodelopt import utils
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import quant_func
+from edgeai_torchmodelopt.xmodelopt.quantization.v3.quant_base import QuantPT2EBaseModule
+
+
+class _ConvNet(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(3, 8, 3, padding=1)
+        self.relu = torch.nn.ReLU()
+        self.fc = torch.nn.Linear(8, 4)
+
+    def forward(self, x):
+        return self.fc(self.relu(self.conv(x)).mean(dim=(2, 3)))
+
+
+def _train_step(model):
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    loss = model(torch.randn(4, 3, 16, 16)).square().mean()
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+
+
+def _get_weights(model):
+    return [p.detach().clone() for p in model.parameters()]
+
+
+@pytest.mark.parametrize('model_retention', utils.ModelRetention.choices())
+def test_init_does_not_train_the_given_model(model_retention, tmp_path):
+    float_model = _ConvNet()
+    float_weights = _get_weights(float_model)
+    model = quant_func.init(float_model, is_qat=True, total_epochs=4, example_inputs=(torch.randn(2, 3, 16, 16),),
+                            model_retention=model_retention, retention_dir=str(tmp_path))
+    _train_step(model)
+    assert all(torch.equal(before, p) for before, p in zip(float_weights, float_model.parameters()))
+    assert model.__quant_params__.rss_mb[1] is None or model.__quant_params__.rss_mb[1] > 0
+
+
+def test_init_inplace_trains_the_given_model(tmp_path):
+    float_model = _ConvNet()
+    float_weights = _get_weights(float_model)
+    model = quant_func.init(float_model, is_qat=True, total_epochs=4, example_inputs=(torch.randn(2, 3, 16, 16),),
+                            model_retention=utils.ModelRetention.MMAP, retention_dir=str(tmp_path), inplace=True)
+    _train_step(model)
+    assert any(not torch.equal(before, p) for before, p in zip(float_weights, float_model.parameters()))
+    # the retained float model is the one before the training
+    retained_model = utils.get_retained_model(model.__quant_params__.original_model)
+    assert all(torch.equal(before, p) for before, p in zip(float_weights, retained_model.parameters()))
+
+
+def test_wrapper_retains_the_model_only_once(monkeypatch, tmp_path):
+    num_spills = []
+    retained_model_init = utils.RetainedModel.__init__
+    def _counting_init(self, *args, **kwargs):
+        num_spills.append(1)
+        retained_model_init(self, *args, **kwargs)
+    #
+    monkeypatch.setattr(utils.RetainedModel, '__init__', _counting_init)
+    wrapper = QuantPT2EBaseModule(_ConvNet(), is_qat=True, total_epochs=4, example_inputs=(torch.randn(2, 3, 16, 16),),
+                                  model_retention=utils.ModelRetention.MMAP, retention_dir=str(tmp_path))
+    assert len(num_spills) == 1
+    assert wrapper.module.__quant_params__.original_model is wrapper._orig_module
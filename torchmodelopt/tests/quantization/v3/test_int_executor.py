@@ -0,0 +1,65 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from torch.fx import Graph, GraphModule
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import int_executor
+
+
+_quantize = torch.ops.quantized_decomposed.quantize_per_tensor.default
+_dequantize = torch.ops.quantized_decomposed.dequantize_per_tensor.default
+
+
+def _qdq_graph_module(op, input_qparams, output_qparams, *op_args):
+    # dequantize(inputs) -> op -> quantize -> dequantize, as in the converted model
+    graph = Graph()
+    inputs = []
+    for index, (scale, zero_point, dtype) in enumerate(input_qparams):
+        qmin, qmax = torch.iinfo(dtype).min, torch.iinfo(dtype).max
+        inputs.append(graph.call_function(_dequantize, (graph.placeholder(f'x{index}'), scale, zero_point, qmin, qmax, dtype)))
+    #
+    scale, zero_point, dtype = output_qparams
+    qmin, qmax = torch.iinfo(dtype).min, torch.iinfo(dtype).max
+    output = graph.call_function(op, (*inputs, *op_args))
+    output = graph.call_function(_quantize, (output, scale, zero_point, qmin, qmax, dtype))
+    graph.output(graph.call_function(_dequantize, (output, scale, zero_point, qmin, qmax, dtype)))
+    return GraphModule(torch.nn.Module(), graph)
+
+
+def _random_q(shape, dtype):
+    return torch.randint(torch.iinfo(dtype).min, torch.iinfo(dtype).max + 1, shape, dtype=dtype)
+
+
+@pytest.mark.parametrize('input_scales', [(1/8, 1/4), (1/4, 1/8), (1/16, 1/16)])
+def test_add_is_bit_exact_with_the_fake_quant_reference(input_scales):
+    torch.manual_seed(0)
+    # power of 2 scales (the device default) - the alignment of the inputs is exact
+    output_scale = min(input_scales)
+    model = _qdq_graph_module(torch.ops.aten.add.Tensor, [(s, 0, torch.int8) for s in input_scales], (output_scale, 0, torch.int8))
+    inputs = (_random_q((2, 8, 4, 4), torch.int8), _random_q((2, 8, 4, 4), torch.int8))
+    assert torch.equal(int_executor.IntegerReferenceExecutor(model)(*inputs), model(*inputs))
+
+
+def test_add_aligns_the_inputs_rounding_half_up():
+    # scale ratio 1.5: the odd values of the coarser input are ties, these round up in the device (not to even)
+    model = _qdq_graph_module(torch.ops.aten.add.Tensor, [(0.15, 0, torch.int8), (0.1, 0, torch.int8)], (0.1, 0, torch.int8))
+    x = torch.arange(-21, 22, dtype=torch.int8)
+    output = int_executor.IntegerReferenceExecutor(model)(x, torch.zeros_like(x))
+    expected = torch.clamp(torch.floor(x.to(torch.float64) * 1.5 + 0.5), -128, 127) * 0.1
+    assert torch.equal(output, expected.to(torch.float32))
+
+
+@pytest.mark.parametrize('pad_value', [0.0, 0.3, -1.0, 100.0])
+def test_pad_is_bit_exact_with_the_fake_quant_reference(pad_value):
+    torch.manual_seed(0)
+    qparams = (1/8, 128, torch.uint8)
+    model = _qdq_graph_module(torch.ops.aten.pad.default, [qparams], qparams, [1, 1, 2, 2], 'constant', pad_value)
+    x = _random_q((2, 4, 4, 4), torch.uint8)
+    assert torch.equal(int_executor.IntegerReferenceExecutor(model)(x), model(x))
+
+
+@pytest.mark.parametrize('multiplier', [0.375, 0.5, 0.75, 1.0, 1.5, 3.0, 2.0 ** 31])
+def test_fixed_point_multiply_rounds_half_up(multiplier):
+    value = torch.arange(-50, 51, dtype=torch.float64)
+    output = int_executor._fixed_point_multiply(value, torch.tensor(multiplier, dtype=torch.float64))
+    assert torch.equal(output, torch.floor(value * multiplier + 0.5).to(torch.int64))
@@ -0,0 +1,69 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import mixed_precision, quant_func
+
+
+class _Net(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(3, 8, 3, padding=1)
+        self.relu = torch.nn.ReLU()
+        self.fc = torch.nn.Linear(8, 8)
+        self.functional_weight = torch.nn.Parameter(torch.randn(4, 8))
+
+    def forward(self, x):
+        x = self.relu(self.conv(x)).mean(dim=(2, 3))
+        x = self.fc(x)
+        return torch.nn.functional.linear(x, self.functional_weight)
+
+
+def _get_batches():
+    torch.manual_seed(0)
+    return [torch.randn(2, 3, 16, 16) for _ in range(3)]
+
+
+def _get_qspec_dtypes(node):
+    annotation = node.meta.get('quantization_annotation', None)
+    qspecs = list(annotation.input_qspec_map.values()) + [annotation.output_qspec] if annotation is not None else []
+    return [getattr(qspec, 'dtype', None) for qspec in qspecs if qspec is not None]
+
+
+def test_selected_nodes_are_annotated_16bit_after_init():
+    model = _Net()
+    batches = _get_batches()
+    node_sensitivity = mixed_precision.get_node_sensitivity(model, batches)
+    # the functional linear is not annotated by the quantizer, so it can not be promoted to 16 bits
+    assert len(node_sensitivity) == 2
+    assert all(isinstance(node_stats['error'], float) for node_stats in node_sensitivity.values())
+    node_list = mixed_precision.get_16bit_node_list(model, batches, max_mac_fraction=1.0, node_sensitivity=node_sensitivity)
+    assert len(node_list) > 0
+
+    prepared_model = quant_func.init(model, is_qat=False, total_epochs=2, example_inputs=(batches[0],), allow_16bit_node_list=node_list)
+    nodes = {node.name: node for node in prepared_model.graph.nodes}
+    for node_name in node_list:
+        assert torch.int16 in _get_qspec_dtypes(nodes[node_name]), node_name
+    #
+    for node_name in set(node_sensitivity) - set(node_list):
+        assert torch.int16 not in _get_qspec_dtypes(nodes[node_name]), node_name
+    #
+
+
+def test_sensitivity_interpreter_releases_the_intermediate_values():
+    model = quant_func.init(_Net(), is_qat=False, total_epochs=2, example_inputs=(_get_batches()[0],))
+    quant_func.freeze(model, freeze_bn=True, freeze_observers=True)
+    stats = {}
+    interpreter = mixed_precision._SensitivityInterpreter(model, stats)
+    max_num_values = []
+    run_node = interpreter.run_node
+    def _tracking_run_node(node):
+        max_num_values.append(len(interpreter.env))
+        return run_node(node)
+    #
+    interpreter.run_node = _tracking_run_node
+    with torch.no_grad():
+        interpreter.run(_get_batches()[0])
+    #
+    assert max(max_num_values) < len(model.graph.nodes) // 2
+    assert len(interpreter.pending) == 0 and len(stats) == 2
@@ -0,0 +1,96 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import quant_func, quant_utils
+
+
+def _get_model():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 8, 3, padding=1), torch.nn.ReLU(), torch.nn.Conv2d(8, 8, 3, padding=1))
+    return quant_func.init(model, is_qat=False, total_epochs=2, example_inputs=(torch.randn(2, 3, 16, 16),))
+
+
+def _calibrate(model):
+    model.calibrate()
+    generator = torch.Generator().manual_seed(1)
+    with torch.no_grad():
+        for _ in range(3):
+            model(torch.randn(2, 3, 16, 16, generator=generator))
+        #
+    #
+    return model
+
+
+def _get_qparams(model):
+    return {name: tuple(qparam.detach().clone() for qparam in module.calculate_qparams()) for name, module in model.named_modules() 
+            if isinstance(module, torch.ao.quantization.FakeQuantizeBase)}
+
+
+def test_save_load_round_trip(tmp_path):
+    filename = str(tmp_path / 'observer_stats.pt')
+    model = _calibrate(_get_model())
+    model.save_observer_stats(filename)
+
+    loaded_model = _get_model()
+    loaded_model.load_observer_stats(filename)
+    observers = quant_utils.get_observer_modules(model)
+    loaded_observers = quant_utils.get_observer_modules(loaded_model)
+    states = quant_utils.get_observer_state(observers)
+    loaded_states = quant_utils.get_observer_state(loaded_observers)
+    assert len(states) > 0 and states.keys() == loaded_states.keys()
+    for name in states:
+        for key in states[name]:
+            assert torch.equal(states[name][key], loaded_states[name][key]), (name, key)
+        #
+    #
+    # the fake quantize qparams are refreshed from the loaded statistics
+    qparams = _get_qparams(model)
+    loaded_qparams = _get_qparams(loaded_model)
+    for name in qparams:
+        for qparam, loaded_qparam in zip(qparams[name], loaded_qparams[name]):
+            assert torch.equal(qparam, loaded_qparam), name
+        #
+    #
+
+
+def test_stats_file_loads_with_weights_only(tmp_path):
+    filename = str(tmp_path / 'observer_stats.pt')
+    _calibrate(_get_model()).save_observer_stats(filename)
+    data = torch.load(filename, weights_only=True)
+    assert data['format_version'] == quant_utils.OBSERVER_STATS_FORMAT_VERSION
+
+
+@pytest.mark.parametrize('field', ['observer_type', 'qscheme', 'shape'])
+def test_mismatching_stats_are_rejected(tmp_path, field):
+    filename = str(tmp_path / 'observer_stats.pt')
+    _calibrate(_get_model()).save_observer_stats(filename)
+    data = torch.load(filename, weights_only=True)
+    name = next(iter(data['observers']))
+    if field == 'shape':
+        state = data['observers'][name]['state']
+        state['min_val'] = torch.zeros(state['min_val'].numel() + 3)
+        state['max_val'] = torch.ones(state['max_val'].numel() + 3)
+    else:
+        data['observers'][name][field] = 'Other'
+    #
+    torch.save(data, filename)
+
+    model = _get_model()
+    with pytest.raises(RuntimeError, match=name):
+        model.load_observer_stats(filename)
+    #
+    # not strict: the mismatching observer is not loaded, the others are
+    model = _get_model()
+    initial_state = quant_utils.get_observer_state(quant_utils.get_observer_modules(model))[name]
+    with pytest.warns(UserWarning, match=name):
+        model.load_observer_stats(filename, strict=False)
+    #
+    observers = quant_utils.get_observer_modules(model)
+    state = quant_utils.get_observer_state(observers)
+    for key, value in initial_state.items():
+        assert torch.equal(state[name][key], value)
+    #
+    other_names = [other_name for other_name in observers if other_name != name]
+    assert len(other_names) > 0
+    assert all(torch.equal(state[other_name]['min_val'], data['observers'][other_name]['state']['min_val']) for other_name in other_names)
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import quant_func
+
+
+WORLD_SIZE = 2
+
+
+def _get_qparams(model):
+    return {name: tuple(qparam.detach().clone() for qparam in module.calculate_qparams()) for name, module in model.named_modules() 
+            if isinstance(module, torch.ao.quantization.FakeQuantizeBase)}
+
+
+def _sync_worker(rank, init_file, output_dir):
+    dist.init_process_group('gloo', init_method=f'file://{init_file}', rank=rank, world_size=WORLD_SIZE)
+    try:
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(torch.nn.Conv2d(3, 8, 3, padding=1), torch.nn.ReLU(), torch.nn.Conv2d(8, 8, 3, padding=1))
+        model = quant_func.init(model, is_qat=False, total_epochs=2, example_inputs=(torch.randn(2, 3, 16, 16),), observer_sync_interval=0)
+        model.calibrate()
+        # a different range of the data in each rank
+        generator = torch.Generator().manual_seed(rank)
+        with torch.no_grad():
+            for _ in range(3):
+                model(torch.randn(2, 3, 16, 16, generator=generator) * (rank + 1))
+            #
+        #
+        # freezing the observers syncs them in all the ranks
+        model.freeze()
+        torch.save(_get_qparams(model), os.path.join(output_dir, f'qparams_{rank}.pt'))
+        if rank == 0:
+            # convert / export only in rank 0 must not wait for the other ranks
+            model.convert()
+        #
+    finally:
+        dist.destroy_process_group()
+    #
+
+
+@pytest.mark.skipif(not dist.is_available(), reason="torch.distributed is not available")
+def test_observer_sync_gives_the_same_qparams_in_every_rank(tmp_path):
+    context = mp.spawn(_sync_worker, args=(str(tmp_path / 'init'), str(tmp_path)), nprocs=WORLD_SIZE, join=False)
+    for _ in range(60):
+        if context.join(timeout=5):
+            break
+        #
+    else:
+        for process in context.processes:
+            process.terminate()
+        #
+        pytest.fail("the ranks did not finish - deadlock in the observer sync")
+    #
+    qparams = [torch.load(tmp_path / f'qparams_{rank}.pt') for rank in range(WORLD_SIZE)]
+    assert len(qparams[0]) > 0 and qparams[0].keys() == qparams[1].keys()
+    for name in qparams[0]:
+        for qparam0, qparam1 in zip(qparams[0][name], qparams[1][name]):
+            assert torch.equal(qparam0, qparam1), name
+        #
+    #
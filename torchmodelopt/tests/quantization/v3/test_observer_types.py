@@ -0,0 +1,65 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import observer_types
+
+
+def _legacy_adjust_range_max(observer):
+    # the implementation with the host sync, as it was before the tensor version
+    signed_range = torch.min(observer.min_val.detach()).item() < 0.0
+    min_val = (-observer.range_max) if signed_range else 0.0
+    max_val = +observer.range_max
+    if observer.fixed_range:
+        observer.min_val.fill_(min_val)
+        observer.max_val.fill_(max_val)
+    else:
+        observer.min_val = torch.clamp(observer.min_val, min=min_val, max=0.0)
+        observer.max_val = torch.clamp(observer.max_val, min=0.0, max=max_val)
+    #
+
+
+def _legacy_symmetric_min_max(min_val, max_val):
+    signed_range = torch.min(min_val.detach()).item() < 0.0
+    max_abs = torch.max(torch.abs(min_val), torch.abs(max_val))
+    return (-max_abs if signed_range else max_abs * 0.0), max_abs
+
+
+@pytest.mark.parametrize('observer_type', [observer_types.AdaptiveWeightObserver, observer_types.AdaptivePerChannelWeightObserver])
+@pytest.mark.parametrize('fixed_range', [False, True])
+@pytest.mark.parametrize('offset', [0.0, 5.0])
+def test_adjust_range_max_matches_the_legacy_implementation(observer_type, fixed_range, offset):
+    torch.manual_seed(0)
+    x = torch.randn(8, 4, 3, 3) * 4 + offset
+    observer = observer_type(range_max=2.0, fixed_range=fixed_range)
+    observer(x)
+    legacy_observer = observer_type(range_max=None)
+    legacy_observer(x)
+    legacy_observer.range_max, legacy_observer.fixed_range = 2.0, fixed_range
+    _legacy_adjust_range_max(legacy_observer)
+    assert torch.equal(observer.min_val, legacy_observer.min_val)
+    assert torch.equal(observer.max_val, legacy_observer.max_val)
+
+
+@pytest.mark.parametrize('min_val, max_val', [(-1.0, 3.0), (0.5, 3.0), (-4.0, -1.0), (0.0, 0.0)])
+def test_symmetric_min_max_matches_the_legacy_implementation(min_val, max_val):
+    min_val, max_val = torch.tensor(min_val), torch.tensor(max_val)
+    new_min, new_max = observer_types._symmetric_min_max(min_val, max_val)
+    legacy_min, legacy_max = _legacy_symmetric_min_max(min_val, max_val)
+    assert torch.equal(new_min, legacy_min) and torch.equal(new_max, legacy_max)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="the host syncs can only be detected on cuda")
+def test_adaptive_observers_have_no_host_sync():
+    observers = [observer_types.AdaptiveWeightObserver(range_max=2.0).cuda(),
+                 observer_types.AdaptivePerChannelWeightObserver(range_max=2.0).cuda(),
+                 observer_types.AdaptiveMinMaxActivationObserver(range_max=2.0, qscheme=torch.per_tensor_symmetric).cuda()]
+    x = torch.randn(8, 4, 3, 3, device='cuda')
+    torch.cuda.set_sync_debug_mode('error')
+    try:
+        for observer in observers:
+            observer(x)
+            observer._calculate_qparams(observer.min_val, observer.max_val)
+        #
+    finally:
+        torch.cuda.set_sync_debug_mode('default')
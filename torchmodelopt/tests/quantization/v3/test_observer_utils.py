@@ -0,0 +1,146 @@
+import random
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v2 import observer_utils as observer_utils_v2
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import observer_utils, quant_utils
+
+
+def _get_observer(batched_search, device='cpu'):
+    observer = observer_utils.CumulativeMSEHistogramObserver(batched_search=batched_search).to(device)
+    torch.manual_seed(0)
+    for _ in range(4):
+        observer(torch.randn(8, 16, 32, 32, device=device) * 3 + 0.5)
+    #
+    return observer
+
+
+def test_batched_mse_search_matches_the_sequential_search():
+    observer = _get_observer(batched_search=False)
+    reference_min, reference_max = observer._non_linear_param_search()
+    new_min, new_max = observer_utils._batched_mse_param_search(observer.histogram, observer.min_val, observer.max_val, observer.dst_nbins)
+    bin_width = (observer.max_val - observer.min_val) / observer.bins
+    assert torch.allclose(new_min, reference_min, atol=bin_width.item())
+    assert torch.allclose(new_max, reference_max, atol=bin_width.item())
+
+
+def test_batched_mse_search_with_zero_width_range():
+    value = torch.tensor(1.5)
+    new_min, new_max = observer_utils._batched_mse_param_search(torch.zeros(256), value, value, 256)
+    assert new_min.item() == 1.5 and new_max.item() == 1.5
+
+
+def _get_range_bins(observer, new_min, new_max):
+    bin_width = (observer.max_val - observer.min_val) / observer.bins
+    start_bin = int(torch.round((new_min - observer.min_val) / bin_width).item())
+    end_bin = int(torch.round((new_max - observer.min_val) / bin_width).item()) - 1
+    return start_bin, end_bin
+
+
+def test_batched_mse_search_is_an_exhaustive_search():
+    # bimodal data, where the greedy search of HistogramObserver can stop at a local minimum
+    observer = torch.ao.quantization.HistogramObserver(bins=32)
+    torch.manual_seed(0)
+    observer(torch.cat([torch.randn(4096) * 0.2 - 3.0, torch.randn(4096) + 2.0, torch.tensor([12.0])]))
+    errors = {(start_bin, end_bin): observer._compute_quantization_error(start_bin, end_bin).item()
+              for start_bin in range(observer.bins) for end_bin in range(start_bin, observer.bins)}
+    new_min, new_max = observer_utils._batched_mse_param_search(observer.histogram, observer.min_val, observer.max_val, observer.dst_nbins)
+    batched_error = errors[_get_range_bins(observer, new_min, new_max)]
+    greedy_error = errors[_get_range_bins(observer, *observer._non_linear_param_search())]
+    # the global minimum over all the ranges, so never worse than the greedy search
+    assert batched_error == pytest.approx(min(errors.values()), rel=1e-5)
+    assert batched_error <= greedy_error * (1 + 1e-5)
+
+
+def test_batched_mse_search_is_shared_by_v2_and_v3():
+    assert observer_utils_v2._batched_mse_param_search is observer_utils._batched_mse_param_search
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="the host syncs can only be detected on cuda")
+def test_batched_mse_search_has_no_host_sync():
+    observer = _get_observer(batched_search=True, device='cuda')
+    torch.cuda.set_sync_debug_mode('error')
+    try:
+        observer_utils._batched_mse_param_search(observer.histogram, observer.min_val, observer.max_val, observer.dst_nbins)
+    finally:
+        torch.cuda.set_sync_debug_mode('default')
+
+
+def _legacy_adjust_qparams_power2_scale(min_val, max_val, quant_min, quant_max, scale, zero_point, eps):
+    # the implementation with torch.unique and the python condition, as it was before the vectorized version
+    scale = observer_utils._ceil2_tensor(scale)
+    scale = torch.max(scale, eps)
+    if len(torch.unique(zero_point))>1 or torch.unique(zero_point) not in (0,127):
+        min_val_neg = torch.min(min_val, torch.zeros_like(min_val))
+        zero_point = quant_min - torch.round(min_val_neg / scale).to(torch.int)
+        zero_point = torch.clamp(zero_point, quant_min, quant_max)
+    #
+    return scale, zero_point
+
+
+@pytest.mark.parametrize('adjust_qparams', [observer_utils._adjust_qparams_power2_scale, observer_utils_v2._adjust_qparams_power2_scale])
+@pytest.mark.parametrize('zero_point', [[0], [127], [37], [0, 0, 0, 0], [127, 127, 127, 127], [0, 127, 0, 127], [3, 40, 0, 127]])
+@pytest.mark.parametrize('dtype', [torch.int64, torch.int32])
+def test_adjust_qparams_power2_scale_matches_the_legacy_implementation(adjust_qparams, zero_point, dtype):
+    torch.manual_seed(0)
+    num_channels = len(zero_point)
+    min_val, max_val = -torch.rand(num_channels) * 4, torch.rand(num_channels) * 4
+    scale = (max_val - min_val) / 255
+    zero_point = torch.tensor(zero_point, dtype=dtype)
+    eps = torch.tensor(torch.finfo(torch.float32).eps)
+    args = (min_val, max_val, 0, 255, scale, zero_point, eps)
+    new_scale, new_zero_point = adjust_qparams(*args)
+    legacy_scale, legacy_zero_point = _legacy_adjust_qparams_power2_scale(*args)
+    assert torch.equal(new_scale, legacy_scale)
+    assert torch.equal(new_zero_point.to(torch.int64), legacy_zero_point.to(torch.int64))
+    # the dtype of the zero_point is preserved in both the cases (kept or adjusted)
+    assert new_zero_point.dtype == dtype
+
+
+def _get_calibration_batches():
+    # batches of different sizes, so that the sampled counts have different weights
+    torch.manual_seed(0)
+    return [torch.randn(batch_size, 16, 32, 32) * 3 + 0.5 for batch_size in (8, 2, 8, 4)]
+
+
+def _calibrate(observer, batches):
+    random.seed(0)
+    for batch in batches:
+        observer(batch)
+    #
+    return observer
+
+
+def _assert_qparams_close(observer, reference_observer):
+    scale, zero_point = observer.calculate_qparams()
+    reference_scale, reference_zero_point = reference_observer.calculate_qparams()
+    assert torch.allclose(scale, reference_scale, rtol=0.05)
+    assert (zero_point - reference_zero_point).abs().max() <= 2
+
+
+def test_sampled_histogram_is_in_element_units():
+    batches = _get_calibration_batches()
+    observer = _calibrate(observer_utils.CumulativeMSEHistogramObserver(sample_budget=4096), batches)
+    num_elements = sum(batch.numel() for batch in batches)
+    assert abs(observer.histogram.sum().item() - num_elements) <= 1e-4 * num_elements
+
+
+def test_sampled_histogram_qparams_are_close_to_the_full_histogram():
+    batches = _get_calibration_batches()
+    observer = _calibrate(observer_utils.CumulativeMSEHistogramObserver(sample_budget=4096), batches)
+    reference_observer = _calibrate(observer_utils.CumulativeMSEHistogramObserver(), batches)
+    _assert_qparams_close(observer, reference_observer)
+
+
+def test_merged_sampled_histograms_are_close_to_the_full_histogram():
+    # as in calibrate_sharded - the shards have a different number of elements
+    batches = _get_calibration_batches()
+    shard_observers = [_calibrate(observer_utils.CumulativeMSEHistogramObserver(sample_budget=4096), batches[:1]),
+                       _calibrate(observer_utils.CumulativeMSEHistogramObserver(sample_budget=4096), batches[1:])]
+    observer = observer_utils.CumulativeMSEHistogramObserver(sample_budget=4096)
+    quant_utils.merge_observer_states({'observer': observer}, [quant_utils.get_observer_state({'observer': shard_observer}) 
+                                                                for shard_observer in shard_observers])
+    reference_observer = _calibrate(observer_utils.CumulativeMSEHistogramObserver(), batches)
+    _assert_qparams_close(observer, reference_observer)
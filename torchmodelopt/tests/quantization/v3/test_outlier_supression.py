@@ -0,0 +1,90 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import quant_func, quant_utils
+
+
+class _MLP(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.fc1 = torch.nn.Linear(16, 32)
+        self.gelu = torch.nn.GELU()
+        self.fc2 = torch.nn.Linear(32, 16)
+
+    def forward(self, x):
+        return self.fc2(self.gelu(self.fc1(x)))
+
+
+def _get_batches(num_batches=4):
+    generator = torch.Generator().manual_seed(0)
+    # a different distribution in every batch
+    return [torch.randn(2, 8, 16, generator=generator) * (index + 1) + index for index in range(num_batches)]
+
+
+def _get_model(**kwargs):
+    torch.manual_seed(0)
+    model = quant_func.init(_MLP(), is_qat=True, total_epochs=10, example_inputs=(torch.randn(2, 8, 16),), **kwargs)
+    model.train()
+    return model
+
+
+def test_statistics_stop_updating_after_the_warmup():
+    outlier_stats = quant_utils.OutlierSupressionStats(warmup_steps=2, momentum=0.5)
+    batches = _get_batches()
+    for batch in batches[:2]:
+        outlier_stats(None, (batch,))
+    #
+    assert outlier_stats.is_frozen() and outlier_stats.num_steps == 2
+    frozen_state = [value.clone() for value in (outlier_stats.running_mean, outlier_stats.running_std, 
+                                                outlier_stats.clip_val_min, outlier_stats.clip_val_max)]
+    for batch in batches[2:]:
+        (output,) = outlier_stats(None, (batch,))
+        # the frozen clip values are used for the later batches
+        assert torch.equal(output, torch.clip(batch, min=frozen_state[2], max=frozen_state[3]))
+    #
+    assert outlier_stats.num_steps == 2
+    for value, frozen_value in zip((outlier_stats.running_mean, outlier_stats.running_std, 
+                                    outlier_stats.clip_val_min, outlier_stats.clip_val_max), frozen_state):
+        assert torch.equal(value, frozen_value)
+    #
+
+
+def test_first_step_matches_the_per_batch_statistics():
+    batch = _get_batches(1)[0]
+    (output,) = quant_utils.OutlierSupressionStats(warmup_steps=2)(None, (batch,))
+    (expected_output,) = quant_utils._fc_outlier_supression_hook(None, (batch,))
+    assert torch.equal(output, expected_output)
+
+
+def test_model_statistics_stop_updating_after_the_warmup():
+    model = _get_model(outlier_warmup_steps=2)
+    assert len(model.__quant_params__.outlier_hooks) == 1
+    batches = _get_batches()
+    with torch.no_grad():
+        for batch in batches[:2]:
+            model(batch)
+        #
+        (outlier_stats,) = model.__quant_params__.outlier_stats.values()
+        running_mean, running_std = outlier_stats.running_mean.clone(), outlier_stats.running_std.clone()
+        for batch in batches[2:]:
+            model(batch)
+        #
+    #
+    assert outlier_stats.num_steps == 2
+    assert torch.equal(outlier_stats.running_mean, running_mean) and torch.equal(outlier_stats.running_std, running_std)
+
+
+def test_unset_option_uses_the_statistics_of_every_batch():
+    model = _get_model()
+    assert len(model.__quant_params__.outlier_hooks) == 1
+    target = quant_utils.get_fc_outlier_supression_targets(model)[0]
+    hooks = list(getattr(model, target)._forward_pre_hooks.values())
+    # the same hook as before the option was added, no running statistics
+    assert hooks == [quant_utils._fc_outlier_supression_hook]
+    with torch.no_grad():
+        for batch in _get_batches():
+            model(batch)
+        #
+    #
+    assert model.__quant_params__.outlier_stats == {}
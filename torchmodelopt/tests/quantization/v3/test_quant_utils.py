@@ -0,0 +1,50 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v2 import quant_utils as quant_utils_v2
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import quant_utils
+
+
+def _legacy_attention_forward(self, x):
+    # QuantAttention.forward as it was before the scale buffer - the q scale vector is created in every call
+    B, N, C = x.shape
+    qkv = torch.permute(self.qkv(x).reshape(B, N, 3, self.num_heads, -1), (2, 0, 3, 1, 4))
+    q, k, v = qkv.unbind(0)
+    q, k = self.q_norm(q), self.k_norm(k)
+    q = torch.mul(q, torch.tensor([self.scale]*self.head_dim))
+    attn = self.softmax(torch.matmul(q, k.transpose(-2, -1)))
+    x = torch.matmul(self.attn_drop(attn), v)
+    x = x.transpose(1, 2).reshape(B, N, -1)
+    return self.proj_drop(self.proj(x))
+
+
+@pytest.mark.parametrize('attention_type', [quant_utils.QuantAttention, quant_utils_v2.QuantAttention])
+def test_quant_attention_scale_buffer_matches_the_legacy_forward(attention_type):
+    torch.manual_seed(0)
+    attention = attention_type(dim=64, num_heads=4, qkv_bias=True).eval()
+    x = torch.randn(2, 10, 64)
+    assert torch.equal(attention(x), _legacy_attention_forward(attention, x))
+    # the buffer is not saved, so that the existing checkpoints still load
+    assert 'scale_tensor' not in attention.state_dict()
+    assert attention.to(torch.float64).scale_tensor.dtype == torch.float64
+
+
+@pytest.mark.parametrize('layer_norm_without_gb', [quant_utils.LayerNormWithoutGB, quant_utils_v2.LayerNormWithoutGB])
+@pytest.mark.parametrize('shape', [(4, 7), (2, 197, 192)])
+def test_layer_norm_without_gb_matches_layer_norm(layer_norm_without_gb, shape):
+    torch.manual_seed(0)
+    x = torch.randn(*shape) * 3 + 1
+    output = layer_norm_without_gb(x, 1e-5)
+    torch.testing.assert_close(output, torch.nn.functional.layer_norm(x, shape[-1:], eps=1e-5), rtol=1e-5, atol=1e-5)
+    # the variance is the biased one (unbiased=False), as in layer_norm
+    var = torch.var(x.to(torch.float64), dim=-1, keepdim=True, unbiased=False)
+    expected = (x.to(torch.float64) - x.to(torch.float64).mean(dim=-1, keepdim=True)) / torch.sqrt(var + 1e-5)
+    torch.testing.assert_close(output.to(torch.float64), expected, rtol=1e-5, atol=1e-5)
+
+
+def test_native_layer_norm_decomposition_matches_layer_norm():
+    torch.manual_seed(0)
+    x, weight, bias = torch.randn(2, 10, 32), torch.randn(32), torch.randn(32)
+    torch.testing.assert_close(quant_utils.native_layer_norm(x, (32,), weight, bias, 1e-6),
+                               torch.nn.functional.layer_norm(x, (32,), weight, bias, eps=1e-6), rtol=1e-5, atol=1e-5)
@@ -0,0 +1,130 @@
+import dataclasses
+import functools
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from torch.fx import Node
+from torch.fx.passes.utils.source_matcher_utils import get_source_partitions
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import quant_func, quantizers
+
+
+class _Block(torch.nn.Module):
+    def __init__(self, channels):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(channels, channels, 3, padding=1)
+        self.bn = torch.nn.BatchNorm2d(channels)
+
+    def forward(self, x):
+        return torch.relu(self.bn(self.conv(x))) + x
+
+
+class _TransformerBlock(torch.nn.Module):
+    # pre norm attention and mlp: linear / layernorm / matmul / softmax / gelu
+    def __init__(self, dim, num_heads=2):
+        super().__init__()
+        self.num_heads = num_heads
+        self.norm1 = torch.nn.LayerNorm(dim)
+        self.qkv = torch.nn.Linear(dim, dim * 3)
+        self.proj = torch.nn.Linear(dim, dim)
+        self.norm2 = torch.nn.LayerNorm(dim)
+        self.fc1 = torch.nn.Linear(dim, dim * 4)
+        self.gelu = torch.nn.GELU()
+        self.fc2 = torch.nn.Linear(dim * 4, dim)
+
+    def forward(self, x):
+        batch_size, seq_len, dim = x.shape
+        qkv = self.qkv(self.norm1(x)).reshape(batch_size, seq_len, 3, self.num_heads, dim // self.num_heads).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        attn = torch.softmax(torch.matmul(q, k.transpose(-2, -1)) * (dim // self.num_heads) ** -0.5, dim=-1)
+        y = torch.matmul(attn, v).transpose(1, 2).reshape(batch_size, seq_len, dim)
+        x = x + self.proj(y)
+        return x + self.fc2(self.gelu(self.fc1(self.norm2(x))))
+
+
+def _get_conv_model():
+    return torch.nn.Sequential(*[_Block(8) for _ in range(6)]), (torch.randn(2, 8, 16, 16),)
+
+
+def _get_transformer_model():
+    return torch.nn.Sequential(*[_TransformerBlock(16) for _ in range(4)]), (torch.randn(2, 8, 16),)
+
+
+class _LegacyGraphIndex(quantizers._AnnotationGraphIndex):
+    # the lookups as they were before the index: a walk of the graph / a get_source_partitions call in every pass
+    def get_nodes(self, targets):
+        return [node for node in self.gm.graph.nodes if node.op == 'call_function' and node.target in targets]
+
+    def get_partitions(self, wanted_sources):
+        return get_source_partitions(self.gm.graph, wanted_sources)
+
+
+def _describe(value):
+    # a comparable description of the annotations (the observer constructors are created again in every call)
+    if isinstance(value, Node):
+        return ('node', value.name)
+    elif isinstance(value, (list, tuple)):
+        return tuple(_describe(v) for v in value)
+    elif isinstance(value, dict):
+        return tuple(sorted((_describe(k), _describe(v)) for k, v in value.items()))
+    elif dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return (type(value).__name__,) + tuple((field.name, _describe(getattr(value, field.name))) for field in dataclasses.fields(value))
+    elif isinstance(value, functools.partial):
+        return ('partial', _describe(value.func), _describe(value.args), _describe(value.keywords))
+    elif hasattr(value, 'p') and isinstance(value.p, functools.partial):
+        # _PartialWrapper of with_args
+        return _describe(value.p)
+    elif isinstance(value, type) or callable(value):
+        return getattr(value, '__qualname__', getattr(value, '__name__', type(value).__name__))
+    elif value is None or isinstance(value, (bool, int, float, str, torch.dtype, torch.qscheme)):
+        return repr(value)
+    else:
+        return type(value).__name__
+    #
+
+
+def _get_annotations(monkeypatch, model_fn, legacy=False):
+    annotations = {}
+    annotate = quantizers.TIDLRTQuantizer.annotate
+
+    def _recording_annotate(self, model):
+        model = annotate(self, model)
+        annotations.update({node.name: _describe(node.meta.get('quantization_annotation', None)) for node in model.graph.nodes})
+        return model
+    #
+    with monkeypatch.context() as context:
+        context.setattr(quantizers.TIDLRTQuantizer, 'annotate', _recording_annotate)
+        if legacy:
+            context.setattr(quantizers.TIDLRTQuantizer, '_get_graph_index', lambda self, gm: _LegacyGraphIndex(gm, self._get_partition_types()))
+        #
+        torch.manual_seed(0)
+        model, example_inputs = model_fn()
+        quant_func.init(model, is_qat=False, total_epochs=2, example_inputs=example_inputs)
+    #
+    return annotations
+
+
+# the two input pass inserts constant nodes for the scalar operands (eg. the attention scale), after which
+# the partitions are found again once
+@pytest.mark.parametrize('model_fn, expected_num_calls', [(_get_conv_model, (1,)), (_get_transformer_model, (1, 2))])
+def test_annotation_indexes_the_partitions_once(monkeypatch, model_fn, expected_num_calls):
+    num_calls = []
+    get_source_partitions = quantizers.get_source_partitions
+    def _counting_get_source_partitions(*args, **kwargs):
+        num_calls.append(1)
+        return get_source_partitions(*args, **kwargs)
+    #
+    monkeypatch.setattr(quantizers, 'get_source_partitions', _counting_get_source_partitions)
+    model, example_inputs = model_fn()
+    quant_func.init(model, is_qat=False, total_epochs=2, example_inputs=example_inputs)
+    # one get_source_partitions for all the annotation passes, irrespective of the number of layers
+    assert len(num_calls) in expected_num_calls
+
+
+@pytest.mark.parametrize('model_fn', [_get_conv_model, _get_transformer_model])
+def test_annotations_match_the_per_pass_lookups(monkeypatch, model_fn):
+    annotations = _get_annotations(monkeypatch, model_fn)
+    legacy_annotations = _get_annotations(monkeypatch, model_fn, legacy=True)
+    assert sum(annotation != repr(None) for annotation in annotations.values()) > 0
+    assert annotations == legacy_annotations
@@ -0,0 +1,92 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from edgeai_torchmodelopt.xmodelopt.quantization.v3 import quant_func, quant_utils, qconfig_types
+
+
+class _Mlp(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(3, 16, 3, padding=1)
+        self.fc1 = torch.nn.Linear(16, 32)
+        self.fc2 = torch.nn.Linear(32, 16)
+
+    def forward(self, x):
+        x = self.conv(x).flatten(2).transpose(1, 2)
+        return x + self.fc2(torch.nn.functional.gelu(self.fc1(x)))
+
+
+def test_train_eval_toggle_does_not_search_the_graph_again(monkeypatch):
+    num_calls = []
+    get_source_partitions = quant_utils.get_source_partitions
+    def _counting_get_source_partitions(*args, **kwargs):
+        num_calls.append(1)
+        return get_source_partitions(*args, **kwargs)
+    #
+    monkeypatch.setattr(quant_utils, 'get_source_partitions', _counting_get_source_partitions)
+    model = quant_func.init(_Mlp(), is_qat=True, total_epochs=10, example_inputs=(torch.randn(2, 3, 8, 8),))
+    num_init_calls = len(num_calls)
+    num_hooks = (len(model.__quant_params__.outlier_hooks), len(model.__quant_params__.bias_hooks))
+    assert num_hooks[1] > 0
+
+    for _ in range(5):
+        model.eval()
+        assert len(model.__quant_params__.outlier_hooks) == 0 and len(model.__quant_params__.bias_hooks) == 0
+        model.train()
+    #
+    # the hooks are re-attached from the cached targets
+    assert len(num_calls) == num_init_calls
+    assert (len(model.__quant_params__.outlier_hooks), len(model.__quant_params__.bias_hooks)) == num_hooks
+
+
+def _get_fake_quant_modules(model):
+    return [mod for mod in model.modules() if isinstance(mod, torch.ao.quantization.FakeQuantizeBase)]
+
+
+@pytest.mark.parametrize('qconfig_type', [qconfig_types.QConfigType.DEFAULT, qconfig_types.QConfigType.LSQ_WC8_AT8])
+@pytest.mark.parametrize('toggle', ['apply', 'load_state_dict'])
+def test_freeze_applies_the_observer_state_after_an_external_toggle(toggle, qconfig_type):
+    model = quant_func.init(_Mlp(), is_qat=True, total_epochs=10, qconfig_type=qconfig_type, example_inputs=(torch.randn(2, 3, 8, 8),))
+    model.freeze(freeze_bn=False, freeze_observers=False)
+    if toggle == 'apply':
+        model.apply(torch.ao.quantization.disable_observer)
+    else:
+        frozen_model = quant_func.init(_Mlp(), is_qat=True, total_epochs=10, qconfig_type=qconfig_type, example_inputs=(torch.randn(2, 3, 8, 8),))
+        frozen_model.freeze(freeze_bn=True, freeze_observers=True)
+        model.load_state_dict(frozen_model.state_dict())
+    #
+    assert all(mod.observer_enabled[0] == 0 for mod in _get_fake_quant_modules(model))
+    # the same mode as before the toggle
+    model.freeze(freeze_bn=False, freeze_observers=False)
+    assert all(mod.observer_enabled[0] == 1 for mod in _get_fake_quant_modules(model))
+
+
+def test_hook_targets_are_found_again_after_a_graph_edit_with_the_same_number_of_nodes(monkeypatch):
+    num_calls = []
+    get_source_partitions = quant_utils.get_source_partitions
+    def _counting_get_source_partitions(*args, **kwargs):
+        num_calls.append(1)
+        return get_source_partitions(*args, **kwargs)
+    #
+    monkeypatch.setattr(quant_utils, 'get_source_partitions', _counting_get_source_partitions)
+    model = quant_func.init(_Mlp(), is_qat=True, total_epochs=10, example_inputs=(torch.randn(2, 3, 8, 8),))
+    quant_func._get_hook_targets(model)
+    num_init_calls = len(num_calls)
+    freeze_state = quant_func._get_freeze_state(model)
+
+    # replace the gelu node with a new node - the number of nodes does not change
+    num_nodes = len(model.graph.nodes)
+    gelu_node = next(n for n in model.graph.nodes if n.target == torch.ops.aten.gelu.default)
+    with model.graph.inserting_after(gelu_node):
+        new_node = model.graph.call_function(gelu_node.target, gelu_node.args, gelu_node.kwargs)
+    #
+    new_node.meta = dict(gelu_node.meta)
+    gelu_node.replace_all_uses_with(new_node)
+    model.graph.erase_node(gelu_node)
+    model.recompile()
+    assert len(model.graph.nodes) == num_nodes
+
+    quant_func._get_hook_targets(model)
+    assert len(num_calls) > num_init_calls
+    assert quant_func._get_freeze_state(model) is not freeze_state
@@ -0,0 +1,84 @@
+import copy
+import gc
+import os
+import pickle
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from edgeai_torchmodelopt.xmodelopt.utils import model_retention
+
+
+def _make_retained_model(tmp_path):
+    model = torch.nn.Sequential(torch.nn.Linear(4, 4))
+    return model, model_retention.RetainedModel(model, retention_dir=str(tmp_path))
+
+
+def test_spilled_file_is_kept_until_the_last_copy_is_released(tmp_path):
+    model, retained_model = _make_retained_model(tmp_path)
+    filename = retained_model.filename
+    retained_copy = copy.deepcopy(retained_model)
+    assert retained_copy is not retained_model
+    del retained_model
+    gc.collect()
+    assert os.path.exists(filename)
+    assert torch.equal(retained_copy.get()[0].weight, model[0].weight)
+    del retained_copy
+    gc.collect()
+    assert not os.path.exists(filename)
+
+
+def test_unpickled_copy_from_another_process_does_not_remove_the_file(tmp_path):
+    _, retained_model = _make_retained_model(tmp_path)
+    filename = retained_model.filename
+    state = pickle.dumps(retained_model)
+    unpickled_model = pickle.loads(state)
+    # as if the copy was unpickled in a worker process
+    unpickled_model.owner_pid = -1
+    del retained_model
+    gc.collect()
+    del unpickled_model
+    gc.collect()
+    assert os.path.exists(filename)
+    os.remove(filename)
+
+
+class _UnpicklableNet(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.fc = torch.nn.Linear(4, 4)
+        self.register_buffer('scale', torch.ones(4))
+        self.act = lambda x: x.relu()
+
+    def forward(self, x):
+        return self.act(self.fc(x)) * self.scale
+
+
+def test_unpicklable_model_is_spilled_without_a_copy_in_memory(tmp_path):
+    model = _UnpicklableNet()
+    retained_model = model_retention.RetainedModel(model, retention_dir=str(tmp_path))
+    assert retained_model.weights_only
+    # only the structure of the model is kept in memory
+    assert all(p.is_meta for p in retained_model.skeleton.state_dict().values())
+    loaded_model = retained_model.get()
+    x = torch.randn(2, 4)
+    assert torch.equal(loaded_model(x), model(x))
+    # the copy in another process does not have the structure of the model
+    unpickled_model = pickle.loads(pickle.dumps(retained_model))
+    unpickled_model.owner_pid = -1
+    with pytest.raises(RuntimeError):
+        unpickled_model.get()
+
+
+def test_rss_is_the_current_and_not_the_peak_value():
+    rss_before = model_retention.get_rss_mb()
+    if rss_before is None:
+        pytest.skip("the resident memory is not available on this platform")
+    #
+    buffer = torch.ones(64 * 1024 * 1024, dtype=torch.uint8)
+    rss_with_buffer = model_retention.get_rss_mb()
+    del buffer
+    rss_after = model_retention.get_rss_mb()
+    assert rss_with_buffer > rss_before + 32
+    assert rss_after < rss_with_buffer - 32
@@ -0,0 +1,163 @@
+import pytest
+
+onnx = pytest.importorskip("onnx")
+
+import numpy as np
+from onnx import helper, numpy_helper, TensorProto
+from edgeai_torchmodelopt.xonnx import optimize_qdq
+
+
+def _qdq_model(with_zero_point=True, subgraph=False):
+    # x -> Q -> DQ -> Q -> DQ -> Relu (-> If with the DQ output used in the branches)
+    x_type = TensorProto.FLOAT
+    initializers = [numpy_helper.from_array(np.array(0.125, dtype=np.float32), 'scale1'),
+                    numpy_helper.from_array(np.array(0.125, dtype=np.float32), 'scale2')]
+    zero_point_inputs1, zero_point_inputs2 = [], []
+    if with_zero_point:
+        initializers += [numpy_helper.from_array(np.array(0, dtype=np.uint8), 'zp1'),
+                         numpy_helper.from_array(np.array(0, dtype=np.uint8), 'zp2')]
+        zero_point_inputs1, zero_point_inputs2 = ['zp1'], ['zp2']
+    #
+    nodes = [helper.make_node('QuantizeLinear', ['x', 'scale1'] + zero_point_inputs1, ['x_q']),
+             helper.make_node('DequantizeLinear', ['x_q', 'scale1'] + zero_point_inputs1, ['x_dq']),
+             helper.make_node('QuantizeLinear', ['x_dq', 'scale2'] + zero_point_inputs2, ['y_q']),
+             helper.make_node('DequantizeLinear', ['y_q', 'scale2'] + zero_point_inputs2, ['y_dq']),
+             helper.make_node('Relu', ['y_dq'], ['y'])]
+    outputs = [helper.make_tensor_value_info('y', x_type, [1, 4])]
+    if subgraph:
+        # the If branches use the outer scope scale and Q output
+        then_graph = helper.make_graph([helper.make_node('DequantizeLinear', ['y_q', 'scale2'], ['then_out'])], 'then', [],
+                                       [helper.make_tensor_value_info('then_out', x_type, [1, 4])])
+        else_graph = helper.make_graph([helper.make_node('DequantizeLinear', ['y_q', 'scale1'], ['else_out'])], 'else', [],
+                                       [helper.make_tensor_value_info('else_out', x_type, [1, 4])])
+        nodes.append(helper.make_node('If', ['cond'], ['z'], then_branch=then_graph, else_branch=else_graph))
+        outputs.append(helper.make_tensor_value_info('z', x_type, [1, 4]))
+    #
+    inputs = [helper.make_tensor_value_info('x', x_type, [1, 4])]
+    if subgraph:
+        inputs.append(helper.make_tensor_value_info('cond', TensorProto.BOOL, []))
+    #
+    graph = helper.make_graph(nodes, 'qdq', inputs, outputs, initializer=initializers)
+    return helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)])
+
+
+def test_fold_dq_q_pair():
+    model = _qdq_model()
+    removed_nodes = optimize_qdq.fold_redundant_qdq(model)
+    assert [node.op_type for node in removed_nodes] == ['QuantizeLinear', 'DequantizeLinear']
+
+
+def test_fold_dq_q_pair_without_zero_points():
+    model = _qdq_model(with_zero_point=False)
+    assert len(optimize_qdq.fold_redundant_qdq(model)) == 2
+
+
+def test_dq_q_pair_without_zero_points_is_not_folded_for_a_different_dtype():
+    # the DQ input is int8, the Q output without zero_point is uint8
+    model = _qdq_model(with_zero_point=False)
+    model.graph.node[0].attribute.append(helper.make_attribute('output_dtype', TensorProto.INT8))
+    model.opset_import[0].version = 21
+    assert optimize_qdq.fold_redundant_qdq(model) == []
+
+
+def test_subgraph_uses_are_renamed_and_kept():
+    model = _qdq_model(subgraph=True)
+    optimize_qdq.deduplicate_initializers(model)
+    optimize_qdq.fold_redundant_qdq(model)
+    optimize_qdq.remove_unused_initializers(model)
+    assert all(node.op_type != 'QuantizeLinear' or node.output[0] != 'y_q' for node in model.graph.node)
+    # the checker verifies that the (outer scope) inputs of the If branches are defined
+    onnx.checker.check_model(model)
+
+
+def test_validate_models_reports_an_invalid_model_as_a_failure():
+    pytest.importorskip("onnxruntime")
+    model = _qdq_model()
+    invalid_model = _qdq_model()
+    invalid_model.graph.node[-1].input[0] = 'missing'
+    assert optimize_qdq.validate_models(model, invalid_model) == (False, float('inf'))
+
+
+def _data_movement_model(num_chains=1, op_type='Reshape'):
+    # x -> Q -> (DQ -> Reshape/Transpose -> Q) x num_chains -> DQ -> Relu
+    initializers = [numpy_helper.from_array(np.array(0.125, dtype=np.float32), 'scale'),
+                    numpy_helper.from_array(np.array(0, dtype=np.uint8), 'zp'),
+                    numpy_helper.from_array(np.array([4, 1], dtype=np.int64), 'shape')]
+    nodes = [helper.make_node('QuantizeLinear', ['x', 'scale', 'zp'], ['q0'])]
+    for index in range(num_chains):
+        nodes.append(helper.make_node('DequantizeLinear', [f'q{index}', 'scale', 'zp'], [f'dq{index}']))
+        if op_type == 'Reshape':
+            # 1x4 <-> 4x1
+            shape_name = 'shape' if index % 2 == 0 else 'shape_back'
+            nodes.append(helper.make_node('Reshape', [f'dq{index}', shape_name], [f'r{index}']))
+        else:
+            nodes.append(helper.make_node('Transpose', [f'dq{index}'], [f'r{index}'], perm=[1, 0]))
+        #
+        nodes.append(helper.make_node('QuantizeLinear', [f'r{index}', 'scale', 'zp'], [f'q{index + 1}']))
+    #
+    initializers.append(numpy_helper.from_array(np.array([1, 4], dtype=np.int64), 'shape_back'))
+    out_shape = [1, 4] if num_chains % 2 == 0 else [4, 1]
+    nodes += [helper.make_node('DequantizeLinear', [f'q{num_chains}', 'scale', 'zp'], ['y_dq']),
+              helper.make_node('Relu', ['y_dq'], ['y'])]
+    graph = helper.make_graph(nodes, 'qdq', [helper.make_tensor_value_info('x', TensorProto.FLOAT, [1, 4])],
+                              [helper.make_tensor_value_info('y', TensorProto.FLOAT, out_shape)], initializer=initializers)
+    return helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)])
+
+
+@pytest.mark.parametrize("op_type", ['Reshape', 'Transpose'])
+def test_fold_dq_data_movement_q_chain(op_type):
+    model = _data_movement_model(op_type=op_type)
+    removed_nodes = optimize_qdq.fold_redundant_qdq(model)
+    assert sorted(node.op_type for node in removed_nodes) == ['DequantizeLinear', 'QuantizeLinear']
+    # the data movement op works directly on the quantized tensor
+    data_movement_node = [node for node in model.graph.node if node.op_type == op_type][0]
+    assert list(data_movement_node.input[:1]) == ['q0'] and list(data_movement_node.output) == ['q1']
+    onnx.checker.check_model(model)
+
+
+def test_dq_data_movement_q_chain_is_not_folded_for_per_channel():
+    model = _data_movement_model()
+    scale = model.graph.initializer[0]
+    scale.CopyFrom(numpy_helper.from_array(np.array([0.125] * 4, dtype=np.float32), 'scale'))
+    assert optimize_qdq.fold_redundant_qdq(model) == []
+
+
+def test_fold_all_the_chains():
+    # all the chains are folded (in a single pass, the graph has no chains that become foldable after a pass)
+    model = _data_movement_model(num_chains=8)
+    removed_nodes = optimize_qdq.fold_redundant_qdq(model)
+    assert len(removed_nodes) == 16
+    assert [node.op_type for node in model.graph.node] == ['QuantizeLinear'] + ['Reshape'] * 8 + ['DequantizeLinear', 'Relu']
+    onnx.checker.check_model(model)
+
+
+def test_fold_shared_dq():
+    # one DQ with two Q consumers (with the same qparams): both the Q nodes and the DQ are removed
+    model = _qdq_model()
+    model.graph.node.append(helper.make_node('QuantizeLinear', ['x_dq', 'scale2', 'zp2'], ['w_q']))
+    model.graph.node.append(helper.make_node('DequantizeLinear', ['w_q', 'scale2', 'zp2'], ['w']))
+    model.graph.output.append(helper.make_tensor_value_info('w', TensorProto.FLOAT, [1, 4]))
+    optimize_qdq.deduplicate_initializers(model)
+    removed_nodes = optimize_qdq.fold_redundant_qdq(model)
+    assert sorted(node.op_type for node in removed_nodes) == ['DequantizeLinear', 'QuantizeLinear', 'QuantizeLinear']
+    onnx.checker.check_model(model)
+
+
+@pytest.mark.parametrize("num_chains", [1, 4])
+def test_optimize_qdq_model_keeps_the_outputs(num_chains):
+    pytest.importorskip("onnxruntime")
+    import onnxruntime as ort
+    model = _data_movement_model(num_chains=num_chains)
+    original_model = onnx.ModelProto()
+    original_model.CopyFrom(model)
+    optimized_model, report = optimize_qdq.optimize_qdq_model(model, validate=True)
+    assert report['validated'] and report['max_abs_diff'] == 0.0
+    assert report['num_qdq_nodes_removed'] == 2 * num_chains
+    assert report['num_nodes_after'] == report['num_nodes_before'] - 2 * num_chains
+    # onnxruntime equivalence on inputs that cover the whole quantization range
+    inputs = {'x': np.linspace(-20.0, 40.0, 4, dtype=np.float32).reshape(1, 4)}
+    expected = ort.InferenceSession(original_model.SerializeToString(), providers=['CPUExecutionProvider']).run(None, inputs)
+    outputs = ort.InferenceSession(optimized_model.SerializeToString(), providers=['CPUExecutionProvider']).run(None, inputs)
+    for output, expected_output in zip(outputs, expected):
+        np.testing.assert_array_equal(output, expected_output)
+    #